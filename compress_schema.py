@@ -311,69 +311,74 @@ schema_definition = {
     }
   }
 }
+import copy
+import hashlib
+import json
 import string
+import re
+from collections import OrderedDict
+from functools import lru_cache
 
-def build_schema_maps(schema_json, start_entity_code='A', start_attr_code='a', start_rel_code='r'):
+
+# ==================================================
+# 1️⃣ 从 Schema 自动生成映射表
+# ==================================================
+def build_schema_maps(schema_json, start_entity_code='A', start_attr_code='a', start_rel_code='r',
+                      tokenizer=None, sample_kgs=None):
     """
     从Schema自动生成实体类型、属性和关系缩写映射表。
     支持嵌套属性（使用点号展开）。
+    传入 tokenizer 和样本KG时按token数分配代码（见 assign_token_codes），否则按字母顺序分配。
 
     Args:
         schema_json (dict): 你的Schema JSON对象
         start_entity_code (str): 实体类型起始字母（默认 'A'）
         start_attr_code (str): 属性起始字母（默认 'a'）
         start_rel_code (str): 关系起始字母（默认 'r'）
+        tokenizer: 训练用的 HF tokenizer，用于按token数分配代码
+        sample_kgs (list): 样本KG，统计属性/类型/关系的出现次数和代码所处的上下文
 
     Returns:
-        dict: { "entity_map": {...}, "attr_map": {...}, "relation_map": {...} }
+        dict: { "entity_map": {...}, "attr_map": {...}, "relation_map": {...}, "attr_regex_pattern": str }
     """
     entity_map = {}
     attr_map = {}
     relation_map = {}
 
-    # =============================
-    # 1️⃣ 实体类型映射
-    # =============================
+    # === 实体类型映射 ===
     entity_types = list(schema_json["Schema"]["EntityTypes"].keys())
     for i, etype in enumerate(entity_types):
         code = chr(ord(start_entity_code) + i)
         entity_map[etype] = code
 
-    # =============================
-    # 2️⃣ 属性映射（包括嵌套）
-    # =============================
+    # === 属性映射 ===
     all_attrs = []
     for etype, detail in schema_json["Schema"]["EntityTypes"].items():
         attrs = detail.get("attributes", {})
         for attr_name, attr_val in attrs.items():
-            if isinstance(attr_val, dict):  # 嵌套结构，如 Appearance
+            if isinstance(attr_val, dict):  # 嵌套结构
                 for sub_key in attr_val.keys():
                     all_attrs.append(f"{attr_name}.{sub_key}")
             else:
                 all_attrs.append(attr_name)
 
-    # 去重
     all_attrs = sorted(set(all_attrs))
 
-    # 分配简写（前缀 a, b, c...，若超26个则 aa, ab, ac...）
-    def gen_codes(prefix, items):
+    def gen_codes(items):
         letters = list(string.ascii_lowercase)
         codes = []
         for i in range(len(items)):
             if i < 26:
                 codes.append(letters[i])
             else:
-                # 超过26个时两位组合 aa, ab...
                 codes.append(letters[i // 26 - 1] + letters[i % 26])
         return codes
 
-    attr_codes = gen_codes('a', all_attrs)
+    attr_codes = gen_codes(all_attrs)
     for attr_name, code in zip(all_attrs, attr_codes):
         attr_map[attr_name] = code
 
-    # =============================
-    # 3️⃣ 关系映射
-    # =============================
+    # === 关系映射 ===
     relation_groups = schema_json["Schema"]["RelationTypes"]
     all_rels = []
     for group, rel_list in relation_groups.items():
@@ -381,91 +386,93 @@ def build_schema_maps(schema_json, start_entity_code='A', start_attr_code='a', s
             for rel in rel_list:
                 if isinstance(rel, str):
                     all_rels.append(rel)
-        elif isinstance(rel_list, dict):
-            # 兼容 OtherActions 结构
-            all_rels.extend(rel_list.get("format", []))
         elif isinstance(rel_list, list) and len(rel_list) and isinstance(rel_list[0], dict):
             for rel in rel_list:
                 all_rels.extend(rel.get("format", []))
     all_rels = sorted(set(all_rels))
-
-    rel_codes = gen_codes(start_rel_code, all_rels)
+    rel_codes = gen_codes(all_rels)
     for rel, code in zip(all_rels, rel_codes):
         relation_map[rel] = code
 
-    # =============================
-    # ✅ 汇总输出
-    # =============================
+    if tokenizer is not None:
+        if not sample_kgs:
+            raise ValueError("按token数分配代码需要提供 sample_kgs")
+        entity_map, attr_map, relation_map = assign_token_codes(tokenizer, sample_kgs, entity_types, all_attrs, all_rels)
+
     return {
         "entity_map": entity_map,
         "attr_map": attr_map,
-        "relation_map": relation_map
+        "relation_map": relation_map,
+        "attr_regex_pattern": build_attr_regex_pattern(attr_map)
     }
 
-import json
-import string
-import re
 
+# 按token数分配代码时的候选: 一到两个字母，都是 \w 字符，scan_attr_block 可以直接解析
+TOKEN_CODE_CANDIDATES = list(string.ascii_letters) + [a + b for a in string.ascii_letters for b in string.ascii_letters]
+# schema_format 用 m= 写实体提及，属性代码避开
+RESERVED_ATTR_CODES = frozenset("m")
+# 每类代码从样本中取多少个上下文估计token数
+NUM_TOKEN_CONTEXTS = 8
 
-# ==================================================
-# 1️⃣ 从 Schema 自动生成映射表
-# ==================================================
-def build_schema_maps(schema_json, start_entity_code='A', start_attr_code='a', start_rel_code='r'):
-    """从Schema自动生成实体类型、属性和关系缩写映射表"""
-    entity_map = {}
-    attr_map = {}
-    relation_map = {}
 
-    # === 实体类型映射 ===
-    entity_types = list(schema_json["Schema"]["EntityTypes"].keys())
-    for i, etype in enumerate(entity_types):
-        code = chr(ord(start_entity_code) + i)
-        entity_map[etype] = code
+def count_tokens(tokenizer, texts):
+    """批量统计每段文本的token数（不加特殊token）"""
+    texts = list(texts)
+    if not texts:
+        return []
+    return [len(ids) for ids in tokenizer(texts, add_special_tokens=False, return_attention_mask=False)["input_ids"]]
 
-    # === 属性映射 ===
-    all_attrs = []
-    for etype, detail in schema_json["Schema"]["EntityTypes"].items():
-        attrs = detail.get("attributes", {})
-        for attr_name, attr_val in attrs.items():
-            if isinstance(attr_val, dict):  # 嵌套结构
-                for sub_key in attr_val.keys():
-                    all_attrs.append(f"{attr_name}.{sub_key}")
-            else:
-                all_attrs.append(attr_name)
-
-    all_attrs = sorted(set(all_attrs))
-
-    def gen_codes(items):
-        letters = list(string.ascii_lowercase)
-        codes = []
-        for i in range(len(items)):
-            if i < 26:
-                codes.append(letters[i])
-            else:
-                codes.append(letters[i // 26 - 1] + letters[i % 26])
-        return codes
-
-    attr_codes = gen_codes(all_attrs)
-    for attr_name, code in zip(all_attrs, attr_codes):
-        attr_map[attr_name] = code
-
-    # === 关系映射 ===
-    relation_groups = schema_json["Schema"]["RelationTypes"]
-    all_rels = []
-    for group, rel_list in relation_groups.items():
-        if isinstance(rel_list, list):
-            for rel in rel_list:
-                if isinstance(rel, str):
-                    all_rels.append(rel)
-        elif isinstance(rel_list, list) and len(rel_list) and isinstance(rel_list[0], dict):
-            for rel in rel_list:
-                all_rels.extend(rel.get("format", []))
-    all_rels = sorted(set(all_rels))
-    rel_codes = gen_codes(all_rels)
-    for rel, code in zip(all_rels, rel_codes):
-        relation_map[rel] = code
 
-    # === 构建属性代码正则表达式模式（用于解析 STTL） ===
+def assign_token_codes(tokenizer, sample_kgs, entity_types, attr_names, rel_names):
+    """
+    按 tokenizer 分配代码，使样本编码后的 STTL token 数尽量少:
+    - 每个候选代码放进样本中真实的上下文里（实体行 "name:代码|"、属性 "|代码=值" / "值;代码=值"、关系 "s 代码 o"）计平均token数，
+      这样与 : | ; = 和空格合并成一个token的代码更便宜
+    - 出现次数多的类型/属性/关系分到token数少的代码，token数相同时优先字符少的代码
+    分隔符保持不变，解析端（decode、scan_attr_block、schema_format）不用修改。
+    返回 (entity_map, attr_map, relation_map)，键顺序与按字母分配时相同
+    """
+    attr_set, rel_set = set(attr_names), set(rel_names)
+    type_counts, attr_counts, rel_counts = {}, {}, {}
+    entity_ctx, attr_ctx, rel_ctx = [], [], []
+    for kg in sample_kgs:
+        attrs = kg.get("Attributes", {})
+        for ent, typ in kg.get("Entity_types", {}).items():
+            type_counts[typ] = type_counts.get(typ, 0) + 1
+            flat = [(k, v) for k, v in flatten_dict(attrs.get(ent, {})).items() if k in attr_set]
+            entity_ctx.append((f"{simplify_name(ent)}:", "|" if flat else "\n"))
+            prev = None
+            for k, v in flat:
+                attr_counts[k] = attr_counts.get(k, 0) + 1
+                attr_ctx.append(("|" if prev is None else f"{prev};", f"={v}"))
+                prev = v
+        for s, r, o in kg.get("Triples", []):
+            if r in rel_set:
+                rel_counts[r] = rel_counts.get(r, 0) + 1
+            rel_ctx.append((f"{simplify_name(s)} ", f" {simplify_name(o)}"))
+
+    def assign(names, counts, contexts, candidates):
+        if len(candidates) < len(names):
+            raise ValueError(f"候选代码不足: {len(names)} 个名字，{len(candidates)} 个候选")
+        # 均匀抽取上下文，没有样本时用空上下文
+        contexts = contexts[::max(1, len(contexts) // NUM_TOKEN_CONTEXTS)][:NUM_TOKEN_CONTEXTS] or [("", "")]
+        tokens = count_tokens(tokenizer, (left + code + right for code in candidates for left, right in contexts))
+        n = len(contexts)
+        cost = {code: sum(tokens[i * n:(i + 1) * n]) / n for i, code in enumerate(candidates)}
+        codes = sorted(candidates, key=lambda c: (cost[c], len(c), c))
+        # sorted 稳定，次数相同时保持原来的顺序
+        ordered = sorted(names, key=lambda name: -counts.get(name, 0))
+        assigned = dict(zip(ordered, codes))
+        return {name: assigned[name] for name in names}
+
+    entity_map = assign(entity_types, type_counts, entity_ctx, TOKEN_CODE_CANDIDATES)
+    attr_map = assign(attr_names, attr_counts, attr_ctx, [c for c in TOKEN_CODE_CANDIDATES if c not in RESERVED_ATTR_CODES])
+    relation_map = assign(rel_names, rel_counts, rel_ctx, TOKEN_CODE_CANDIDATES)
+    return entity_map, attr_map, relation_map
+
+
+def build_attr_regex_pattern(attr_map):
+    """构建属性代码正则表达式模式（用于解析 STTL）"""
     attr_codes = list(attr_map.values())
     # 按长度降序排序，确保较长的代码（如 'aa'）优先匹配
     attr_codes.sort(key=len, reverse=True)
@@ -475,21 +482,61 @@ def build_schema_maps(schema_json, start_entity_code='A', start_attr_code='a', s
     # 使用单词边界 \b 确保属性代码的完整匹配
     # 使用 [^;]* 匹配不包含分号的任意字符
     # 使用 ;? 匹配可选的分号
-    attr_regex_pattern = rf"\b({attr_pattern})=([^;]*);?"
+    return rf"\b({attr_pattern})=([^;]*);?"
 
-    return {
-        "entity_map": entity_map,
-        "attr_map": attr_map,
-        "relation_map": relation_map,
-        "attr_regex_pattern": attr_regex_pattern
-    }
+
+def is_word_code(code):
+    """代码是否全由 \\w 字符组成（Unicode 字母数字或下划线，与正则的 \\w 一致）"""
+    return bool(code) and all(c.isalnum() or c == "_" for c in code)
+
+
+def scan_attr_block(attr_part, codes):
+    """
+    手写的属性块扫描，结果与 re.findall(build_attr_regex_pattern(...), attr_part + ";") 相同，
+    要求所有属性代码都满足 is_word_code:
+    - 值里不含分号，按 ; 切分后每段至多匹配一个 "代码=值"，值取到段尾
+    - 段首到第一个 = 恰好是属性代码时直接命中（大多数行）
+    - 否则与正则一样在段内继续寻找前面不是 \\w 字符的 "代码="
+    返回 [(code, value), ...]
+    """
+    pairs = []
+    for seg in attr_part.split(";"):
+        code, has_eq, value = seg.partition("=")
+        if not has_eq:
+            continue
+        if code not in codes:
+            code, value = _search_attr_segment(seg, codes)
+            if code is None:
+                continue
+        pairs.append((code, value))
+    return pairs
+
+
+def _search_attr_segment(seg, codes):
+    # 依次检查每个 = 前面的完整单词，单词开头即正则 \b 的位置
+    eq = seg.find("=")
+    while eq >= 0:
+        start = eq
+        while start > 0 and (seg[start - 1].isalnum() or seg[start - 1] == "_"):
+            start -= 1
+        if start < eq and seg[start:eq] in codes:
+            return seg[start:eq], seg[eq + 1:]
+        eq = seg.find("=", eq + 1)
+    return None, None
 
 
 # ==================================================
 # 2️⃣ JSON → Schema-aware Turtle (STTL)
 # ==================================================
+_NAME_RE = re.compile(r"[^A-Za-z0-9_]+")
+
+
 def simplify_name(name):
-    return re.sub(r"[^A-Za-z0-9_]+", "_", name.strip())
+    return _NAME_RE.sub("_", name.strip())
+
+
+# 同一实体名会出现在实体行和多条关系行中，也常在不同KG间重复
+_simplify_name_cached = lru_cache(maxsize=1 << 16)(simplify_name)
 
 
 def flatten_dict(d, prefix=""):
@@ -502,65 +549,20 @@ def flatten_dict(d, prefix=""):
     return flat
 
 
-def convert_json_2_sttl(kg, maps=None, schema_json=None, calc_ratio=False):
+def convert_json_2_sttl(kg, maps=None, schema_json=None, calc_ratio=False, tokenizer=None):
     """
     压缩知识图谱为 Schema-Aware Turtle (STTL)
     - 用 Schema 缩写实体类型、属性名和关系名
+    - 等价于 get_codec(maps, schema_json).encode(kg, calc_ratio)，批量转换时直接复用 SchemaCodec
     
     Args:
         kg: 知识图谱 JSON 对象
         maps: 已构建的 schema maps（优先使用，避免重复构建）
         schema_json: Schema JSON 对象（如果 maps 为 None 则使用此参数构建 maps）
         calc_ratio: 是否计算压缩比
+        tokenizer: 计算压缩比时同时统计token数
     """
-    if maps is None:
-        if schema_json is None:
-            raise ValueError("必须提供 maps 或 schema_json 参数")
-        maps = build_schema_maps(schema_json)
-    Emap, Amap, Rmap = maps["entity_map"], maps["attr_map"], maps["relation_map"]
-
-    lines = []
-    ent_types = kg.get("Entity_types", {})
-    attrs = kg.get("Attributes", {})
-    triples = kg.get("Triples", [])
-
-    # === 实体与属性 ===
-    for ent, typ in ent_types.items():
-        typ_code = Emap.get(typ, "_")
-        eid = simplify_name(ent)
-
-        flat_attrs = flatten_dict(attrs.get(ent, {}))
-        attr_strs = []
-        for k, v in flat_attrs.items():
-            if k not in Amap:  # 超出schema的属性舍弃
-                continue
-            a_code = Amap[k]
-            attr_strs.append(f"{a_code}={v}")
-        joined = ";".join(attr_strs)
-        lines.append(f"{eid}:{typ_code}" + (f"|{joined}" if joined else ""))
-
-    # === 关系 ===
-    if triples:
-        lines.append("#R")
-        for s, r, o in triples:
-            s_id, o_id = simplify_name(s), simplify_name(o)
-            r_code = Rmap.get(r, r[0].lower())
-            lines.append(f"{s_id} {r_code} {o_id}")
-
-    sttl_str = "\n".join(lines)
-
-    if not calc_ratio:
-        return sttl_str
-
-    json_len = len(json.dumps(kg, separators=(",", ":")))
-    sttl_len = len(sttl_str)
-    ratio = sttl_len / json_len if json_len else 0
-    return sttl_str, {
-        "json_length": json_len,
-        "sttl_length": sttl_len,
-        "compression_ratio": round(ratio, 3),
-        "reduction_percent": round((1 - ratio) * 100, 1)
-    }
+    return get_codec(maps, schema_json).encode(kg, calc_ratio=calc_ratio, tokenizer=tokenizer)
 
 
 # ==================================================
@@ -569,68 +571,193 @@ def convert_json_2_sttl(kg, maps=None, schema_json=None, calc_ratio=False):
 def convert_sttl_2_json(sttl_text, maps=None, schema_json=None):
     """
     从 STTL 反解析回标准 JSON
+    - 等价于 get_codec(maps, schema_json).decode(sttl_text)，批量转换时直接复用 SchemaCodec
     
     Args:
         sttl_text: STTL 格式的字符串
         maps: 已构建的 schema maps（优先使用，避免重复构建）
         schema_json: Schema JSON 对象（如果 maps 为 None 则使用此参数构建 maps）
     """
-    if maps is None:
-        if schema_json is None:
-            raise ValueError("必须提供 maps 或 schema_json 参数")
-        maps = build_schema_maps(schema_json)
-    
-    Emap, Amap, Rmap = maps["entity_map"], maps["attr_map"], maps["relation_map"]
-    attr_regex_pattern = maps["attr_regex_pattern"]
-    rev_E = {v: k for k, v in Emap.items()}
-    rev_A = {v: k for k, v in Amap.items()}
-    rev_R = {v: k for k, v in Rmap.items()}
+    return get_codec(maps, schema_json).decode(sttl_text)
 
-    kg = {"Triples": [], "Entity_types": {}, "Attributes": {}}
 
-    lines = [l.strip() for l in sttl_text.splitlines() if l.strip()]
-    mode = "entity"
+# ==================================================
+# 4️⃣ 可复用的编解码器
+# ==================================================
+def schema_hash(obj):
+    """Schema 或 maps 内容的哈希。实体代码按 EntityTypes 的顺序分配，键顺序不同视为不同的 Schema"""
+    return hashlib.sha1(json.dumps(obj, ensure_ascii=False).encode("utf-8")).hexdigest()
 
-    for line in lines:
-        if line.startswith("#R"):
-            mode = "rel"
-            continue
 
-        if mode == "entity":
-            if ":" not in line:
+# 按 (类型, 内容哈希) 缓存的 SchemaCodec，LRU 淘汰，最多保留 CODEC_CACHE_SIZE 份 Schema
+CODEC_CACHE_SIZE = 64
+_codec_cache = OrderedDict()
+
+
+def _cached_codec(key, build):
+    codec = _codec_cache.get(key)
+    if codec is None:
+        codec = _codec_cache[key] = build()
+        if len(_codec_cache) > CODEC_CACHE_SIZE:
+            _codec_cache.popitem(last=False)
+    else:
+        _codec_cache.move_to_end(key)
+    return codec
+
+
+def ratio_stats(json_len, sttl_len, json_tokens=None, sttl_tokens=None):
+    """字符级压缩比统计（calc_ratio 的输出），给出token数时加上token级的压缩比"""
+    ratio = sttl_len / json_len if json_len else 0
+    stats = {
+        "json_length": json_len,
+        "sttl_length": sttl_len,
+        "compression_ratio": round(ratio, 3),
+        "reduction_percent": round((1 - ratio) * 100, 1)
+    }
+    if json_tokens is not None:
+        token_ratio = sttl_tokens / json_tokens if json_tokens else 0
+        stats.update({
+            "json_tokens": json_tokens,
+            "sttl_tokens": sttl_tokens,
+            "token_compression_ratio": round(token_ratio, 3),
+            "token_reduction_percent": round((1 - token_ratio) * 100, 1)
+        })
+    return stats
+
+
+class SchemaCodec:
+    """
+    按一份 Schema 构建一次、可复用的 STTL 编解码器，输出与 convert_json_2_sttl / convert_sttl_2_json 相同:
+    - 正向/反向映射表和编译好的属性正则在构建时生成，encode / decode 时不再重复构建
+    - decode 不做逐行正则匹配: 实体行按 : 和 | 切分，属性块用 scan_attr_block 扫描，#R 之后的三元组按空白切分；
+      只有属性代码不满足 is_word_code 时属性块才退回正则
+    - from_schema / from_maps 按内容哈希缓存 (LRU，最多 CODEC_CACHE_SIZE 份)，同一份 Schema 在进程内只构建一次
+    - encode_many / decode_many 批量编解码
+    """
+    def __init__(self, maps):
+        self.maps = maps
+        self.entity_map = maps["entity_map"]
+        self.attr_map = maps["attr_map"]
+        self.relation_map = maps["relation_map"]
+        self.rev_entity = {v: k for k, v in self.entity_map.items()}
+        self.rev_attr = {v: k for k, v in self.attr_map.items()}
+        self.rev_relation = {v: k for k, v in self.relation_map.items()}
+        pattern = build_attr_regex_pattern(self.attr_map)
+        self.attr_regex = re.compile(maps.get("attr_regex_pattern") or pattern)
+        # 代码都是单词字符且 maps 里的正则与 attr_map 一致时用 scan_attr_block，否则退回正则
+        self.scan_attrs = self.attr_regex.pattern == pattern and all(map(is_word_code, self.rev_attr))
+
+    @classmethod
+    def from_schema(cls, schema_json):
+        return _cached_codec(("schema", schema_hash(schema_json)), lambda: cls(build_schema_maps(schema_json)))
+
+    @classmethod
+    def from_maps(cls, maps):
+        # 缓存的编解码器持有 maps 的副本，调用方之后原地修改 maps 不会影响按旧内容缓存的编解码器
+        return _cached_codec(("maps", schema_hash(maps)), lambda: cls(copy.deepcopy(maps)))
+
+    def encode(self, kg, calc_ratio=False, tokenizer=None):
+        """JSON → STTL，calc_ratio 时返回 (sttl_str, 压缩比统计)，传入 tokenizer 时统计中再加上token级的压缩比"""
+        Emap, Amap, Rmap = self.entity_map, self.attr_map, self.relation_map
+        lines = []
+        attrs = kg.get("Attributes", {})
+        # === 实体与属性，超出schema的属性舍弃 ===
+        for ent, typ in kg.get("Entity_types", {}).items():
+            attr_strs = [f"{Amap[k]}={v}" for k, v in flatten_dict(attrs.get(ent, {})).items() if k in Amap]
+            line = f"{_simplify_name_cached(ent)}:{Emap.get(typ, '_')}"
+            lines.append(f"{line}|{';'.join(attr_strs)}" if attr_strs else line)
+
+        # === 关系 ===
+        triples = kg.get("Triples", [])
+        if triples:
+            lines.append("#R")
+            for s, r, o in triples:
+                lines.append(f"{_simplify_name_cached(s)} {Rmap.get(r, r[0].lower())} {_simplify_name_cached(o)}")
+
+        sttl_str = "\n".join(lines)
+        if not calc_ratio:
+            return sttl_str
+
+        json_str = json.dumps(kg, separators=(",", ":"))
+        if tokenizer is None:
+            return sttl_str, ratio_stats(len(json_str), len(sttl_str))
+        json_tokens, sttl_tokens = count_tokens(tokenizer, [json_str, sttl_str])
+        return sttl_str, ratio_stats(len(json_str), len(sttl_str), json_tokens, sttl_tokens)
+
+    def decode(self, sttl_text):
+        """STTL → JSON"""
+        rev_E, rev_A, rev_R = self.rev_entity, self.rev_attr, self.rev_relation
+        findall = self.attr_regex.findall
+        scan_attrs = self.scan_attrs
+        kg = {"Triples": [], "Entity_types": {}, "Attributes": {}}
+        entity_types, attributes, triples = kg["Entity_types"], kg["Attributes"], kg["Triples"]
+        in_relations = False
+
+        for line in sttl_text.splitlines():
+            line = line.strip()
+            if not line:
                 continue
-            ent_part, rest = line.split(":", 1)
-            ent_name = ent_part.replace("_", " ").strip()
-            if "|" in rest:
-                type_code, attr_part = rest.split("|", 1)
-            else:
-                type_code, attr_part = rest, ""
-            ent_type = rev_E.get(type_code.strip(), "Unknown")
-
-            attrs = {}
-            if attr_part:
-                # 使用预构建的正则表达式解析属性
-                # 检查字符串结尾是否有分号，如果没有就添加一个
-                if not attr_part.endswith(';'):
-                    attr_part = attr_part + ';'
-                
-                # 使用 re.findall 找到所有匹配
-                matches = re.findall(attr_regex_pattern, attr_part)
-                for k, v in matches:
-                    key_name = rev_A.get(k, None)
-                    if key_name:
-                        attrs[key_name] = v
-            kg["Entity_types"][ent_name] = ent_type
-            kg["Attributes"][ent_name] = attrs
-
-        elif mode == "rel":
-            if not line or len(line.split()) < 3:
+            if line.startswith("#R"):
+                in_relations = True
                 continue
-            s, r, o = line.split(maxsplit=2)
-            rel = rev_R.get(r, r)
-            kg["Triples"].append([s.replace("_", " "), rel, o.replace("_", " ")])
 
-    return kg
+            if not in_relations:
+                ent_part, has_type, rest = line.partition(":")
+                if not has_type:
+                    continue
+                ent_name = ent_part.replace("_", " ").strip()
+                type_code, _, attr_part = rest.partition("|")
+                attrs = {}
+                if attr_part:
+                    if scan_attrs:
+                        pairs = scan_attr_block(attr_part, rev_A)
+                    else:
+                        # 结尾补上分号，与正则的 ;? 一起保证最后一个属性值完整
+                        pairs = findall(attr_part if attr_part.endswith(";") else attr_part + ";")
+                    for k, v in pairs:
+                        key_name = rev_A.get(k)
+                        if key_name:
+                            attrs[key_name] = v
+                entity_types[ent_name] = rev_E.get(type_code.strip(), "Unknown")
+                attributes[ent_name] = attrs
+            else:
+                parts = line.split(maxsplit=2)
+                if len(parts) < 3:
+                    continue
+                s, r, o = parts
+                triples.append([s.replace("_", " "), rev_R.get(r, r), o.replace("_", " ")])
+
+        return kg
+
+    def encode_many(self, kgs, calc_ratio=False):
+        encode = self.encode
+        return [encode(kg, calc_ratio) for kg in kgs]
+
+    def compression_stats(self, kgs, tokenizer=None):
+        """整个语料的压缩比（总长度之比），传入 tokenizer 时批量统计token数，用于比较不同的代码分配"""
+        json_strs = [json.dumps(kg, separators=(",", ":")) for kg in kgs]
+        sttl_strs = self.encode_many(kgs)
+        json_len, sttl_len = sum(map(len, json_strs)), sum(map(len, sttl_strs))
+        if tokenizer is None:
+            return ratio_stats(json_len, sttl_len)
+        return ratio_stats(json_len, sttl_len, sum(count_tokens(tokenizer, json_strs)), sum(count_tokens(tokenizer, sttl_strs)))
+
+    def decode_many(self, sttl_texts):
+        decode = self.decode
+        return [decode(sttl_text) for sttl_text in sttl_texts]
+
+
+def get_codec(maps=None, schema_json=None):
+    """
+    maps 优先，否则按 schema_json 获取缓存的 SchemaCodec。
+    每次调用都按内容哈希查找，原地修改过的 maps / schema_json 会得到对应新内容的编解码器；
+    批量转换时先取一次 SchemaCodec 再复用，省掉每次调用的哈希计算。
+    """
+    if maps is not None:
+        return SchemaCodec.from_maps(maps)
+    if schema_json is not None:
+        return SchemaCodec.from_schema(schema_json)
+    raise ValueError("必须提供 maps 或 schema_json 参数")
 
 if __name__ == "__main__":
     schema_maps = build_schema_maps(schema_definition)
@@ -670,20 +797,27 @@ if __name__ == "__main__":
     }
 
     # === 压缩为 STTL ===
-    # 方式1: 使用已构建的 maps（推荐，可复用）
+    # 方式1: 使用按 Schema 缓存的编解码器（推荐，可复用）
     from pprint import pprint
-    sttl, stats = convert_json_2_sttl(kg, maps=schema_maps, calc_ratio=True)
+    codec = SchemaCodec.from_schema(schema_definition)
+    sttl, stats = codec.encode(kg, calc_ratio=True)
     print("=== STTL ===")
     print(sttl)
     print("\n=== Compression Stats ===")
     pprint(stats)
 
     # === 还原为 JSON ===
-    # 复用已构建的 maps，避免重复构建
-    restored = convert_sttl_2_json(sttl, maps=schema_maps)
+    # 复用同一个编解码器，不再重复构建反向映射和正则
+    restored = codec.decode(sttl)
     print("\n=== Restored JSON ===")
     print(json.dumps(restored, indent=2, ensure_ascii=False))
     
-    # 方式2: 直接传入 schema_json（兼容旧代码，但会重复构建 maps）
+    # 方式2: 直接传入 maps 或 schema_json（兼容旧代码，按内容哈希取缓存的编解码器）
     # sttl, stats = convert_json_2_sttl(kg, schema_json=schema_definition, calc_ratio=True)
     # restored = convert_sttl_2_json(sttl, schema_json=schema_definition)
+
+    # 方式3: 按训练用的 tokenizer 和样本KG分配代码，生成的 maps 需保存下来供训练和解析使用
+    # from transformers import AutoTokenizer
+    # tokenizer = AutoTokenizer.from_pretrained("/path/to/model")
+    # token_maps = build_schema_maps(schema_definition, tokenizer=tokenizer, sample_kgs=sample_kgs)
+    # sttl, stats = SchemaCodec(token_maps).encode(kg, calc_ratio=True, tokenizer=tokenizer)  # stats 含 token_compression_ratio
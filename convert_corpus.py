@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+JSON ⇄ STTL 语料批量转换脚本
+
+- 按行流式读取 jsonl，按 chunk 分发到进程池转换，内存占用只与 chunk 大小和并发数有关
+- 输出顺序与输入一致
+- 统计 lines/sec 和整体压缩比（与 calc_ratio 相同的口径：紧凑 JSON 字符数 vs STTL 字符数），--tokenizer 时再统计token级压缩比
+- 每写完一个 chunk 记录输入/输出字节偏移，中断后 --resume 从断点继续
+- 输出与输入逐行对齐：转换失败的行写占位记录（待转换字段为 null，--error_field 字段记录错误），空行原样保留
+
+用法示例：
+    python convert_corpus.py labelled.jsonl train_sttl.jsonl --direction json2sttl --field output
+    python convert_corpus.py preds_sttl.jsonl preds_json.jsonl --direction sttl2json --format schema_format
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SCHEMA_MAPS = os.path.join(REPO_DIR, "schema_maps.json")
+# 每个 chunk 最多回传的错误明细条数
+MAX_CHUNK_ERRORS = 5
+
+# 进程内的转换方向、转换函数和 tokenizer，由 _init_worker 设置，每个进程只构建一次
+_direction = None
+_convert = None
+_tokenizer = None
+
+
+def _build_converter(direction, fmt, maps, include_mentions):
+    """返回 value -> (转换结果, 紧凑 JSON 文本, STTL 文本) 的转换函数，两段文本用于统计压缩比"""
+    if fmt == "compress_schema":
+        from compress_schema import SchemaCodec
+        codec = SchemaCodec.from_maps(maps)
+        encode, decode = codec.encode, codec.decode
+    else:
+        from schema_format import jsonTosttl, sttl_to_kg
+
+        def encode(kg):
+            return jsonTosttl(kg, maps, include_mentions=include_mentions)
+
+        def decode(sttl):
+            return sttl_to_kg(sttl, maps, include_mentions=include_mentions)
+
+    if direction == "json2sttl":
+        def convert(kg):
+            sttl = encode(kg)
+            return sttl, json.dumps(kg, separators=(",", ":")), sttl
+    else:
+        def convert(sttl):
+            kg = decode(sttl)
+            return kg, json.dumps(kg, separators=(",", ":")), sttl
+    return convert
+
+
+def _init_worker(direction, fmt, maps, include_mentions, tokenizer_path=None):
+    global _direction, _convert, _tokenizer
+    _direction = direction
+    _convert = _build_converter(direction, fmt, maps, include_mentions)
+    if tokenizer_path:
+        from transformers import AutoTokenizer
+        _tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+
+
+def new_stats():
+    return {"lines": 0, "converted": 0, "errors": 0, "json_chars": 0, "sttl_chars": 0,
+            "json_tokens": 0, "sttl_tokens": 0, "ratio_sum": 0.0, "ratio_min": None, "ratio_max": None}
+
+
+def merge_stats(total, part):
+    for key in ("lines", "converted", "errors", "json_chars", "sttl_chars", "json_tokens", "sttl_tokens", "ratio_sum"):
+        total[key] += part[key]
+    for key, pick in (("ratio_min", min), ("ratio_max", max)):
+        if part[key] is not None:
+            total[key] = part[key] if total[key] is None else pick(total[key], part[key])
+    return total
+
+
+def convert_chunk(lines, field, error_field="convert_error"):
+    """
+    转换一个 chunk 的原始行（bytes），返回 (输出字节, 统计, 错误明细)。
+    输出与输入逐行对应：转换失败的行计入 errors，写一条占位记录（原记录的 field 置为 null，
+    行本身不是合法 JSON 时只有错误字段），error_field 记录错误；空行原样输出为空行。
+    """
+    out, errors, texts = [], [], []
+    stats = new_stats()
+    for idx, raw in enumerate(lines):
+        if not raw.strip():
+            out.append("")
+            continue
+        stats["lines"] += 1
+        record = None
+        try:
+            record = json.loads(raw)
+            value = record[field]
+            # json2sttl 时字段里可能是 JSON 字符串
+            if isinstance(value, str) and _direction == "json2sttl":
+                value = json.loads(value)
+            result, json_text, sttl_text = _convert(value)
+        except Exception as e:
+            message = f"{type(e).__name__}: {e}"
+            stats["errors"] += 1
+            if len(errors) < MAX_CHUNK_ERRORS:
+                errors.append((idx, message))
+            placeholder = dict(record, **{field: None}) if isinstance(record, dict) else {}
+            placeholder[error_field] = message
+            out.append(json.dumps(placeholder, ensure_ascii=False))
+            continue
+
+        record[field] = result
+        out.append(json.dumps(record, ensure_ascii=False))
+
+        if _tokenizer is not None:
+            texts += (json_text, sttl_text)
+        json_len, sttl_len = len(json_text), len(sttl_text)
+        ratio = sttl_len / json_len if json_len else 0
+        stats["converted"] += 1
+        stats["json_chars"] += json_len
+        stats["sttl_chars"] += sttl_len
+        stats["ratio_sum"] += ratio
+        stats["ratio_min"] = ratio if stats["ratio_min"] is None else min(stats["ratio_min"], ratio)
+        stats["ratio_max"] = ratio if stats["ratio_max"] is None else max(stats["ratio_max"], ratio)
+
+    if texts:
+        # 整个 chunk 一起分词
+        from compress_schema import count_tokens
+        counts = count_tokens(_tokenizer, texts)
+        stats["json_tokens"], stats["sttl_tokens"] = sum(counts[0::2]), sum(counts[1::2])
+
+    data = ("\n".join(out) + "\n").encode("utf-8") if out else b""
+    return data, stats, errors
+
+
+def read_chunks(f, chunk_size):
+    """按行读取二进制文件，产出 (行列表, chunk 结束处的字节偏移, chunk 起始行号)"""
+    line_no = 0
+    while True:
+        lines = []
+        for _ in range(chunk_size):
+            line = f.readline()
+            if not line:
+                break
+            lines.append(line)
+        if not lines:
+            return
+        yield lines, f.tell(), line_no
+        line_no += len(lines)
+
+
+def write_progress(path, progress):
+    """原子写入断点文件，避免中断时留下半个 JSON"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(progress, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def format_summary(stats, elapsed):
+    converted = stats["converted"]
+    overall = stats["sttl_chars"] / stats["json_chars"] if stats["json_chars"] else 0
+    summary = {
+        "lines": stats["lines"],
+        "converted": converted,
+        "errors": stats["errors"],
+        "lines_per_sec": round(stats["lines"] / elapsed, 1) if elapsed > 0 else 0.0,
+        "json_chars": stats["json_chars"],
+        "sttl_chars": stats["sttl_chars"],
+        "compression_ratio": round(overall, 3),
+        "reduction_percent": round((1 - overall) * 100, 1) if stats["json_chars"] else 0.0,
+        "mean_line_ratio": round(stats["ratio_sum"] / converted, 3) if converted else 0.0,
+        "min_line_ratio": round(stats["ratio_min"], 3) if stats["ratio_min"] is not None else None,
+        "max_line_ratio": round(stats["ratio_max"], 3) if stats["ratio_max"] is not None else None,
+    }
+    if stats["json_tokens"]:
+        token_ratio = stats["sttl_tokens"] / stats["json_tokens"]
+        summary.update({
+            "json_tokens": stats["json_tokens"],
+            "sttl_tokens": stats["sttl_tokens"],
+            "token_compression_ratio": round(token_ratio, 3),
+            "token_reduction_percent": round((1 - token_ratio) * 100, 1),
+        })
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON ⇄ STTL 语料流式并行转换")
+    parser.add_argument("input", help="输入 jsonl 文件")
+    parser.add_argument("output", help="输出 jsonl 文件")
+    parser.add_argument("--direction", choices=["json2sttl", "sttl2json"], default="json2sttl")
+    parser.add_argument("--format", choices=["compress_schema", "schema_format"], default="compress_schema",
+                        help="compress_schema: SchemaCodec（Entity_types，无 mentions）；schema_format: jsonTosttl/sttl_to_kg（Entity types，支持 m=）")
+    parser.add_argument("--schema_maps", type=str, default=DEFAULT_SCHEMA_MAPS, help="schema_maps.json 路径")
+    parser.add_argument("--field", type=str, default="output",
+                        help="每行中待转换的字段，转换结果原地替换该字段，其余字段原样保留")
+    parser.add_argument("--error_field", type=str, default="convert_error",
+                        help="转换失败的行输出占位记录（field 为 null），错误信息写入该字段，保持输出与输入逐行对齐")
+    parser.add_argument("--tokenizer", type=str, default=None, help="tokenizer 路径，指定时同时统计token级压缩比")
+    parser.add_argument("--no_mentions", action="store_true", help="schema_format 格式下不写入/解析 m= 提及")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count() or 1, help="进程数，<=1 时在主进程内转换")
+    parser.add_argument("--chunk_size", type=int, default=1000, help="每个任务包含的行数")
+    parser.add_argument("--max_pending", type=int, default=0, help="同时在途的 chunk 数上限，0 表示 2*num_workers")
+    parser.add_argument("--resume", action="store_true", help="从 <output>.progress.json 记录的断点继续")
+    parser.add_argument("--start_offset", type=int, default=0, help="从输入文件的该字节偏移开始（需在行首），结果追加到输出")
+    parser.add_argument("--log_every", type=float, default=10.0, help="每隔多少秒打印一次进度")
+    args = parser.parse_args()
+
+    with open(args.schema_maps, "r", encoding="utf-8") as f:
+        maps = json.load(f)
+    field = args.field
+    include_mentions = not args.no_mentions
+    progress_path = args.output + ".progress.json"
+
+    # ---- 断点 ----
+    stats = new_stats()
+    input_offset, output_offset, prev_elapsed = args.start_offset, None, 0.0
+    if args.resume and os.path.exists(progress_path):
+        with open(progress_path, "r", encoding="utf-8") as f:
+            progress = json.load(f)
+        if progress["input"] != os.path.abspath(args.input) or progress["direction"] != args.direction \
+                or progress["format"] != args.format:
+            print(f"❌ 错误: 断点文件 {progress_path} 与当前输入/方向/格式不一致")
+            sys.exit(1)
+        if progress.get("done"):
+            print(f"✅ {args.output} 已转换完成，无需继续")
+            return
+        input_offset, output_offset = progress["input_offset"], progress["output_offset"]
+        stats = {**new_stats(), **progress["stats"]}
+        prev_elapsed = progress.get("elapsed", 0.0)
+        print(f"🔄 从断点继续: 输入偏移 {input_offset}，输出偏移 {output_offset}，已处理 {stats['lines']} 行")
+    elif args.resume:
+        print(f"⚠️  未找到断点文件 {progress_path}，从头开始")
+
+    if output_offset is not None:
+        # 丢弃断点之后写了一半的输出
+        outfile = open(args.output, "r+b")
+        outfile.truncate(output_offset)
+        outfile.seek(output_offset)
+    else:
+        outfile = open(args.output, "ab" if input_offset else "wb")
+
+    infile = open(args.input, "rb")
+    if input_offset:
+        infile.seek(input_offset - 1)
+        if infile.read(1) != b"\n":
+            print(f"❌ 错误: 偏移 {input_offset} 不在行首")
+            sys.exit(1)
+
+    init_args = (args.direction, args.format, maps, include_mentions, args.tokenizer)
+    if args.num_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=args.num_workers, initializer=_init_worker,
+                                       initargs=init_args)
+        max_pending = args.max_pending or 2 * args.num_workers
+    else:
+        executor = None
+        max_pending = 1
+        _init_worker(*init_args)
+
+    print(f"🚀 {args.input} -> {args.output} ({args.direction}, {args.format}, workers={args.num_workers}, chunk={args.chunk_size})")
+    start_time = time.perf_counter()
+    start_lines = stats["lines"]
+    last_log = start_time
+    pending = deque()
+
+    def elapsed():
+        return prev_elapsed + time.perf_counter() - start_time
+
+    def drain_one():
+        nonlocal last_log
+        future, end_offset, first_line = pending.popleft()
+        data, part, errors = future.result() if executor else future
+        for idx, msg in errors:
+            print(f"⚠️  本次第 {first_line + idx + 1} 行转换失败，已写占位记录: {msg}")
+        outfile.write(data)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+        merge_stats(stats, part)
+        # 输出先落盘再记录断点，断点之前的输出一定完整
+        write_progress(progress_path, {
+            "input": os.path.abspath(args.input), "direction": args.direction, "format": args.format,
+            "input_offset": end_offset, "output_offset": outfile.tell(),
+            "stats": stats, "elapsed": elapsed(), "done": False,
+        })
+        now = time.perf_counter()
+        if now - last_log >= args.log_every:
+            rate = (stats["lines"] - start_lines) / (now - start_time)
+            print(f"⏱️  已处理 {stats['lines']} 行，{rate:.1f} lines/sec，失败 {stats['errors']} 行")
+            last_log = now
+
+    try:
+        for lines, end_offset, first_line in read_chunks(infile, args.chunk_size):
+            if executor:
+                future = executor.submit(convert_chunk, lines, field, args.error_field)
+            else:
+                future = convert_chunk(lines, field, args.error_field)
+            pending.append((future, end_offset, first_line))
+            # 限制在途 chunk 数，读取不会跑在转换前面太多
+            while len(pending) >= max_pending:
+                drain_one()
+        while pending:
+            drain_one()
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        infile.close()
+        outfile.close()
+
+    summary = format_summary(stats, elapsed())
+    summary["lines_per_sec_this_run"] = round((stats["lines"] - start_lines) / (time.perf_counter() - start_time), 1)
+    write_progress(progress_path, {
+        "input": os.path.abspath(args.input), "direction": args.direction, "format": args.format,
+        "input_offset": os.path.getsize(args.input), "output_offset": os.path.getsize(args.output),
+        "stats": stats, "elapsed": elapsed(), "done": True, "summary": summary,
+    })
+    print("✅ 转换完成")
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if stats["errors"]:
+        print(f"⚠️  {stats['errors']} 行转换失败，输出中对应行为占位记录（含 {args.error_field} 字段）")
+
+
+if __name__ == "__main__":
+    main()
@@ -119,10 +119,21 @@ echo "  EPOCHS=${EPOCHS:-10}"
 echo "  BATCH_SIZE=${BATCH_SIZE:-2}"
 echo "  LEARNING_RATE=${LEARNING_RATE:-3e-4}"
 
+# ============ 选择 accelerate 配置 ============
+# 多adapter训练只支持DDP，其余默认使用 DeepSpeed ZeRO-2
+if [ -z "${ACCELERATE_CONFIG:-}" ]; then
+  if [ -n "${MULTI_ADAPTER_CONFIG:-}" ]; then
+    ACCELERATE_CONFIG="ddp_config.yaml"
+  else
+    ACCELERATE_CONFIG="default_config.yaml"
+  fi
+fi
+echo "  ACCELERATE_CONFIG=${ACCELERATE_CONFIG}"
+
 # ============ 启动训练 ============
 echo "🚀 开始训练 ..."
 apptainer run --bind /DATA_B:/workspace,/DATA_A:/data --nv env/apptainer.sif \
- accelerate launch --config_file default_config.yaml\
+ accelerate launch --config_file "${ACCELERATE_CONFIG}"\
   src/train.py \
   --model_name "${MODEL_NAME}" \
   --dataset_dir "${DATASET_DIR}" \
@@ -136,15 +147,28 @@ apptainer run --bind /DATA_B:/workspace,/DATA_A:/data --nv env/apptainer.sif \
   --learning_rate "${LEARNING_RATE}" \
   --lora_rank "${LORA_RANK}" \
   --dataset_eval_dir "${DATASET_EVAL_DIR}" \
-  --save_total_limit "${SAVE_TOTAL_LIMIT}"
+  --save_total_limit "${SAVE_TOTAL_LIMIT}" \
+  ${ASYNC_CHECKPOINT:+--async_checkpoint} \
+  ${RESUME_FROM_CHECKPOINT:+--resume_from_checkpoint "${RESUME_FROM_CHECKPOINT}"} \
+  ${AUTO_TOKEN_BUDGET:+--auto_token_budget} \
+  ${MULTI_ADAPTER_CONFIG:+--multi_adapter_config "${MULTI_ADAPTER_CONFIG}"} \
+  ${ADAPTER_ROUTING:+--adapter_routing "${ADAPTER_ROUTING}"} \
+  ${SHAPE_BUCKET_SIZE:+--shape_bucket_size "${SHAPE_BUCKET_SIZE}"} \
+  ${COMPILE_MODEL:+--compile_model}
 
 echo "🎉 训练完成！"
 
 # ============ 输出最新的模型目录 ============
 echo "📁 查找最新的模型检查点..."
 if [ -d "${OUTPUT_DIR}" ]; then
-  # 查找 output_dir 下最新的目录（按修改时间排序）
-  LATEST_CHECKPOINT=$(find "${OUTPUT_DIR}" -maxdepth 1 -type d -name "checkpoint-*" | sort -V | tail -1)
+  # 优先读取训练脚本原子写入的完成标记，只有所有rank都写完的checkpoint才会出现在这里
+  LATEST_MARKER="${OUTPUT_DIR%/}/latest_checkpoint"
+  if [ -f "$LATEST_MARKER" ]; then
+    LATEST_CHECKPOINT=$(head -n 1 "$LATEST_MARKER")
+  else
+    # 兼容没有完成标记的旧输出目录：按步数取最大的 checkpoint-*
+    LATEST_CHECKPOINT=$(find "${OUTPUT_DIR}" -maxdepth 1 -type d -name "checkpoint-*" | sort -V | tail -1)
+  fi
   
   if [ -n "$LATEST_CHECKPOINT" ]; then
     # 将容器内路径映射回主机路径
@@ -158,6 +182,7 @@ if [ -d "${OUTPUT_DIR}" ]; then
     
     echo "✅ 找到最新检查点: $LATEST_CHECKPOINT"
     echo "🔄 映射到主机路径: $HOST_CHECKPOINT"
+    echo "LATEST_CHECKPOINT=$HOST_CHECKPOINT"
     echo "$HOST_CHECKPOINT"  # 输出主机路径到 stdout，供 zenml_pipeline.py 捕获
   else
     echo "⚠️  警告: 在 $OUTPUT_DIR 中未找到 checkpoint-* 目录"
@@ -1,8 +1,13 @@
+import os
 import re
 import json
+import time
 from typing import Dict
 
 schema_maps = "/Users/universe/Desktop/complate_format/schema_maps.json"
+if not os.path.exists(schema_maps):
+    # 不在原开发机上时使用仓库内的 schema_maps.json
+    schema_maps = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema_maps.json")
 with open(schema_maps,"r",encoding="utf-8") as f:
     maps = json.load(f)
 
@@ -68,91 +73,197 @@ def jsonTosttl(kg: dict, maps: dict, include_mentions: bool = True) -> str:
     return "\n".join(lines)
 
 
+def scan_attr_block(attr_block: str) -> list:
+    """
+    手写的属性块扫描，结果与 re.findall(r'([^=;]+)=([^;]*)', attr_block) 相同：
+    - 按 ; 切分后每段至多一个 key=value，值取到段尾（可以再含 =）
+    - 段首的 = 会被跳过，key 是其后到下一个 = 之间的内容
+    返回 [(key, value), ...]，key/value 未去空白
+    """
+    pairs = []
+    for seg in attr_block.split(";"):
+        key, has_eq, val = seg.lstrip("=").partition("=")
+        if has_eq:
+            pairs.append((key, val))
+    return pairs
+
+
+def reverse_maps(maps: dict):
+    """
+    (实体, 属性, 关系) 的 代码 → 名称 反向映射。每个 STTLStreamParser 构建一次，不跨调用缓存：
+    maps 只有几十个条目，直接构建比按内容哈希查缓存更快，原地修改过的 maps 也总能得到最新的映射
+    """
+    return tuple({v: k for k, v in maps[name].items()} for name in ("entity_map", "attr_map", "relation_map"))
+
+
 def sttl_to_kg(sttl_str: str, maps: dict, entity_name_map: dict = None, include_mentions: bool = True) -> dict:
     """
     解析端：
     - 解析 m= 部分直接恢复到实体的属性部分
+    - 整行语法都按分隔符切分，不做逐行正则匹配: 实体行按 : 和第一个 | 切分，属性块用 scan_attr_block，
+      m= 的值按 || 切分，#R 之后的三元组按空白切分
+    - 逐行解析与 STTLStreamParser 共用，流式输出可以边生成边解析
     """
-    Emap, Amap, Rmap = maps["entity_map"], maps["attr_map"], maps["relation_map"]
-    rev_e = {v: k for k, v in Emap.items()}
-    rev_a = {v: k for k, v in Amap.items()}
-    rev_r = {v: k for k, v in Rmap.items()}
+    parser = STTLStreamParser(maps, entity_name_map=entity_name_map, include_mentions=include_mentions)
+    parse_line = parser.parse_line
+    for raw_line in sttl_str.strip().splitlines():
+        parse_line(raw_line)
+    return parser.kg
 
-    kg = {
-        "Entity types": {},
-        "Attributes": {},
-        "Triples": [],
-    }
 
-    # 如果 include_mentions 为 True，才处理 Entity mentions 部分
-    if include_mentions:
-        kg["Entity mentions"] = {}
+# str.splitlines 认作换行的字符，流式输入时据此判断缓冲区最后一行是否已经结束
+_LINE_BREAK_RE = re.compile("[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+
+
+class STTLStreamParser:
+    """
+    增量解析 STTL：模型流式输出的文本块逐块 feed 进来，每行结束就解析并产出事件，不必等完整输出：
+    - ("entity", 实体名, 实体类型, 属性dict, mentions列表 或 None)
+    - ("triple", [主语, 关系, 宾语])
+    close() 之后 kg 与 sttl_to_kg(完整文本) 相同。
+
+    time_to_first_entity / chars_to_first_entity 记录从 start_time（默认构造时刻，可传入请求发出的时刻）
+    到产出第一个实体时的耗时和已接收的字符数。
+    skip_invalid_lines=False 时非法行与 sttl_to_kg 一样抛异常；为 True 时跳过并计入 invalid_lines。
+    """
+    def __init__(self, maps: dict, entity_name_map: dict = None, include_mentions: bool = True,
+                 skip_invalid_lines: bool = False, start_time: float = None):
+        self.rev_e, self.rev_a, self.rev_r = reverse_maps(maps)
+        self.entity_name_map = entity_name_map
+        self.include_mentions = include_mentions
+        self.skip_invalid_lines = skip_invalid_lines
+        self.kg = {
+            "Entity types": {},
+            "Attributes": {},
+            "Triples": [],
+        }
+        # 如果 include_mentions 为 True，才处理 Entity mentions 部分
+        if include_mentions:
+            self.kg["Entity mentions"] = {}
+        self.parsing_triples = False
+        self.buffer = ""
+        self.invalid_lines = 0
+        self.chars_fed = 0
+        self.start_time = time.perf_counter() if start_time is None else start_time
+        self.time_to_first_entity = None
+        self.chars_to_first_entity = None
+
+    def feed(self, chunk: str) -> list:
+        """接收一个文本块，返回本块内结束的所有行产生的事件"""
+        self.chars_fed += len(chunk)
+        if not _LINE_BREAK_RE.search(chunk):
+            self.buffer += chunk
+            return []
+        lines = (self.buffer + chunk).splitlines(True)
+        # 最后一行没有换行符时还没结束，留在缓冲区等后续文本块
+        self.buffer = "" if _LINE_BREAK_RE.match(lines[-1][-1]) else lines.pop()
+        return self._parse_lines(lines)
 
-    lines = sttl_str.strip().splitlines()
-    parsing_triples = False
+    def close(self) -> list:
+        """输入结束，解析缓冲区里没有换行符的最后一行"""
+        lines, self.buffer = [self.buffer], ""
+        return self._parse_lines(lines)
+
+    def _parse_lines(self, lines):
+        events = []
+        for line in lines:
+            try:
+                event = self.parse_line(line)
+            except (ValueError, AttributeError, TypeError):
+                if not self.skip_invalid_lines:
+                    raise
+                self.invalid_lines += 1
+                continue
+            if event is not None:
+                events.append(event)
+        if self.time_to_first_entity is None and any(event[0] == "entity" for event in events):
+            self.time_to_first_entity = time.perf_counter() - self.start_time
+            self.chars_to_first_entity = self.chars_fed
+        return events
 
-    for raw_line in lines:
+    def parse_line(self, raw_line: str):
+        """解析完整的一行并写入 kg，返回对应的事件（空行、#R 和无法识别的行返回 None）"""
         line = raw_line.strip()
         if not line:
-            continue
+            return None
 
         if line == "#R":
-            parsing_triples = True
-            continue
+            self.parsing_triples = True
+            return None
 
+        entity_name_map = self.entity_name_map
         # 解析三元组
-        if parsing_triples:
+        if self.parsing_triples:
             parts = line.split()
-            if len(parts) == 3:
-                s, r_code, o = parts
-                rel_name = rev_r.get(r_code, r_code)
-                if entity_name_map:
-                    s_name = entity_name_map.get(s, s.replace("_", " "))
-                    o_name = entity_name_map.get(o, o.replace("_", " "))
-                else:
-                    s_name, o_name = s.replace("_", " "), o.replace("_", " ")
-                kg["Triples"].append([s_name, rel_name, o_name])
-            continue
-
-        # 解析实体行（entity:typ|attr;attr;...）
-        if ":" in line:
-            entity_part, *attr_part = line.split("|", 1)
-            entity_id, typ_code = entity_part.split(":", 1)
-            entity_type = rev_e.get(typ_code, typ_code)
+            if len(parts) != 3:
+                return None
+            s, r_code, o = parts
+            rel_name = self.rev_r.get(r_code, r_code)
             if entity_name_map:
-                entity_id_clean = entity_name_map.get(entity_id, entity_id.replace("_", " "))
+                s_name = entity_name_map.get(s, s.replace("_", " "))
+                o_name = entity_name_map.get(o, o.replace("_", " "))
             else:
-                entity_id_clean = entity_id.replace("_", " ")
-            kg["Entity types"][entity_id_clean] = entity_type
-
-            attrs = {}
-            if attr_part:
-                attr_block = attr_part[0]
-                # 提取 key=value 对
-                for m in re.finditer(r'([^\=;]+)=([^;]*)', attr_block):
-                    a_code = m.group(1).strip()
-                    val = m.group(2).strip()
-                    if not a_code:
-                        continue
-                    if a_code == "m" and include_mentions:
-                        mentions_list = [v.strip() for v in val.split("||") if v.strip()]
-                        kg["Entity mentions"][entity_id_clean] = mentions_list
-                        continue
-                    attr_name = rev_a.get(a_code, a_code)
-                    attrs[attr_name] = val
-
-                # 恢复嵌套属性 a.b.c 恢复成嵌套字典
-                d = {}
-                for k, v in attrs.items():
-                    keys = k.split(".")
-                    temp = d
-                    for key in keys[:-1]:
-                        temp = temp.setdefault(key, {})
-                    temp[keys[-1]] = v
-                attrs = d
-            kg["Attributes"][entity_id_clean] = attrs
-
-    return kg
+                s_name, o_name = s.replace("_", " "), o.replace("_", " ")
+            triple = [s_name, rel_name, o_name]
+            self.kg["Triples"].append(triple)
+            return ("triple", triple)
+
+        # 解析实体行（entity:typ|attr;attr;...）
+        if ":" not in line:
+            return None
+        entity_part, *attr_part = line.split("|", 1)
+        entity_id, typ_code = entity_part.split(":", 1)
+        entity_type = self.rev_e.get(typ_code, typ_code)
+        if entity_name_map:
+            entity_id_clean = entity_name_map.get(entity_id, entity_id.replace("_", " "))
+        else:
+            entity_id_clean = entity_id.replace("_", " ")
+
+        attrs = {}
+        mentions = None
+        if attr_part:
+            rev_a = self.rev_a
+            # 提取 key=value 对
+            for a_code, val in scan_attr_block(attr_part[0]):
+                a_code = a_code.strip()
+                val = val.strip()
+                if not a_code:
+                    continue
+                if a_code == "m" and self.include_mentions:
+                    mentions = [v.strip() for v in val.split("||") if v.strip()]
+                    continue
+                attr_name = rev_a.get(a_code, a_code)
+                attrs[attr_name] = val
+
+            # 恢复嵌套属性 a.b.c 恢复成嵌套字典
+            d = {}
+            for k, v in attrs.items():
+                keys = k.split(".")
+                temp = d
+                for key in keys[:-1]:
+                    temp = temp.setdefault(key, {})
+                temp[keys[-1]] = v
+            attrs = d
+
+        # 整行解析成功后才写入 kg，跳过的非法行不会留下半个实体
+        self.kg["Entity types"][entity_id_clean] = entity_type
+        if mentions is not None:
+            self.kg["Entity mentions"][entity_id_clean] = mentions
+        self.kg["Attributes"][entity_id_clean] = attrs
+        return ("entity", entity_id_clean, entity_type, attrs, mentions)
+
+
+def iter_sttl_events(chunks, maps: dict, entity_name_map: dict = None, include_mentions: bool = True):
+    """
+    对流式文本块（如 OpenAI 流式接口的 delta.content）逐个产出解析事件，事件格式见 STTLStreamParser，
+    全部产出后返回的 parser.kg 与 sttl_to_kg 相同：
+        for event in iter_sttl_events((c.choices[0].delta.content or "" for c in stream), maps): ...
+    """
+    parser = STTLStreamParser(maps, entity_name_map=entity_name_map, include_mentions=include_mentions)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+    return parser.kg
 
 
 if __name__=="__main__":
@@ -0,0 +1,820 @@
+"""
+训练热点路径的基准测试，全部在CPU上用合成的 STTL 格式数据运行:
+- tokenize: mapper_tokenize 的吞吐
+- collator: data_collator 与原实现对比 (含输出一致性校验)
+- loss: compute_loss / default_compute_loss_func / label_only / 预计算权重的加权loss (含loss与梯度一致性校验)
+- train: 随机初始化的小型 causal LM + LoRA，按 main() 的方式用 CustomTrainer 训练若干步
+- memory: estimate_training_memory 与 profiler 记录的实际分配峰值对比 (小型 Qwen2/Qwen3，超出 --memory_tolerance 时报错)
+- multi_adapter: N 个adapter依次单独训练 (每次重新加载基座) 与一次加载基座后 mixed / round_robin 多adapter训练的吞吐对比
+- shape_bucketing: 静态shape分桶的shape数和padding比例，以及分桶后 eager 与 torch.compile 训练的每步耗时、编译图数和编译耗时
+- codec: compress_schema 中 SchemaCodec 与原 convert_json_2_sttl / convert_sttl_2_json 的每个KG吞吐对比 (含输出一致性校验)
+- sttl_scanner: compress_schema / schema_format 中按分隔符切分的逐行解析与原正则解析的每行吞吐对比
+  (随机变异输入上的差分校验在 tests/test_sttl_parsers.py)
+- code_assignment: build_schema_maps 按 tokenizer 分配代码与按字母分配在留出KG上的字符/token级压缩比对比
+- sttl_stream: STTLStreamParser 按token大小的文本块增量解析的吞吐与首个实体出现时间
+
+结果以JSON输出，--compare 与保存的基线对比，超出容忍度的指标视为回归并以非零状态退出:
+    python src/benchmark.py --output baseline.json
+    python src/benchmark.py --compare baseline.json --tolerance 0.1
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from functools import partial
+from types import SimpleNamespace
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from train import (
+    AdapterRouter,
+    CustomTrainer,
+    MultiAdapterDataset,
+    StepTimingCallback,
+    TokenBudgetBatchSampler,
+    _weighted_cross_entropy,
+    collate_with_adapter_ids,
+    compile_decoder_layers,
+    compiled_graph_count,
+    compute_loss,
+    data_collator,
+    default_compute_loss_func,
+    estimate_training_memory,
+    label_hidden_states,
+    label_logit_positions,
+    label_only_compute_loss_func,
+    mapper_tokenize,
+    packing_data_collator,
+    weighted_compute_loss_func,
+)
+
+# STTL 编解码工具在仓库根目录
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from compress_schema import (  # noqa: E402
+    SchemaCodec,
+    build_schema_maps,
+    convert_json_2_sttl,
+    convert_sttl_2_json,
+    schema_definition,
+)
+import schema_format  # noqa: E402
+from sttl_reference import (  # noqa: E402
+    WORDS,
+    make_kg,
+    make_schema_format_sttls,
+    reference_convert_json_2_sttl,
+    reference_convert_sttl_2_json,
+    reference_sttl_to_kg,
+    split_stream,
+)
+
+ENTITY_CODES = "ABCDEFGHI"
+ATTR_CODES = ["ai", "am", "l", "ay", "az", "at", "s", "aj", "b", "c"]
+REL_CODES = ["t", "g", "k", "q", "r"]
+
+
+def reference_data_collator(examples, eos_token_id, pad_token_id, total_max_length):
+    # 向量化之前的 data_collator 实现（逐样本建tensor + pad_sequence），作为对照基线
+    input_ids_all = []
+    labels_all = []
+    attention_mask_all = []
+    for example in examples:
+        original_input_ids = example['input_ids']
+        original_output_ids = example['labels']
+        input_ids = original_input_ids + original_output_ids + [eos_token_id]
+        labels = [-100] * len(original_input_ids) + original_output_ids + [eos_token_id]
+        attention_mask = [1] * len(input_ids)
+        input_ids_all.append(torch.tensor(input_ids, dtype=torch.long))
+        labels_all.append(torch.tensor(labels, dtype=torch.long))
+        attention_mask_all.append(torch.tensor(attention_mask, dtype=torch.long))
+    input_ids_tensor = pad_sequence(input_ids_all, batch_first=True, padding_value=pad_token_id, padding_side="left")
+    labels_tensor = pad_sequence(labels_all, batch_first=True, padding_value=-100, padding_side="left")
+    attention_mask_tensor = pad_sequence(attention_mask_all, batch_first=True, padding_value=0, padding_side="left")
+
+    max_bs_size = total_max_length // input_ids_tensor.shape[1]
+    if max_bs_size < input_ids_tensor.shape[0]:
+        if max_bs_size < 1:
+            max_bs_size = 1
+            input_ids_tensor = input_ids_tensor[:max_bs_size, :total_max_length]
+            labels_tensor = labels_tensor[:max_bs_size, :total_max_length]
+            attention_mask_tensor = attention_mask_tensor[:max_bs_size, :total_max_length]
+        else:
+            input_ids_tensor = input_ids_tensor[:max_bs_size]
+            labels_tensor = labels_tensor[:max_bs_size]
+            attention_mask_tensor = attention_mask_tensor[:max_bs_size]
+    return {
+        "input_ids": input_ids_tensor.long(),
+        "labels": labels_tensor.long(),
+        "attention_mask": attention_mask_tensor.long(),
+    }
+
+
+def make_sttl(rng, num_entities):
+    # 形如 convert_json_2_sttl 输出的文本: 实体行 name:Code|attr=value;...，#R 之后为关系行
+    def phrase(low, high):
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+    names = [phrase(1, 3).replace(" ", "_") + f"_{i}" for i in range(num_entities)]
+    lines = [
+        f"{name}:{rng.choice(ENTITY_CODES)}|" + ";".join(f"{code}={phrase(1, 4)}" for code in rng.sample(ATTR_CODES, rng.randint(1, 5)))
+        for name in names
+    ]
+    lines.append("#R")
+    lines += [f"{rng.choice(names)} {rng.choice(REL_CODES)} {rng.choice(names)}" for _ in range(rng.randint(1, num_entities))]
+    return "\n".join(lines)
+
+
+def make_sttl_records(num_records, seed=0):
+    rng = random.Random(seed)
+    return [
+        {
+            "input": " ".join(rng.choice(WORDS) for _ in range(rng.randint(100, 500))),
+            "output": make_sttl(rng, rng.randint(2, 12)),
+        }
+        for _ in range(num_records)
+    ]
+
+
+def build_tokenizer(records, vocab_size=2000):
+    # 在合成数据上训练一个小的 byte-level BPE，避免依赖下载的模型
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=["<unk>", "<|endoftext|>", "<pad>"],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet(), show_progress=False)
+    tokenizer.train_from_iterator((text for record in records for text in (record["input"], record["output"])), trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|endoftext|>", unk_token="<unk>", pad_token="<pad>")
+
+
+def tokenize_records(records, tokenizer):
+    tokenized = mapper_tokenize({"input": [r["input"] for r in records], "output": [r["output"] for r in records]}, tokenizer)
+    return [{"input_ids": i, "labels": o} for i, o in zip(tokenized["input_ids"], tokenized["labels"])]
+
+
+def time_fn(fn, repeats, rounds=5):
+    # 预热一次后分 rounds 轮计时，取最快一轮的平均值，降低机器噪声对回归对比的影响
+    fn()
+    per_round = max(1, repeats // rounds)
+    best = float("inf")
+    for _ in range(rounds if repeats >= rounds else 1):
+        start = time.perf_counter()
+        for _ in range(per_round):
+            fn()
+        best = min(best, (time.perf_counter() - start) / per_round)
+    return best
+
+
+class Results:
+    """收集指标: name -> {value, unit, higher_is_better}"""
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, value, unit, higher_is_better=False):
+        self.metrics[name] = {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+        print(f"  {name}: {value:.4f} {unit}")
+
+
+def bench_tokenize(args, ctx, results):
+    print(f"tokenize (records={len(ctx.records)}):")
+    elapsed = time_fn(lambda: tokenize_records(ctx.records, ctx.tokenizer), max(1, args.repeats // 20))
+    results.add("tokenize/mapper_tokenize_examples_per_sec", len(ctx.records) / elapsed, "examples/s", higher_is_better=True)
+
+
+def bench_collator(args, ctx, results):
+    examples = ctx.examples[:args.batch_size]
+    collate_new = partial(data_collator, examples, ctx.eos_token_id, ctx.pad_token_id, 10**9)
+    collate_ref = partial(reference_data_collator, examples, ctx.eos_token_id, ctx.pad_token_id, 10**9)
+    new_batch, ref_batch = collate_new(), collate_ref()
+    for key in ref_batch:
+        assert torch.equal(new_batch[key], ref_batch[key]), f"collator 输出不一致: {key}"
+
+    print(f"collator (shape={tuple(new_batch['input_ids'].shape)}):")
+    results.add("collator/reference_ms", time_fn(collate_ref, args.repeats) * 1e3, "ms")
+    results.add("collator/data_collator_ms", time_fn(collate_new, args.repeats) * 1e3, "ms")
+    collate_weighted = partial(data_collator, examples, ctx.eos_token_id, ctx.pad_token_id, 10**9, with_loss_weights=True)
+    results.add("collator/data_collator_with_loss_weights_ms", time_fn(collate_weighted, args.repeats) * 1e3, "ms")
+    collate_packing = partial(packing_data_collator, examples, ctx.eos_token_id, ctx.pad_token_id, 10**9)
+    results.add("collator/packing_data_collator_ms", time_fn(collate_packing, args.repeats) * 1e3, "ms")
+
+
+def bench_loss(args, ctx, results):
+    # 用随机 hidden states + lm_head 模拟模型输出，各loss实现与参考实现对比 loss/梯度，并计时 forward+backward
+    examples = ctx.examples[:args.loss_batch_size]
+    lm_head = torch.nn.Linear(args.hidden_size, args.vocab_size, bias=False)
+    repeats = max(1, args.repeats // 20)
+
+    def run(loss_fn, label_only, batch, hidden):
+        # label_only 为 "hidden" 时与 CustomTrainer(label_only_logits=True) 一样，由loss函数按chunk经过 lm_head
+        labels = batch["labels"]
+        if label_only == "hidden":
+            loss = loss_fn(SimpleNamespace(logits=hidden[:, label_logit_positions(labels)]), labels, None, lm_head=lm_head)
+        else:
+            logits = lm_head(hidden[:, label_logit_positions(labels)] if label_only else hidden)
+            loss = loss_fn(SimpleNamespace(logits=logits), labels, None)
+        loss.backward()
+        return loss
+
+    def check_and_time(name, reference, candidates, batch):
+        hidden = torch.randn(*batch["labels"].shape, args.hidden_size, requires_grad=True)
+        ref_loss = run(reference, False, batch, hidden)
+        ref_grad = hidden.grad.clone()
+        results.add(f"loss/{name}/reference_ms", time_fn(partial(run, reference, False, batch, hidden), repeats) * 1e3, "ms")
+        for candidate_name, loss_fn in candidates.items():
+            for label_only, suffix in ((True, ""), ("hidden", "_chunked_head")):
+                hidden.grad = None
+                loss = run(loss_fn, label_only, batch, hidden)
+                grad_diff = (hidden.grad - ref_grad).abs().max().item()
+                assert torch.allclose(loss, ref_loss, rtol=1e-5, atol=1e-6), \
+                    f"{candidate_name}{suffix} loss 不一致: {loss.item()} vs {ref_loss.item()}"
+                assert grad_diff < 1e-5, f"{candidate_name}{suffix} 梯度不一致: {grad_diff}"
+                results.add(f"loss/{name}/{candidate_name}{suffix}_ms",
+                            time_fn(partial(run, loss_fn, label_only, batch, hidden), repeats) * 1e3, "ms")
+
+    batch = data_collator(examples, ctx.eos_token_id, ctx.pad_token_id, 10**9)
+    print(f"loss (shape={tuple(batch['labels'].shape)}, V={args.vocab_size}):")
+    # default_compute_loss_func 为参考，对比只在label位置计算的版本
+    check_and_time("default", default_compute_loss_func, {
+        "label_only": partial(label_only_compute_loss_func, chunk_size=args.loss_chunk_size),
+    }, batch)
+
+    weighted_fns = {"eager": _weighted_cross_entropy}
+    if not args.no_compile:
+        weighted_fns["compiled"] = torch.compile(_weighted_cross_entropy, dynamic=True)
+    for collator_name, collator in (("padded", data_collator), ("packed", packing_data_collator)):
+        # 原 compute_loss 为参考，对比collator预计算权重的加权loss
+        batch = collator(examples, ctx.eos_token_id, ctx.pad_token_id, 10**9, with_loss_weights=True)
+        reference = partial(compute_loss, eos_token_id=ctx.eos_token_id, segment_ids=batch.get("segment_ids"))
+        candidates = {
+            f"weighted_{fn_name}": partial(weighted_compute_loss_func, loss_weights=batch["loss_weights"],
+                                           chunk_size=args.loss_chunk_size, cross_entropy_fn=fn)
+            for fn_name, fn in weighted_fns.items()
+        }
+        check_and_time(f"cosine_{collator_name}", reference, candidates, batch)
+
+
+def small_model_config(args, ctx):
+    # 基准中使用的随机初始化小型 Qwen2
+    from transformers import Qwen2Config
+
+    return Qwen2Config(vocab_size=len(ctx.tokenizer), hidden_size=args.hidden_size, intermediate_size=args.hidden_size * 2,
+                       num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=8192,
+                       eos_token_id=ctx.eos_token_id, pad_token_id=ctx.pad_token_id)
+
+
+def small_lora_model(args, ctx):
+    from peft import LoraConfig, get_peft_model
+    from transformers import AutoModelForCausalLM
+
+    torch.manual_seed(0)
+    model = AutoModelForCausalLM.from_config(small_model_config(args, ctx))
+    return get_peft_model(model, LoraConfig(r=8, lora_alpha=32, lora_dropout=0.05, task_type="CAUSAL_LM",
+                                            target_modules=["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"]))
+
+
+def bench_train(args, ctx, results):
+    # 按 main() 的方式组装: LoRA + CustomTrainer + data_collator + loss，随机初始化的小模型在CPU上训练若干步
+    from datasets import Dataset
+    from transformers import TrainingArguments
+
+    model = small_lora_model(args, ctx)
+    dataset = Dataset.from_list([{**e, "length": len(e["input_ids"]) + len(e["labels"]) + 1} for e in ctx.examples])
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        training_args = TrainingArguments(
+            output_dir=output_dir,
+            max_steps=args.train_steps,
+            per_device_train_batch_size=args.train_batch_size,
+            logging_steps=args.train_steps,
+            save_strategy="no",
+            eval_strategy="no",
+            report_to=[],
+            use_cpu=True,
+            gradient_checkpointing=True,
+            gradient_checkpointing_kwargs={"use_reentrant": False},
+            remove_unused_columns=False,
+            dataloader_num_workers=args.train_num_workers,
+            dataloader_prefetch_factor=args.train_prefetch_factor if args.train_num_workers > 0 else None,
+            dataloader_persistent_workers=args.train_num_workers > 0,
+            disable_tqdm=True,
+            log_level="error",
+        )
+        step_timer = StepTimingCallback(os.path.join(output_dir, "step_timing.jsonl"))
+        trainer = CustomTrainer(
+            model=model,
+            args=training_args,
+            train_dataset=dataset,
+            data_collator=partial(data_collator, eos_token_id=ctx.eos_token_id, pad_token_id=ctx.pad_token_id, total_max_length=10**9),
+            compute_loss_func=default_compute_loss_func,
+            step_timer=step_timer,
+        )
+        print(f"train (steps={args.train_steps}, batch={args.train_batch_size}, hidden={args.hidden_size}, workers={args.train_num_workers}):")
+        metrics = trainer.train().metrics
+        with open(step_timer.output_file, encoding="utf-8") as f:
+            # 跳过第一步(没有 step_time 且包含预热开销)
+            steps = [record for record in map(json.loads, f) if "tokens" in record][1:]
+    results.add("train/steps_per_sec", metrics["train_steps_per_second"], "steps/s", higher_is_better=True)
+    results.add("train/tokens_per_sec", sum(s["tokens"] for s in steps) / sum(s["step_time"] for s in steps), "tokens/s", higher_is_better=True)
+    for phase in ("data_wait", "forward", "backward", "optimizer"):
+        results.add(f"train/{phase}_ms", sum(s[phase] for s in steps) / len(steps) * 1e3, "ms")
+
+
+def measure_peak_memory(fn):
+    # profiler 的内存事件按时间排序累加，得到 fn 执行期间新分配内存的峰值 (CPU 上没有 max_memory_allocated)
+    from torch.profiler import ProfilerActivity, profile
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    events = sorted(
+        (event.time_range.start, event.cpu_memory_usage if event.name == "[memory]" else event.self_cpu_memory_usage)
+        for event in prof.events()
+    )
+    live = peak = 0
+    for _, delta in events:
+        live += delta
+        peak = max(peak, live)
+    return peak
+
+
+def bench_memory(args, ctx, results):
+    # 一个训练step (forward + backward) 的激活和LoRA梯度峰值，与估算值对比；权重在计时前已分配，不计入
+    from peft import LoraConfig, get_peft_model
+    from transformers import AutoModelForCausalLM, Qwen2Config, Qwen3Config
+
+    targets = ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"]
+    cases = {
+        # name: (config类, dtype, gradient_checkpointing, lora_dropout, label_only, 行数, 长度)
+        "qwen2_ckpt": (Qwen2Config, torch.float32, True, 0.05, False, 2, 512),
+        "qwen3_ckpt": (Qwen3Config, torch.float32, True, 0.05, False, 2, 512),
+        "qwen3_no_ckpt": (Qwen3Config, torch.float32, False, 0.05, False, 2, 512),
+        "qwen3_bf16": (Qwen3Config, torch.bfloat16, True, 0.05, False, 2, 512),
+        "qwen3_label_only": (Qwen3Config, torch.float32, True, 0.05, True, 2, 1024),
+    }
+    print(f"memory (tolerance={args.memory_tolerance:.0%}):")
+    failures = []
+    for name, (config_class, dtype, gradient_checkpointing, lora_dropout, label_only, rows, seq_len) in cases.items():
+        torch.manual_seed(0)
+        config = config_class(hidden_size=256, intermediate_size=704, num_hidden_layers=4, num_attention_heads=4,
+                              num_key_value_heads=2, vocab_size=2000, max_position_embeddings=8192, tie_word_embeddings=False)
+        config._attn_implementation = "sdpa"
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype)
+        model.config.use_cache = False
+        model = get_peft_model(model, LoraConfig(r=8, lora_alpha=16, lora_dropout=lora_dropout, target_modules=targets, task_type="CAUSAL_LM"))
+        model.train()
+        if gradient_checkpointing:
+            model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+            model.enable_input_require_grads()
+        input_ids = torch.randint(0, config.vocab_size, (rows, seq_len))
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[0, : seq_len // 4] = 0
+        labels = input_ids.clone()
+        labels[:, : seq_len // 2] = -100
+
+        def step():
+            if label_only:
+                with label_hidden_states(model) as lm_head:
+                    outputs = model(input_ids=input_ids, attention_mask=attention_mask, logits_to_keep=label_logit_positions(labels))
+                loss = label_only_compute_loss_func(outputs, labels, None, chunk_size=args.loss_chunk_size, lm_head=lm_head)
+            else:
+                outputs = model(input_ids=input_ids, attention_mask=attention_mask)
+                loss = default_compute_loss_func(outputs, labels, None)
+            del outputs
+            loss.backward()
+
+        # 预热一次分配好梯度，再清空梯度后测量
+        step()
+        model.zero_grad(set_to_none=True)
+        measured = measure_peak_memory(step)
+        num_trainable, num_params = model.get_nb_trainable_parameters()
+        estimate = estimate_training_memory(
+            config, rows * seq_len, num_params, num_trainable, 8, targets, lora_dropout=lora_dropout,
+            dtype_bytes=dtype.itemsize, lora_dtype_bytes=4, gradient_checkpointing=gradient_checkpointing,
+            label_only_loss=label_only, logit_fraction=0.5 if label_only else 1.0,
+            loss_chunk_size=rows * args.loss_chunk_size, max_seq_len=seq_len, optimizer_offload=True,
+        )
+        ratio = (estimate["activations"] + estimate["lora"]) / measured
+        results.add(f"memory/{name}/measured_mib", measured / 2**20, "MiB")
+        results.add(f"memory/{name}/estimate_ratio", ratio, "x")
+        if abs(ratio - 1) > args.memory_tolerance:
+            failures.append(f"{name}: {ratio:.3f}")
+    assert not failures, f"显存估算偏差超过 {args.memory_tolerance:.0%}: {', '.join(failures)}"
+
+
+def train_adapters(args, ctx, model_dir, adapter_datasets, routing=None):
+    """
+    从磁盘加载基座并挂载 len(adapter_datasets) 个adapter，训练一个epoch，返回训练耗时 (不含加载)。
+    routing 为 None 时只有一个adapter，按 main() 的单adapter方式训练；mixed 每步的样本数为单adapter的 N 倍。
+    """
+    from peft import LoraConfig, get_peft_model
+    from transformers import AutoModelForCausalLM, TrainingArguments
+
+    torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    model = AutoModelForCausalLM.from_pretrained(model_dir)
+    model.config.use_cache = False
+    names = [f"adapter_{i}" for i in range(len(adapter_datasets))]
+    lora_config = LoraConfig(r=8, lora_alpha=32, lora_dropout=0.05, task_type="CAUSAL_LM",
+                             target_modules=["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"])
+    model = get_peft_model(model, lora_config, adapter_name=names[0])
+    for name in names[1:]:
+        model.add_adapter(name, lora_config)
+    for name, param in model.named_parameters():
+        if "lora_" in name:
+            param.requires_grad = True
+    collate_fn = partial(data_collator, eos_token_id=ctx.eos_token_id, pad_token_id=ctx.pad_token_id, total_max_length=10**9)
+    router, dataset = None, adapter_datasets[0]
+    if routing is not None:
+        router = AdapterRouter(model, names)
+        dataset = MultiAdapterDataset(adapter_datasets)
+        collate_fn = partial(collate_with_adapter_ids, collate_fn=collate_fn)
+    with tempfile.TemporaryDirectory() as output_dir:
+        training_args = TrainingArguments(
+            output_dir=output_dir,
+            num_train_epochs=1,
+            per_device_train_batch_size=args.train_batch_size * len(adapter_datasets) if routing == "mixed" else args.train_batch_size,
+            save_strategy="no",
+            eval_strategy="no",
+            report_to=[],
+            use_cpu=True,
+            gradient_checkpointing=True,
+            gradient_checkpointing_kwargs={"use_reentrant": False},
+            remove_unused_columns=False,
+            disable_tqdm=True,
+            log_level="error",
+        )
+        trainer = CustomTrainer(
+            model=model,
+            args=training_args,
+            train_dataset=dataset,
+            data_collator=collate_fn,
+            compute_loss_func=default_compute_loss_func,
+            total_max_length=10**9,
+            # 按长度分桶，避免 mixed 的batch更大、padding更多而影响对比
+            group_by_length=True,
+            megabatch_size=50 * training_args.per_device_train_batch_size,
+            adapter_router=router,
+            adapter_routing=routing or "mixed",
+        )
+        return trainer.train().metrics["train_runtime"]
+
+
+def run_in_new_process(fn, *args):
+    """在新启动的进程中运行 fn，返回 (包括进程启动、导入依赖在内的总耗时, fn 的返回值)，与单独启动一次训练任务相同"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        result = executor.submit(fn, *args).result()
+    return time.perf_counter() - start, result
+
+
+def bench_multi_adapter(args, ctx, results):
+    # 工作量相同: 每个adapter都在自己的 train_steps×batch 条样本上训练一个epoch，
+    # 依次单独训练时每步 batch 条，mixed 每步 N×batch 条，round_robin 每步一个adapter的 batch 条
+    from datasets import Dataset
+    from transformers import AutoModelForCausalLM
+
+    num_adapters = args.num_adapters
+    examples_per_adapter = args.train_steps * args.train_batch_size
+    assert examples_per_adapter * num_adapters <= len(ctx.examples), "合成样本数不足，增大 --num_records"
+    adapter_datasets = [
+        Dataset.from_list([{**e, "length": len(e["input_ids"]) + len(e["labels"]) + 1}
+                           for e in ctx.examples[i * examples_per_adapter:(i + 1) * examples_per_adapter]])
+        for i in range(num_adapters)
+    ]
+    torch.manual_seed(0)
+    config = small_model_config(args, ctx)
+    print(f"multi_adapter (adapters={num_adapters}, examples/adapter={examples_per_adapter}, hidden={args.hidden_size}):")
+    # 每次训练都在新进程中进行: 依次单独训练时每个adapter都要重新启动、导入依赖并加载基座
+    job_ctx = SimpleNamespace(eos_token_id=ctx.eos_token_id, pad_token_id=ctx.pad_token_id)
+    with tempfile.TemporaryDirectory() as model_dir:
+        AutoModelForCausalLM.from_config(config).save_pretrained(model_dir)
+        runs = {
+            "sequential": [run_in_new_process(train_adapters, args, job_ctx, model_dir, [dataset]) for dataset in adapter_datasets],
+            "mixed": [run_in_new_process(train_adapters, args, job_ctx, model_dir, adapter_datasets, "mixed")],
+            "round_robin": [run_in_new_process(train_adapters, args, job_ctx, model_dir, adapter_datasets, "round_robin")],
+        }
+    elapsed = {name: sum(total for total, _ in jobs) for name, jobs in runs.items()}
+    for name, jobs in runs.items():
+        results.add(f"multi_adapter/{name}_examples_per_sec_per_adapter", examples_per_adapter / elapsed[name], "examples/s",
+                    higher_is_better=True)
+        results.add(f"multi_adapter/{name}_train_examples_per_sec_per_adapter",
+                    examples_per_adapter / sum(train_time for _, train_time in jobs), "examples/s", higher_is_better=True)
+    results.add("multi_adapter/mixed_speedup", elapsed["sequential"] / elapsed["mixed"], "x", higher_is_better=True)
+
+
+def train_shape_buckets(args, ctx, dataset, total_max_length, bucket_size, compile_model=False):
+    """按token预算和静态shape分桶训练 train_steps 步 (与 main() 的 --shape_bucket_size / --compile_model 相同)，返回每步的计时记录"""
+    from transformers import TrainingArguments
+
+    model = small_lora_model(args, ctx)
+    # 与 main() 相同，否则第一层的输入不需要梯度，编译出的图与其余层不同
+    model.enable_input_require_grads()
+    compute_loss_func = default_compute_loss_func
+    if compile_model:
+        compile_decoder_layers(model, -(-total_max_length // bucket_size))
+        compute_loss_func = torch.compile(default_compute_loss_func, dynamic=False)
+    with tempfile.TemporaryDirectory() as output_dir:
+        training_args = TrainingArguments(
+            output_dir=output_dir,
+            max_steps=args.train_steps,
+            per_device_train_batch_size=args.train_batch_size,
+            logging_steps=args.train_steps,
+            save_strategy="no",
+            eval_strategy="no",
+            report_to=[],
+            use_cpu=True,
+            gradient_checkpointing=True,
+            gradient_checkpointing_kwargs={"use_reentrant": False},
+            remove_unused_columns=False,
+            disable_tqdm=True,
+            log_level="error",
+        )
+        step_timer = StepTimingCallback(os.path.join(output_dir, "step_timing.jsonl"), shape_summary=True,
+                                        count_graphs=compile_model)
+        trainer = CustomTrainer(
+            model=model,
+            args=training_args,
+            train_dataset=dataset,
+            data_collator=partial(data_collator, eos_token_id=ctx.eos_token_id, pad_token_id=ctx.pad_token_id,
+                                  total_max_length=total_max_length, shape_bucket_size=bucket_size),
+            compute_loss_func=compute_loss_func,
+            total_max_length=total_max_length,
+            token_budget_batching=True,
+            group_by_length=True,
+            megabatch_size=50 * args.train_batch_size,
+            step_timer=step_timer,
+            shape_bucket_size=bucket_size,
+        )
+        trainer.train()
+        with open(step_timer.output_file, encoding="utf-8") as f:
+            return [record for record in map(json.loads, f) if "tokens" in record]
+
+
+def bench_shape_bucketing(args, ctx, results):
+    # 不同桶大小下一个epoch的batch shape数和padding比例；再按 --shape_bucket_size 分桶训练，对比 eager 和 torch.compile
+    from datasets import Dataset
+
+    lengths = [len(e["input_ids"]) + len(e["labels"]) + 1 for e in ctx.examples]
+    total_max_length = args.train_batch_size * max(lengths)
+    print(f"shape_bucketing (token budget={total_max_length}, bucket={args.shape_bucket_size}):")
+    for bucket_size in sorted({0, 64, 128, args.shape_bucket_size}):
+        sampler = TokenBudgetBatchSampler(lengths, total_max_length, shuffle=True, group_by_length=True,
+                                          megabatch_size=50 * args.train_batch_size, shape_bucket_size=bucket_size)
+        shapes, real_tokens, padded_tokens = set(), 0, 0
+        for batch_indices in sampler.epoch_batches(0):
+            batch = data_collator([ctx.examples[i] for i in batch_indices], ctx.eos_token_id, ctx.pad_token_id, total_max_length,
+                                  shape_bucket_size=bucket_size)
+            shapes.add(tuple(batch["input_ids"].shape))
+            real_tokens += int(batch["attention_mask"].sum())
+            padded_tokens += batch["input_ids"].numel()
+        name = f"bucket_{bucket_size}" if bucket_size else "no_bucket"
+        results.add(f"shape_bucketing/{name}_num_shapes", len(shapes), "shapes")
+        results.add(f"shape_bucketing/{name}_padding_fraction", 1 - real_tokens / padded_tokens, "ratio")
+
+    dataset = Dataset.from_list([{**e, "length": length} for e, length in zip(ctx.examples, lengths)])
+    variants = {"eager": False} if args.no_compile else {"eager": False, "compiled": True}
+    for name, compile_model in variants.items():
+        graphs_before = compiled_graph_count()
+        steps = train_shape_buckets(args, ctx, dataset, total_max_length, args.shape_bucket_size, compile_model=compile_model)
+        # 不含编译的步才计入每步耗时；编译耗时为含编译的步比其余步平均多出的时间之和
+        timed = [s["forward"] + s["backward"] for s in steps if not s["graphs_compiled"]]
+        step_time = sum(timed) / len(timed)
+        results.add(f"shape_bucketing/{name}_step_ms", step_time * 1e3, "ms")
+        if compile_model:
+            compile_steps = [s["forward"] + s["backward"] for s in steps if s["graphs_compiled"]]
+            results.add(f"shape_bucketing/{name}_graphs", compiled_graph_count() - graphs_before, "graphs")
+            results.add(f"shape_bucketing/{name}_compile_s", sum(compile_steps) - step_time * len(compile_steps), "s")
+
+
+def bench_codec(args, ctx, results):
+    # 每个KG的编解码吞吐: 原实现 (传入 maps / 只传 schema_json)、兼容接口 convert_*、复用的 SchemaCodec 批量接口
+    rng = random.Random(0)
+    kgs = [make_kg(rng, schema_definition, rng.randint(2, 12)) for _ in range(args.num_records)]
+    maps = build_schema_maps(schema_definition)
+    codec = SchemaCodec.from_schema(schema_definition)
+    sttls = codec.encode_many(kgs)
+    for kg, sttl in zip(kgs, sttls):
+        assert sttl == reference_convert_json_2_sttl(kg, maps=maps), "encode 输出不一致"
+        assert codec.encode(kg, calc_ratio=True) == reference_convert_json_2_sttl(kg, maps=maps, calc_ratio=True), "压缩比统计不一致"
+        assert convert_json_2_sttl(kg, schema_json=schema_definition) == sttl, "convert_json_2_sttl 输出不一致"
+    restored = codec.decode_many(sttls)
+    for sttl, kg in zip(sttls, restored):
+        assert kg == reference_convert_sttl_2_json(sttl, maps=maps), "decode 输出不一致"
+        assert convert_sttl_2_json(sttl, maps=maps) == kg, "convert_sttl_2_json 输出不一致"
+
+    print(f"codec (kgs={len(kgs)}):")
+    repeats = max(1, args.repeats // 20)
+    variants = {
+        "encode": {
+            "reference_schema_json": lambda: [reference_convert_json_2_sttl(kg, schema_json=schema_definition) for kg in kgs],
+            "reference_maps": lambda: [reference_convert_json_2_sttl(kg, maps=maps) for kg in kgs],
+            "convert_maps": lambda: [convert_json_2_sttl(kg, maps=maps) for kg in kgs],
+            "codec_many": lambda: codec.encode_many(kgs),
+        },
+        "decode": {
+            "reference_schema_json": lambda: [reference_convert_sttl_2_json(sttl, schema_json=schema_definition) for sttl in sttls],
+            "reference_maps": lambda: [reference_convert_sttl_2_json(sttl, maps=maps) for sttl in sttls],
+            "convert_maps": lambda: [convert_sttl_2_json(sttl, maps=maps) for sttl in sttls],
+            "codec_many": lambda: codec.decode_many(sttls),
+        },
+    }
+    for direction, fns in variants.items():
+        for name, fn in fns.items():
+            results.add(f"codec/{direction}_{name}_kg_per_sec", len(kgs) / time_fn(fn, repeats), "kg/s", higher_is_better=True)
+
+
+def bench_sttl_scanner(args, ctx, results):
+    # compress_schema (SchemaCodec.decode) 与 schema_format (sttl_to_kg) 的逐行解析与原正则解析的每行吞吐；
+    # 与原实现的差分校验在 tests/test_sttl_parsers.py
+    rng = random.Random(0)
+    maps = build_schema_maps(schema_definition)
+    codec = SchemaCodec.from_schema(schema_definition)
+    sf_maps = schema_format.maps
+
+    kgs = [make_kg(rng, schema_definition, rng.randint(2, 12)) for _ in range(args.num_records)]
+    sttls = codec.encode_many(kgs)
+    sf_sttls = make_schema_format_sttls(rng, kgs, sf_maps)
+
+    num_lines = sum(t.count("\n") + 1 for t in sttls)
+    sf_num_lines = sum(t.count("\n") + 1 for t in sf_sttls)
+    print(f"sttl_scanner (kgs={len(kgs)}, lines={num_lines}):")
+    regex_codec = SchemaCodec(dict(maps))
+    regex_codec.scan_attrs = False
+    repeats = max(1, args.repeats // 20)
+    variants = {
+        "compress_regex": (num_lines, lambda: regex_codec.decode_many(sttls)),
+        "compress_scanner": (num_lines, lambda: codec.decode_many(sttls)),
+        "schema_format_reference": (sf_num_lines, lambda: [reference_sttl_to_kg(t, sf_maps) for t in sf_sttls]),
+        "schema_format_scanner": (sf_num_lines, lambda: [schema_format.sttl_to_kg(t, sf_maps) for t in sf_sttls]),
+    }
+    for name, (lines, fn) in variants.items():
+        results.add(f"sttl_scanner/{name}_lines_per_sec", lines / time_fn(fn, repeats), "lines/s", higher_is_better=True)
+
+
+def bench_sttl_stream(args, ctx, results):
+    # STTLStreamParser: 整段解析与按token大小增量解析的吞吐；首个实体在输出中出现的位置 (与 sttl_to_kg 的一致性校验在 tests/)
+    rng = random.Random(0)
+    sf_maps = schema_format.maps
+    kgs = [make_kg(rng, schema_definition, rng.randint(2, 12)) for _ in range(args.num_records)]
+    texts = make_schema_format_sttls(rng, kgs, sf_maps)
+
+    def stream_parse(text, chunks, **kwargs):
+        parser = schema_format.STTLStreamParser(sf_maps, **kwargs)
+        events = []
+        for chunk in chunks:
+            events += parser.feed(chunk)
+        events += parser.close()
+        return parser, events
+
+    chunked = [split_stream(rng, text, 2, 6) for text in texts]
+    num_chars = sum(len(text) for text in texts)
+    repeats = max(1, args.repeats // 20)
+    print(f"sttl_stream (texts={len(texts)}, chars={num_chars}, chunks={sum(map(len, chunked))}):")
+    batch_time = time_fn(lambda: [schema_format.sttl_to_kg(text, sf_maps) for text in texts], repeats)
+    stream_time = time_fn(lambda: [stream_parse(text, chunks) for text, chunks in zip(texts, chunked)], repeats)
+    results.add("sttl_stream/batch_chars_per_sec", num_chars / batch_time, "chars/s", higher_is_better=True)
+    results.add("sttl_stream/stream_chars_per_sec", num_chars / stream_time, "chars/s", higher_is_better=True)
+
+    # 生成耗时按 --stream_tokens_per_sec 模拟 (一块一个token)，解析耗时实测
+    fractions, first_ms, full_ms = [], [], []
+    for text, chunks in zip(texts, chunked):
+        parser = schema_format.STTLStreamParser(sf_maps)
+        for i, chunk in enumerate(chunks):
+            if parser.feed(chunk) and parser.chars_to_first_entity is not None:
+                break
+        fractions.append(parser.chars_to_first_entity / len(text))
+        first_ms.append((i + 1) / args.stream_tokens_per_sec * 1000 + parser.time_to_first_entity * 1000)
+        full_ms.append(len(chunks) / args.stream_tokens_per_sec * 1000)
+    results.add("sttl_stream/first_entity_output_fraction", sum(fractions) / len(fractions), "ratio")
+    results.add("sttl_stream/time_to_first_entity_ms", sum(first_ms) / len(first_ms), "ms")
+    results.add("sttl_stream/time_to_full_output_ms", sum(full_ms) / len(full_ms), "ms")
+
+
+def bench_code_assignment(args, ctx, results):
+    # 前一半KG作为样本按 ctx.tokenizer 分配代码，在后一半上比较两种 maps 的压缩比；只比较 schema 内的关系，
+    # schema 外的关系按首字母兜底编码，换一套代码后会解析成别的关系
+    rng = random.Random(0)
+    kgs = [make_kg(rng, schema_definition, rng.randint(2, 12)) for _ in range(args.num_records)]
+    default_maps = build_schema_maps(schema_definition)
+    relations = set(default_maps["relation_map"])
+    for kg in kgs:
+        kg["Triples"] = [t for t in kg["Triples"] if t[1] in relations]
+    sample, held_out = kgs[:len(kgs) // 2], kgs[len(kgs) // 2:]
+
+    start = time.perf_counter()
+    token_maps = build_schema_maps(schema_definition, tokenizer=ctx.tokenizer, sample_kgs=sample)
+    build_seconds = time.perf_counter() - start
+    default_codec, token_codec = SchemaCodec(default_maps), SchemaCodec(token_maps)
+    assert token_codec.scan_attrs, "按token分配的属性代码应能由 scan_attr_block 解析"
+    for kg in held_out:
+        assert token_codec.decode(token_codec.encode(kg)) == default_codec.decode(default_codec.encode(kg)), "换代码后解析结果不一致"
+
+    print(f"code_assignment (sample_kgs={len(sample)}, held_out_kgs={len(held_out)}):")
+    results.add("code_assignment/build_seconds", build_seconds, "s")
+    for name, codec in (("alphabetical", default_codec), ("token_aware", token_codec)):
+        stats = codec.compression_stats(held_out, tokenizer=ctx.tokenizer)
+        results.add(f"code_assignment/{name}_compression_ratio", stats["compression_ratio"], "ratio")
+        results.add(f"code_assignment/{name}_token_compression_ratio", stats["token_compression_ratio"], "ratio")
+        results.add(f"code_assignment/{name}_sttl_tokens_per_kg", stats["sttl_tokens"] / len(held_out), "tokens")
+
+
+BENCHMARKS = {
+    "tokenize": bench_tokenize,
+    "collator": bench_collator,
+    "loss": bench_loss,
+    "train": bench_train,
+    "memory": bench_memory,
+    "multi_adapter": bench_multi_adapter,
+    "shape_bucketing": bench_shape_bucketing,
+    "codec": bench_codec,
+    "sttl_scanner": bench_sttl_scanner,
+    "sttl_stream": bench_sttl_stream,
+    "code_assignment": bench_code_assignment,
+}
+
+
+def compare(current, baseline, tolerance):
+    """返回回归的指标列表: 越小越好的指标变大超过 tolerance，或越大越好的指标变小超过 tolerance"""
+    regressions = []
+    print(f"\n与基线对比 (容忍度 {tolerance:.0%}):")
+    for name, metric in current.items():
+        if name not in baseline:
+            continue
+        base, value = baseline[name]["value"], metric["value"]
+        change = (value - base) / base if base else 0.0
+        regressed = (-change if metric["higher_is_better"] else change) > tolerance
+        if regressed:
+            regressions.append(name)
+        print(f"  [{'回归' if regressed else '正常'}] {name}: {base:.4f} -> {value:.4f} {metric['unit']} ({change:+.1%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", type=str, default=None, help=f"逗号分隔，只运行部分基准: {','.join(BENCHMARKS)}")
+    parser.add_argument("--output", type=str, default=None, help="结果JSON的保存路径，不指定则只打印")
+    parser.add_argument("--compare", type=str, default=None, help="基线JSON路径，对比并在回归时以非零状态退出")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="允许的相对性能下降")
+    parser.add_argument("--num_records", type=int, default=512, help="合成STTL样本数")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=100)
+    parser.add_argument("--hidden_size", type=int, default=128)
+    parser.add_argument("--vocab_size", type=int, default=32000, help="loss基准中 lm_head 的词表大小")
+    parser.add_argument("--loss_batch_size", type=int, default=4, help="loss基准的batch大小，完整logits为 B×T×V 的float32")
+    parser.add_argument("--loss_chunk_size", type=int, default=512)
+    parser.add_argument("--no_compile", action="store_true", help="loss基准中跳过 torch.compile")
+    parser.add_argument("--train_steps", type=int, default=20)
+    parser.add_argument("--train_batch_size", type=int, default=4)
+    parser.add_argument("--train_num_workers", type=int, default=0, help="train基准的 dataloader worker 数")
+    parser.add_argument("--train_prefetch_factor", type=int, default=4)
+    parser.add_argument("--num_threads", type=int, default=1)
+    parser.add_argument("--memory_tolerance", type=float, default=0.15, help="memory基准中估算值与实测值允许的相对偏差")
+    parser.add_argument("--num_adapters", type=int, default=3, help="multi_adapter基准的adapter数")
+    parser.add_argument("--shape_bucket_size", type=int, default=128, help="shape_bucketing基准中训练时的桶大小")
+    parser.add_argument("--stream_tokens_per_sec", type=float, default=50.0, help="sttl_stream基准中模拟的生成速度")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.num_threads)
+    records = make_sttl_records(args.num_records)
+    tokenizer = build_tokenizer(records)
+    examples = tokenize_records(records, tokenizer)
+    assert args.vocab_size >= len(tokenizer), "vocab_size 不能小于合成tokenizer的词表大小"
+    ctx = SimpleNamespace(records=records, tokenizer=tokenizer, examples=examples,
+                          eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id)
+
+    results = Results()
+    for name in (args.only.split(",") if args.only else BENCHMARKS):
+        BENCHMARKS[name](args, ctx, results)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "args": vars(args),
+        },
+        "metrics": results.metrics,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"结果已保存到 {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["metrics"]
+        regressions = compare(results.metrics, baseline, args.tolerance)
+        if regressions:
+            print(f"发现 {len(regressions)} 项性能回归: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
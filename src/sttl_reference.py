@@ -0,0 +1,202 @@
+"""
+STTL 编解码的对照实现和随机语料，不依赖 torch，供 src/benchmark.py 的吞吐对比和 tests/ 的差分校验共用:
+- reference_*: SchemaCodec / scan_attr_block 之前基于正则的原实现
+- make_kg / make_schema_format_sttls: 符合 schema 的随机KG及其 schema_format 编码
+- split_stream: 模拟模型流式输出的文本块切分
+"""
+import json
+import os
+import re
+import sys
+
+# STTL 编解码工具在仓库根目录
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from compress_schema import build_schema_maps, flatten_dict, simplify_name  # noqa: E402
+import schema_format  # noqa: E402
+
+WORDS = ("person scene object action event speech man woman dog car street red blue big small walking "
+         "talking holding wearing standing sitting near behind award stage crowd light camera").split()
+
+
+def reference_convert_json_2_sttl(kg, maps=None, schema_json=None, calc_ratio=False):
+    # SchemaCodec 之前的 convert_json_2_sttl，作为对照基线
+    if maps is None:
+        maps = build_schema_maps(schema_json)
+    Emap, Amap, Rmap = maps["entity_map"], maps["attr_map"], maps["relation_map"]
+
+    lines = []
+    ent_types = kg.get("Entity_types", {})
+    attrs = kg.get("Attributes", {})
+    triples = kg.get("Triples", [])
+    for ent, typ in ent_types.items():
+        typ_code = Emap.get(typ, "_")
+        eid = simplify_name(ent)
+        flat_attrs = flatten_dict(attrs.get(ent, {}))
+        attr_strs = []
+        for k, v in flat_attrs.items():
+            if k not in Amap:
+                continue
+            attr_strs.append(f"{Amap[k]}={v}")
+        joined = ";".join(attr_strs)
+        lines.append(f"{eid}:{typ_code}" + (f"|{joined}" if joined else ""))
+    if triples:
+        lines.append("#R")
+        for s, r, o in triples:
+            lines.append(f"{simplify_name(s)} {Rmap.get(r, r[0].lower())} {simplify_name(o)}")
+    sttl_str = "\n".join(lines)
+    if not calc_ratio:
+        return sttl_str
+    json_len = len(json.dumps(kg, separators=(",", ":")))
+    ratio = len(sttl_str) / json_len if json_len else 0
+    return sttl_str, {"json_length": json_len, "sttl_length": len(sttl_str), "compression_ratio": round(ratio, 3),
+                      "reduction_percent": round((1 - ratio) * 100, 1)}
+
+
+def reference_convert_sttl_2_json(sttl_text, maps=None, schema_json=None):
+    # SchemaCodec 之前的 convert_sttl_2_json: 每次调用都重建反向映射，正则以字符串传给 re.findall
+    if maps is None:
+        maps = build_schema_maps(schema_json)
+    Emap, Amap, Rmap = maps["entity_map"], maps["attr_map"], maps["relation_map"]
+    attr_regex_pattern = maps["attr_regex_pattern"]
+    rev_E = {v: k for k, v in Emap.items()}
+    rev_A = {v: k for k, v in Amap.items()}
+    rev_R = {v: k for k, v in Rmap.items()}
+
+    kg = {"Triples": [], "Entity_types": {}, "Attributes": {}}
+    lines = [l.strip() for l in sttl_text.splitlines() if l.strip()]
+    mode = "entity"
+    for line in lines:
+        if line.startswith("#R"):
+            mode = "rel"
+            continue
+        if mode == "entity":
+            if ":" not in line:
+                continue
+            ent_part, rest = line.split(":", 1)
+            ent_name = ent_part.replace("_", " ").strip()
+            if "|" in rest:
+                type_code, attr_part = rest.split("|", 1)
+            else:
+                type_code, attr_part = rest, ""
+            ent_type = rev_E.get(type_code.strip(), "Unknown")
+            attrs = {}
+            if attr_part:
+                if not attr_part.endswith(';'):
+                    attr_part = attr_part + ';'
+                for k, v in re.findall(attr_regex_pattern, attr_part):
+                    key_name = rev_A.get(k, None)
+                    if key_name:
+                        attrs[key_name] = v
+            kg["Entity_types"][ent_name] = ent_type
+            kg["Attributes"][ent_name] = attrs
+        elif mode == "rel":
+            if not line or len(line.split()) < 3:
+                continue
+            s, r, o = line.split(maxsplit=2)
+            kg["Triples"].append([s.replace("_", " "), rev_R.get(r, r), o.replace("_", " ")])
+    return kg
+
+
+def reference_sttl_to_kg(sttl_str, maps, entity_name_map=None, include_mentions=True):
+    # scan_attr_block 之前的 schema_format.sttl_to_kg: 每次调用重建反向映射，属性块用 re.finditer 解析
+    Emap, Amap, Rmap = maps["entity_map"], maps["attr_map"], maps["relation_map"]
+    rev_e = {v: k for k, v in Emap.items()}
+    rev_a = {v: k for k, v in Amap.items()}
+    rev_r = {v: k for k, v in Rmap.items()}
+    kg = {"Entity types": {}, "Attributes": {}, "Triples": []}
+    if include_mentions:
+        kg["Entity mentions"] = {}
+    parsing_triples = False
+    for raw_line in sttl_str.strip().splitlines():
+        line = raw_line.strip()
+        if not line:
+            continue
+        if line == "#R":
+            parsing_triples = True
+            continue
+        if parsing_triples:
+            parts = line.split()
+            if len(parts) == 3:
+                s, r_code, o = parts
+                rel_name = rev_r.get(r_code, r_code)
+                if entity_name_map:
+                    s_name = entity_name_map.get(s, s.replace("_", " "))
+                    o_name = entity_name_map.get(o, o.replace("_", " "))
+                else:
+                    s_name, o_name = s.replace("_", " "), o.replace("_", " ")
+                kg["Triples"].append([s_name, rel_name, o_name])
+            continue
+        if ":" in line:
+            entity_part, *attr_part = line.split("|", 1)
+            entity_id, typ_code = entity_part.split(":", 1)
+            entity_type = rev_e.get(typ_code, typ_code)
+            if entity_name_map:
+                entity_id_clean = entity_name_map.get(entity_id, entity_id.replace("_", " "))
+            else:
+                entity_id_clean = entity_id.replace("_", " ")
+            kg["Entity types"][entity_id_clean] = entity_type
+            attrs = {}
+            if attr_part:
+                for m in re.finditer(r'([^\=;]+)=([^;]*)', attr_part[0]):
+                    a_code = m.group(1).strip()
+                    val = m.group(2).strip()
+                    if not a_code:
+                        continue
+                    if a_code == "m" and include_mentions:
+                        kg["Entity mentions"][entity_id_clean] = [v.strip() for v in val.split("||") if v.strip()]
+                        continue
+                    attrs[rev_a.get(a_code, a_code)] = val
+                d = {}
+                for k, v in attrs.items():
+                    keys = k.split(".")
+                    temp = d
+                    for key in keys[:-1]:
+                        temp = temp.setdefault(key, {})
+                    temp[keys[-1]] = v
+                attrs = d
+            kg["Attributes"][entity_id_clean] = attrs
+    return kg
+
+
+def make_kg(rng, schema_json, num_entities):
+    # 符合 schema 的随机KG (Entity_types / Attributes / Triples)，含嵌套属性、schema之外的属性和关系
+    def phrase(low, high):
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+    entity_types = schema_json["Schema"]["EntityTypes"]
+    relations = sorted({rel for rels in schema_json["Schema"]["RelationTypes"].values() for rel in rels if isinstance(rel, str)})
+    kg = {"Triples": [], "Entity_types": {}, "Attributes": {}}
+    names = [f"{phrase(1, 3)}'s {i}" if rng.random() < 0.2 else f"{phrase(1, 3)} {i}" for i in range(num_entities)]
+    for name in names:
+        etype = rng.choice(list(entity_types))
+        attrs = {}
+        for attr, value in entity_types[etype]["attributes"].items():
+            if rng.random() < 0.5:
+                continue
+            attrs[attr] = {sub: phrase(1, 3) for sub in value if rng.random() < 0.5} if isinstance(value, dict) else phrase(1, 5)
+        if rng.random() < 0.1:
+            attrs["Unknown"] = phrase(1, 2)
+        kg["Entity_types"][name] = etype
+        kg["Attributes"][name] = attrs
+    kg["Triples"] = [[rng.choice(names), rng.choice(relations + ["declined"]), rng.choice(names)] for _ in range(rng.randint(1, num_entities))]
+    return kg
+
+
+def make_schema_format_sttls(rng, kgs, maps):
+    # make_kg 的KG转成 schema_format 的键名 (Entity types)，加上 Entity mentions 后用 jsonTosttl 编码
+    sttls = []
+    for kg in kgs:
+        sf_kg = {"Triples": kg["Triples"], "Entity types": kg["Entity_types"], "Attributes": kg["Attributes"]}
+        sf_kg["Entity mentions"] = {name: [name, f"the {name}"] for name in kg["Entity_types"] if rng.random() < 0.7}
+        sttls.append(schema_format.jsonTosttl(sf_kg, maps))
+    return sttls
+
+
+def split_stream(rng, text, low, high):
+    # 模拟模型的流式输出: 每块 low~high 个字符，约等于一个token
+    chunks, pos = [], 0
+    while pos < len(text):
+        step = rng.randint(low, high)
+        chunks.append(text[pos:pos + step])
+        pos += step
+    return chunks
@@ -1,89 +1,593 @@
 import os
+import time
+
+# 进程启动时间，用于统计启动各阶段耗时 (time-to-first-step)
+_START_TIME = time.perf_counter()
+
+# 参数解析只依赖标准库，作为入口运行时在导入 torch / transformers 之前完成；
+# 模块里的类继承 Trainer / Dataset / Sampler，这些导入本身无法推迟到第一步之后
+from train_args import parse_args
+_CLI_ARGS = parse_args() if __name__ == "__main__" else None
 
 import torch
-import argparse
-from transformers import AutoTokenizer, AutoModelForCausalLM,TrainingArguments,Trainer,ProgressCallback
+import torch.utils.checkpoint
+import json
+import hashlib
+import shutil
+import tempfile
+import math
+import copy
+import dataclasses
+import queue
+import threading
+import resource
+import contextlib
+import numpy as np
+from transformers import AutoTokenizer, AutoModelForCausalLM,TrainingArguments,Trainer,ProgressCallback,TrainerCallback
 from datasets import load_dataset
 from peft import LoraConfig, get_peft_model
 import glob
 from functools import partial
-from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader, Dataset, IterableDataset, Sampler, get_worker_info
+import random
+import itertools
 
 from accelerate import Accelerator
+from accelerate.utils import gather_object
+from transformers.trainer_callback import ExportableState
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
 def on_log(self, args, state, control, logs=None, **kwargs):
     if state.is_local_process_zero and self.training_bar is not None:
         _ = logs.pop("total_flos", None)
 ProgressCallback.on_log = on_log
 
 def mapper_tokenize(examples,tokenizer):
-    input_ids = []
-    output_ids = []
-    inputs = examples['input']
-    outputs = examples['output']
-    for input_tex,output_tex in zip(inputs,outputs):
-        input_ids.append(tokenizer.encode(input_tex,add_special_tokens=False))
-        output_ids.append(tokenizer.encode(output_tex,add_special_tokens=False))
+    # 整个batch一次调用 fast tokenizer（Rust 侧批量编码），结果与逐条 tokenizer.encode 一致
+    input_ids = tokenizer(examples['input'],add_special_tokens=False,return_attention_mask=False)["input_ids"]
+    output_ids = tokenizer(examples['output'],add_special_tokens=False,return_attention_mask=False)["input_ids"]
     return {
         "input_ids": input_ids,
-        "labels": output_ids
+        "labels": output_ids,
+        # 样本总长度: input + output + eos，供按token预算组batch使用
+        "length": [len(i) + len(o) + 1 for i, o in zip(input_ids, output_ids)],
+    }
+
+TOKENIZED_CACHE_VERSION = 1
+
+
+def tokenizer_fingerprint(tokenizer):
+    """tokenizer 的指纹: 词表/merges 的哈希 + special tokens"""
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        content = backend.to_str()
+    else:
+        content = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    return {
+        "class": type(tokenizer).__name__,
+        "vocab_hash": hashlib.sha256(content.encode("utf-8")).hexdigest(),
+        "special_tokens": json.loads(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str)),
+    }
+
+
+def files_fingerprint(jsonl_files):
+    """jsonl 文件集合的指纹: 路径 + 大小 + 修改时间"""
+    fingerprint = []
+    for path in sorted(jsonl_files):
+        stat = os.stat(path)
+        fingerprint.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+def tokenized_cache_key(jsonl_files, tokenizer, max_input_length):
+    key = {
+        "version": TOKENIZED_CACHE_VERSION,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "files": files_fingerprint(jsonl_files),
+        "max_input_length": max_input_length,
+    }
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+    return digest, key
+
+
+def _flatten_list_column(column):
+    """把 Arrow 的 list<int> 列拆成扁平 int32 数组和 int64 offsets"""
+    values = []
+    lengths = []
+    for chunk in column.chunks:
+        values.append(chunk.flatten().to_numpy(zero_copy_only=False).astype(np.int32))
+        lengths.append(chunk.value_lengths().to_numpy(zero_copy_only=False).astype(np.int64))
+    values = np.concatenate(values) if values else np.zeros(0, dtype=np.int32)
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return values, offsets
+
+
+def write_tokenized_cache(tokenized_ds, cache_path, key):
+    """把 tokenize 后的 datasets.Dataset 写成扁平 .npy 缓存，写完后原子重命名，meta.json 标记缓存完整"""
+    table = tokenized_ds.flatten_indices().data.table
+    cache_root = os.path.dirname(cache_path)
+    os.makedirs(cache_root, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=".tmp-", dir=cache_root)
+    os.chmod(tmp_path, 0o755)
+    try:
+        for column in ("input_ids", "labels"):
+            values, offsets = _flatten_list_column(table.column(column))
+            np.save(os.path.join(tmp_path, f"{column}.npy"), values)
+            np.save(os.path.join(tmp_path, f"{column}_offsets.npy"), offsets)
+        with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"num_examples": table.num_rows, "key": key}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # 其他进程已经写好了同一份缓存
+        if not os.path.exists(os.path.join(cache_path, "meta.json")):
+            raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+class TokenizedCacheDataset(Dataset):
+    """
+    内存映射加载的 tokenize 缓存，接口与 tokenize 后的 datasets.Dataset 保持一致:
+    dataset[i] 返回 {"input_ids", "labels", "length"}，dataset["length"] 返回整列长度。
+    """
+    def __init__(self, cache_path, indices=None):
+        self.cache_path = cache_path
+        self.input_ids = np.load(os.path.join(cache_path, "input_ids.npy"), mmap_mode="r")
+        self.input_offsets = np.load(os.path.join(cache_path, "input_ids_offsets.npy"), mmap_mode="r")
+        self.labels = np.load(os.path.join(cache_path, "labels.npy"), mmap_mode="r")
+        self.labels_offsets = np.load(os.path.join(cache_path, "labels_offsets.npy"), mmap_mode="r")
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices) if self.indices is not None else len(self.input_offsets) - 1
+
+    def _lengths(self):
+        lengths = np.diff(self.input_offsets) + np.diff(self.labels_offsets) + 1
+        return lengths[self.indices] if self.indices is not None else lengths
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key != "length":
+                return [self[i][key] for i in range(len(self))]
+            return self._lengths().tolist()
+        idx = int(self.indices[key]) if self.indices is not None else key
+        input_ids = self.input_ids[self.input_offsets[idx]:self.input_offsets[idx + 1]].tolist()
+        labels = self.labels[self.labels_offsets[idx]:self.labels_offsets[idx + 1]].tolist()
+        return {"input_ids": input_ids, "labels": labels, "length": len(input_ids) + len(labels) + 1}
+
+    def shuffle(self, seed):
+        permutation = np.random.default_rng(seed).permutation(len(self))
+        indices = self.indices[permutation] if self.indices is not None else permutation
+        return TokenizedCacheDataset(self.cache_path, indices)
+
+    def __repr__(self):
+        return f"TokenizedCacheDataset(path={self.cache_path}, num_rows={len(self)})"
+
+
+def tokenize_jsonl_files(jsonl_files, tokenizer, args, shuffle=False, fingerprint=None):
+    """
+    fingerprint 不为 None 时用作 datasets 缓存指纹，保证各rank/各次启动命中同一份 Arrow 缓存，
+    不依赖对 tokenizer 和 lambda 的序列化哈希。
+    """
+    if fingerprint is not None and shuffle:
+        fingerprint = f"{fingerprint}-s{args.shuffle_seed}"
+    ds = load_dataset("json", data_files=jsonl_files)['train']
+    if shuffle:
+        print(f"启用数据随机化，种子: {args.shuffle_seed}")
+        # 方法1: 使用 shuffle 方法打乱数据集
+        ds = ds.shuffle(seed=args.shuffle_seed)  # 使用指定种子确保可重现性
+    start_time = time.perf_counter()
+    tokenized_ds = ds.map(
+        partial(mapper_tokenize,tokenizer=tokenizer),
+        batched=True,
+        batch_size=args.tokenize_batch_size,
+        num_proc=args.tokenize_num_proc if args.tokenize_num_proc > 1 else None,
+        remove_columns=ds.column_names,
+        desc="Tokenizing",
+        new_fingerprint=f"{fingerprint}-tokenize" if fingerprint else None,
+    )
+    elapsed = time.perf_counter() - start_time
+    print(f"tokenize 完成: {len(ds)} 条, {elapsed:.1f}s, {len(ds) / max(elapsed, 1e-6):.0f} examples/s "
+          f"(batch_size={args.tokenize_batch_size}, num_proc={args.tokenize_num_proc})")
+    return tokenized_ds.filter(
+        lambda batch_input_ids: [len(ids) <= args.max_input_length for ids in batch_input_ids],
+        input_columns="input_ids",
+        batched=True,
+        batch_size=args.tokenize_batch_size,
+        new_fingerprint=f"{fingerprint}-filter" if fingerprint else None,
+    )
+
+
+def load_tokenized_dataset(data_dir, tokenizer, args, shuffle=False):
+    """
+    加载目录下所有 jsonl 并 tokenize。
+    指定 --tokenized_cache_dir 时，按 tokenizer/文件集合/长度过滤参数的指纹复用磁盘缓存，未命中则构建一次。
+    """
+    jsonl_files = sorted(glob.glob(os.path.join(data_dir, "*.jsonl")))
+    print(jsonl_files)
+    digest, key = tokenized_cache_key(jsonl_files, tokenizer, args.max_input_length)
+    if not args.tokenized_cache_dir:
+        return tokenize_jsonl_files(jsonl_files, tokenizer, args, shuffle=shuffle, fingerprint=digest)
+
+    cache_path = os.path.join(args.tokenized_cache_dir, digest)
+    if os.path.exists(os.path.join(cache_path, "meta.json")):
+        print(f"命中tokenize缓存: {cache_path}")
+    else:
+        print(f"未命中tokenize缓存，开始构建: {cache_path}")
+        write_tokenized_cache(tokenize_jsonl_files(jsonl_files, tokenizer, args, fingerprint=digest), cache_path, key)
+    tokenized_ds = TokenizedCacheDataset(cache_path)
+    if shuffle:
+        print(f"启用数据随机化，种子: {args.shuffle_seed}")
+        tokenized_ds = tokenized_ds.shuffle(args.shuffle_seed)
+    return tokenized_ds
+
+
+def count_jsonl_lines(jsonl_files):
+    """按块统计换行数，用于流式模式下估算训练步数"""
+    total = 0
+    for path in jsonl_files:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 24), b""):
+                total += chunk.count(b"\n")
+    return total
+
+
+class JsonlStreamingDataset(IterableDataset):
+    """
+    流式读取 jsonl 分片，在 DataLoader worker 中实时 tokenize，不把整个语料加载进内存。
+    - 按 (rank, worker) 确定性切分: 文件数不少于分片数时按文件大小均衡分配文件，否则按行号取模
+    - 每个epoch用 seed + epoch 打乱文件顺序，行流按 shuffle_buffer_size 切块，块内用 (seed, epoch, 分片, 块号) 打乱
+    - 每条样本带 _cursor = (分片, (块号, 块起始位置, 块内已消费行数))，由 StreamingDataLoader 记录；
+      恢复训练时从块起始位置 seek，只重读当前块，之前的数据不再读取和 tokenize
+    输出与 tokenize 后的 datasets.Dataset 相同: {"input_ids", "labels", "length"}
+    """
+    def __init__(self, jsonl_files, tokenizer, max_input_length, shuffle=False, seed=42, shuffle_buffer_size=10000,
+                 num_replicas=1, rank=0, tokenize_batch_size=256):
+        self.jsonl_files = sorted(jsonl_files)
+        self.tokenizer = tokenizer
+        self.max_input_length = max_input_length
+        self.shuffle = shuffle
+        self.seed = seed
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.tokenize_batch_size = tokenize_batch_size
+        self.epoch = 0
+        # StreamingDataLoader.state_dict() 的内容，只对其中记录的epoch生效
+        self.resume_state = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _resume_state(self):
+        if self.resume_state is not None and self.resume_state["epoch"] == self.epoch:
+            return self.resume_state
+        return None
+
+    def _shard(self):
+        worker_info = get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info is not None else (1, 0)
+        resume_state = self._resume_state()
+        if resume_state is not None:
+            # DataLoader 总是从 worker 0 开始轮询，轮换 worker 与分片的对应关系，使恢复后的batch顺序与中断前一致
+            worker_id = (worker_id + resume_state["next_worker"]) % num_workers
+        return self.num_replicas * num_workers, self.rank * num_workers + worker_id
+
+    def _shard_files(self, num_shards, shard_id):
+        # 按文件大小从大到小贪心分配给当前最空的分片，保证各分片数据量接近且结果确定
+        loads = [0] * num_shards
+        assigned = [[] for _ in range(num_shards)]
+        for path in sorted(self.jsonl_files, key=lambda p: (-os.path.getsize(p), p)):
+            target = loads.index(min(loads))
+            assigned[target].append(path)
+            loads[target] += os.path.getsize(path)
+        return assigned[shard_id]
+
+    def _iter_lines(self, rng, num_shards, shard_id, start=None):
+        """产出当前分片的 (位置, 行)，位置 = (文件序号, 字节偏移, 全局行号)，从 start 开始时直接 seek"""
+        by_line = len(self.jsonl_files) < num_shards
+        if by_line:
+            files = list(self.jsonl_files)
+        else:
+            files = self._shard_files(num_shards, shard_id)
+            if self.shuffle:
+                rng.shuffle(files)
+        file_index, offset, line_index = start or (0, 0, 0)
+        for i in range(file_index, len(files)):
+            with open(files[i], "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    if not by_line or line_index % num_shards == shard_id:
+                        yield (i, offset, line_index), line
+                    offset += len(line)
+                    line_index += 1
+            offset = 0
+
+    def _iter_blocks(self, rng, num_shards, shard_id, resume=None):
+        """按块打乱行流，产出 (游标, 行)；resume 为之前记录的游标，跳过该块内已消费的行"""
+        block_index, start, consumed = resume or (0, None, 0)
+        lines = self._iter_lines(rng, num_shards, shard_id, start)
+        while True:
+            block = list(itertools.islice(lines, self.shuffle_buffer_size))
+            if not block:
+                return
+            order = list(range(len(block)))
+            if self.shuffle:
+                random.Random(f"{self.seed}-{self.epoch}-{shard_id}-{block_index}").shuffle(order)
+            block_start = block[0][0]
+            for position in range(consumed, len(order)):
+                yield (block_index, block_start, position + 1), block[order[position]][1]
+            block_index += 1
+            consumed = 0
+
+    def _tokenize(self, records):
+        input_ids = self.tokenizer([r['input'] for _, r in records],add_special_tokens=False,return_attention_mask=False)["input_ids"]
+        output_ids = self.tokenizer([r['output'] for _, r in records],add_special_tokens=False,return_attention_mask=False)["input_ids"]
+        for (cursor, _), i, o in zip(records, input_ids, output_ids):
+            if len(i) <= self.max_input_length:
+                yield {"input_ids": i, "labels": o, "length": len(i) + len(o) + 1, "_cursor": cursor}
+
+    def _iter_examples(self, rng, num_shards, shard_id, resume=None):
+        records = []
+        for cursor, line in self._iter_blocks(rng, num_shards, shard_id, resume):
+            if not line.strip():
+                continue
+            records.append(((shard_id, cursor), json.loads(line)))
+            if len(records) >= self.tokenize_batch_size:
+                yield from self._tokenize(records)
+                records = []
+        if records:
+            yield from self._tokenize(records)
+
+    def __iter__(self):
+        num_shards, shard_id = self._shard()
+        rng = random.Random(f"{self.seed}-{self.epoch}-{shard_id}")
+        resume_state = self._resume_state()
+        resume = resume_state["shards"].get(str(shard_id)) if resume_state is not None else None
+        yield from self._iter_examples(rng, num_shards, shard_id, resume)
+
+
+def collate_with_cursor(examples, collate_fn):
+    """去掉样本上的 _cursor 再交给 collator，返回 (batch, 最后一条样本的游标)"""
+    cursor = examples[-1]["_cursor"]
+    return collate_fn([{k: v for k, v in e.items() if k != "_cursor"} for e in examples]), cursor
+
+
+class StreamingDataLoader(DataLoader):
+    """
+    把 Trainer 的 set_epoch 转发给流式数据集，并记录每个分片已训练到的游标。
+    state_dict() 随checkpoint保存，load_state_dict() 后数据集从游标处继续，不重放已训练的batch。
+    """
+    def __init__(self, dataset, *args, collate_fn=None, **kwargs):
+        # worker 的种子取自独立的 generator，创建迭代器不消耗全局RNG，恢复后 dropout 等随机数与中断前一致
+        kwargs.setdefault("generator", torch.Generator())
+        super().__init__(dataset, *args, collate_fn=partial(collate_with_cursor, collate_fn=collate_fn), **kwargs)
+        # 恢复训练后 Trainer 的epoch从0重新计数，加上偏移得到数据集的epoch
+        self.epoch_offset = 0
+        self.cursors = {}
+        self.num_batches = 0
+
+    @property
+    def num_shards(self):
+        return self.dataset.num_replicas * max(1, self.num_workers)
+
+    def set_epoch(self, epoch):
+        self.dataset.set_epoch(epoch + self.epoch_offset)
+        self.cursors = {}
+        self.num_batches = 0
+
+    def __iter__(self):
+        resume_state = self.dataset._resume_state()
+        if resume_state is not None:
+            self.num_batches = resume_state["num_batches"]
+        num_batches = 0
+        for batch, (shard_id, cursor) in super().__iter__():
+            self.cursors[shard_id] = cursor
+            self.num_batches += 1
+            num_batches += 1
+            yield batch
+        if num_batches == 0 and resume_state is not None:
+            # 恢复点恰好在epoch末尾，直接进入下一个epoch，避免 Trainer 因空epoch停止训练
+            self.epoch_offset += 1
+            self.dataset.set_epoch(self.dataset.epoch + 1)
+            self.cursors = {}
+            self.num_batches = 0
+            yield from self.__iter__()
+
+    def state_dict(self):
+        return {
+            "epoch": self.dataset.epoch,
+            "num_shards": self.num_shards,
+            "num_batches": self.num_batches,
+            "next_worker": self.num_batches % max(1, self.num_workers),
+            "shards": {str(shard_id): cursor for shard_id, cursor in self.cursors.items()},
+        }
+
+    def load_state_dict(self, state):
+        self.dataset.resume_state = state
+        self.epoch_offset = state["epoch"]
+
+
+class LazyDataset:
+    """占位数据集，第一次调用 load() 时才真正构建 (fast_start 下验证集延迟到第一次评估再加载)"""
+    def __init__(self, loader):
+        self.loader = loader
+
+    def load(self):
+        return self.loader()
+
+
+def load_eval_dataset(tokenizer, args, accelerator):
+    with accelerator.local_main_process_first():
+        return load_tokenized_dataset(args.dataset_eval_dir, tokenizer, args)
+
+
+def prepare_datasets(tokenizer, args, accelerator, lazy_eval=False):
+    """
+    每个节点只由本地主进程 tokenize 并写缓存，其余rank在barrier处等待，之后直接内存映射复用结果。
+    结束时汇总各rank的数据集就绪耗时。lazy_eval 时验证集返回 LazyDataset，在第一次评估时加载。
+    """
+    start_time = time.perf_counter()
+    with accelerator.local_main_process_first():
+        wait_time = time.perf_counter() - start_time
+        if args.streaming:
+            tokenized_ds = JsonlStreamingDataset(
+                glob.glob(os.path.join(args.dataset_dir, "*.jsonl")),
+                tokenizer,
+                args.max_input_length,
+                shuffle=True,
+                seed=args.shuffle_seed,
+                shuffle_buffer_size=args.shuffle_buffer_size,
+                num_replicas=accelerator.num_processes,
+                rank=accelerator.process_index,
+            )
+        else:
+            tokenized_ds = load_tokenized_dataset(args.dataset_dir, tokenizer, args, shuffle=args.shuffle_data)
+        if lazy_eval:
+            tokenized_ds_eval = LazyDataset(partial(load_eval_dataset, tokenizer, args, accelerator))
+        else:
+            tokenized_ds_eval = load_tokenized_dataset(args.dataset_eval_dir, tokenizer, args)
+        load_time = time.perf_counter() - start_time - wait_time
+    timing = {
+        "rank": accelerator.process_index,
+        "wait": wait_time,
+        "load": load_time,
+        "ready": time.perf_counter() - start_time,
     }
+    timings = gather_object([timing])
+    if accelerator.is_main_process:
+        print("数据集就绪耗时:")
+        for t in sorted(timings, key=lambda t: t["rank"]):
+            print(f"  rank {t['rank']}: 就绪 {t['ready']:.1f}s (等待主进程 {t['wait']:.1f}s, 加载 {t['load']:.1f}s)")
+    return tokenized_ds, tokenized_ds_eval
+
+
+def bucket_length(length, bucket_size):
+    """把padding后的长度向上取整到 bucket_size 的整数倍，bucket_size 为0或None时不变"""
+    if not bucket_size:
+        return length
+    return -(-length // bucket_size) * bucket_size
+
+
+def shape_bucket_rows(seq_len, total_max_length, max_batch_size=None):
+    """静态shape模式下长度为 seq_len 的batch固定补齐到的行数"""
+    rows = max(1, total_max_length // seq_len)
+    return rows if max_batch_size is None else min(rows, max_batch_size)
 
-def data_collator(examples,eos_token_id,pad_token_id,total_max_length):
-    input_ids_all = []
-    labels_all = []
-    attention_mask_all = []
+
+def data_collator(examples,eos_token_id,pad_token_id,total_max_length,with_loss_weights=False,shape_bucket_size=None,max_batch_size=None,truncate=True):
+    """
+    左padding的batch: 所有样本的token先拼成一个扁平tensor，再按长度一次性散射到预分配的 (B, T) buffer 中，
+    不为每个样本单独创建tensor。
+    with_loss_weights: 额外输出与labels对齐的余弦位置权重 loss_weights，供 weighted_compute_loss_func 使用。
+    shape_bucket_size: 静态shape模式，长度向上取整到它的整数倍，行数补齐到 shape_bucket_rows，
+        每个长度桶只有一种shape。补齐的行全部为padding (labels为-100)，排在真实样本之后。
+    truncate: 旧的按 total_max_length 截断 (丢弃多余的行，单条超长样本截掉末尾的label)，只用于不经过
+        TokenBudgetBatchSampler 的路径；batch_sampler 已按预算组好batch，超预算的样本单独成batch并完整保留。
+    """
+    input_lengths = [len(example['input_ids']) for example in examples]
+    lengths = torch.tensor([len(example['input_ids']) + len(example['labels']) + 1 for example in examples], dtype=torch.long)
+    flat_ids = []
     for example in examples:
-        original_input_ids = example['input_ids']
-        original_output_ids = example['labels']
-        input_ids = original_input_ids+original_output_ids+[eos_token_id]
-        labels = [-100]*len(original_input_ids)+original_output_ids+[eos_token_id]
-        attention_mask = [1]*len(input_ids)
-        input_ids_all.append(torch.tensor(input_ids, dtype=torch.long))
-        labels_all.append(torch.tensor(labels, dtype=torch.long))
-        attention_mask_all.append(torch.tensor(attention_mask, dtype=torch.long))
-    input_ids_tensor = pad_sequence(input_ids_all,batch_first=True,padding_value=pad_token_id,padding_side="left")
-    labels_tensor = pad_sequence(labels_all,batch_first=True,padding_value=-100,padding_side="left")
-    attention_mask_tensor = pad_sequence(attention_mask_all,batch_first=True,padding_value=0,padding_side="left")
-
-    max_bs_size = total_max_length // input_ids_tensor.shape[1]
-    if max_bs_size < input_ids_tensor.shape[0]:
+        flat_ids += example['input_ids']
+        flat_ids += example['labels']
+        flat_ids.append(eos_token_id)
+    flat_ids = torch.from_numpy(np.array(flat_ids, dtype=np.int64))
+
+    batch_size, seq_len = len(examples), bucket_length(int(lengths.max()), shape_bucket_size)
+    rows = torch.repeat_interleave(torch.arange(batch_size), lengths)
+    starts = torch.cumsum(lengths, 0) - lengths
+    positions = torch.arange(flat_ids.numel()) - starts[rows]
+    cols = positions + (seq_len - lengths)[rows]
+
+    input_ids_tensor = torch.full((batch_size, seq_len), pad_token_id, dtype=torch.long)
+    labels_tensor = torch.full((batch_size, seq_len), -100, dtype=torch.long)
+    attention_mask_tensor = torch.zeros((batch_size, seq_len), dtype=torch.long)
+    input_ids_tensor[rows, cols] = flat_ids
+    labels_tensor[rows, cols] = flat_ids.masked_fill(positions < torch.tensor(input_lengths)[rows], -100)
+    attention_mask_tensor[rows, cols] = 1
+
+    # 旧逻辑: 固定 batch_size 的路径才截断，按token预算组batch时不会走到这里
+    max_bs_size = total_max_length // seq_len
+    if truncate and max_bs_size < batch_size:
         if max_bs_size < 1:
             max_bs_size = 1
-            print(f'max_bs_size:{max_bs_size}, input_ids_tensor.shape[0]:{input_ids_tensor.shape[0]} truncate the batch size to {max_bs_size}')
+            print(f'max_bs_size:{max_bs_size}, input_ids_tensor.shape[0]:{batch_size} truncate the batch size to {max_bs_size}')
             input_ids_tensor = input_ids_tensor[:max_bs_size,:total_max_length]
             labels_tensor = labels_tensor[:max_bs_size,:total_max_length]
             attention_mask_tensor = attention_mask_tensor[:max_bs_size,:total_max_length]
         else:
-            print(f'max_bs_size:{max_bs_size}, input_ids_tensor.shape[0]:{input_ids_tensor.shape[0]} truncate the batch size to {max_bs_size}')
+            print(f'max_bs_size:{max_bs_size}, input_ids_tensor.shape[0]:{batch_size} truncate the batch size to {max_bs_size}')
             input_ids_tensor = input_ids_tensor[:max_bs_size]
             labels_tensor = labels_tensor[:max_bs_size]
             attention_mask_tensor = attention_mask_tensor[:max_bs_size]
-    
-    # 确保张量在正确的设备上并且有正确的数据类型
-    input_ids_tensor = input_ids_tensor.long()
-    labels_tensor = labels_tensor.long()
-    attention_mask_tensor = attention_mask_tensor.long()
-    
-    
-    return {
+    if shape_bucket_size:
+        num_rows = shape_bucket_rows(input_ids_tensor.shape[1], total_max_length, max_batch_size)
+        pad_rows = (0, 0, 0, num_rows - input_ids_tensor.shape[0])
+        input_ids_tensor = torch.nn.functional.pad(input_ids_tensor, pad_rows, value=pad_token_id)
+        labels_tensor = torch.nn.functional.pad(labels_tensor, pad_rows, value=-100)
+        attention_mask_tensor = torch.nn.functional.pad(attention_mask_tensor, pad_rows, value=0)
+
+    batch = {
         "input_ids": input_ids_tensor,
         "labels": labels_tensor,
         "attention_mask": attention_mask_tensor
     }
+    if with_loss_weights:
+        batch["loss_weights"] = shifted_to_label_weights(cosine_position_weights(labels_tensor[:, 1:], eos_token_id))
+    return batch
 
 
-def compute_loss(outputs,
-                labels,
-                num_items_in_batch,
-                eos_token_id=None,
-            ):
-    logits = outputs.logits  # shape: (B, T, V)
-    B, T, V = logits.shape
-    logits = outputs.logits[:,:-1,:]
-    labels = labels[:,1:]
-    
-    if eos_token_id is None:
-        eos_token_id = 2  # 默认值，如果未提供
+def packing_data_collator(examples, eos_token_id, pad_token_id, total_max_length, with_loss_weights=False,
+                          shape_bucket_size=None, max_batch_size=None):
+    """
+    把一个batch的样本拼接成一行 (1, L)，不做padding:
+    - position_ids 按样本从0重置，flash-attn/sdpa 据此切分样本，样本之间互不可见
+    - labels 按样本mask，每个样本首token置为-100，避免被上一个样本的末尾预测
+    - segment_ids 标记每个token所属样本(从1开始)，供 loss 按样本计算
+    - with_loss_weights 时额外输出按样本计算的余弦位置权重 loss_weights
+    - shape_bucket_size 时在行尾补一段padding到桶长度: segment_ids 为0，labels为-100，position_ids 从0开始
+    """
+    input_ids = []
+    labels = []
+    position_ids = []
+    segment_ids = []
+    for segment, example in enumerate(examples, start=1):
+        original_input_ids = example['input_ids']
+        original_output_ids = example['labels']
+        example_input_ids = original_input_ids+original_output_ids+[eos_token_id]
+        example_labels = [-100]*len(original_input_ids)+original_output_ids+[eos_token_id]
+        example_labels[0] = -100
+        input_ids.extend(example_input_ids)
+        labels.extend(example_labels)
+        position_ids.extend(range(len(example_input_ids)))
+        segment_ids.extend([segment]*len(example_input_ids))
+    num_pad = bucket_length(len(input_ids), shape_bucket_size) - len(input_ids)
+    if num_pad:
+        input_ids.extend([pad_token_id]*num_pad)
+        labels.extend([-100]*num_pad)
+        position_ids.extend(range(num_pad))
+        segment_ids.extend([0]*num_pad)
+    batch = {
+        "input_ids": torch.tensor([input_ids], dtype=torch.long),
+        "labels": torch.tensor([labels], dtype=torch.long),
+        "position_ids": torch.tensor([position_ids], dtype=torch.long),
+        "segment_ids": torch.tensor([segment_ids], dtype=torch.long),
+    }
+    if with_loss_weights:
+        batch["loss_weights"] = shifted_to_label_weights(
+            segment_cosine_position_weights(batch["labels"][:, 1:], batch["segment_ids"][:, 1:], eos_token_id)
+        )
+    return batch
+
+
+def cosine_position_weights(labels, eos_token_id):
+    """
+    按行计算余弦位置权重: 每行从第一个有效label到第一个eos，权重 cos(pi * pos / (2 * len)) + 1，最后一个位置为2。
+    labels 为已经移位后的 (B, T)，返回 (B, T) 的 float32 权重，无效位置为0。
+    """
+    B, T = labels.shape
     
     # 向量化计算每个样本的第一个非-100位置
     non_neg_100_mask = labels != -100  # (B, T)
@@ -109,7 +613,7 @@ def compute_loss(outputs,
     valid_length[all_neg_100_mask] = 0
     
     # 创建位置索引张量 (B, T)
-    position_indices = torch.arange(T, device=logits.device).unsqueeze(0).expand(B, -1)  # (B, T)
+    position_indices = torch.arange(T, device=labels.device).unsqueeze(0).expand(B, -1)  # (B, T)
     
     # 创建有效位置掩码
     valid_positions = (position_indices >= valid_label_start_index.unsqueeze(1)) & \
@@ -134,11 +638,52 @@ def compute_loss(outputs,
     # 创建最终权重张量
     weights = torch.zeros_like(labels, dtype=torch.float32)  # (B, T)
     weights[valid_positions] = cosine_weights[valid_positions]
+    return weights
+
+
+def segment_cosine_position_weights(labels, segment_ids, eos_token_id):
+    """
+    packing 模式下按样本(segment)计算余弦位置权重: 把每个segment展开成独立的一行，
+    复用 cosine_position_weights 的按行逻辑后再合并回 (B, T)。segment_ids 中0表示padding。
+    """
+    B, T = labels.shape
+    flat_labels = labels.reshape(1, -1)
+    flat_segments = segment_ids.reshape(1, -1)
+    segment_values = torch.unique(flat_segments)
+    segment_values = segment_values[segment_values > 0].unsqueeze(1)  # (S, 1)
+    per_segment_labels = torch.where(flat_segments == segment_values, flat_labels, torch.full_like(flat_labels, -100))
+    weights = cosine_position_weights(per_segment_labels, eos_token_id)  # (S, B*T)
+    return weights.sum(dim=0).view(B, T)
+
+
+def shifted_to_label_weights(weights):
+    """把按移位后labels (B, T-1) 计算的权重补上首列0，与未移位的labels (B, T) 对齐"""
+    return torch.nn.functional.pad(weights, (1, 0))
+
+
+def compute_loss(outputs,
+                labels,
+                num_items_in_batch,
+                eos_token_id=None,
+                segment_ids=None,
+            ):
+    logits = outputs.logits[:,:-1,:]
+    labels = labels[:,1:]
+    B, T, V = logits.shape
+    
+    if eos_token_id is None:
+        eos_token_id = 2  # 默认值，如果未提供
+    
+    if segment_ids is None:
+        weights = cosine_position_weights(labels, eos_token_id)
+    else:
+        # packing 行中每个样本单独计算权重
+        weights = segment_cosine_position_weights(labels, segment_ids[:,1:], eos_token_id)
     
     # 计算交叉熵损失（reduction='none'）
     ce_loss = torch.nn.functional.cross_entropy(
-        logits.view(-1, V), 
-        labels.view(-1), 
+        logits.reshape(-1, V), 
+        labels.reshape(-1), 
         ignore_index=-100, 
         reduction='none'
     ).view(B, T)
@@ -155,45 +700,1695 @@ def compute_loss(outputs,
     
     return loss
 
-def default_compute_loss_func(outputs, labels, num_items_in_batch):
+def default_compute_loss_func(outputs, labels, num_items_in_batch, segment_ids=None):
+    # packing 模式下 collator 已经按样本mask了labels，token平均与不packing的batch等价，segment_ids 无需处理
     logits = outputs.logits[:,:-1,:].contiguous()
     labels = labels[:,1:].contiguous()
     return torch.nn.functional.cross_entropy(logits.view(-1, logits.shape[-1]), labels.view(-1),ignore_index=-100)
 
+def label_logit_positions(labels):
+    """
+    需要计算logits的序列位置: 位置 t 预测 labels[:, t+1]，只要任意一行在 t+1 有有效label就保留。
+    左padding时答案都对齐在序列末尾，这些位置通常只占整个序列的一小部分。
+    """
+    return (labels[:, 1:] != -100).any(dim=0).nonzero().squeeze(-1)
+
+
+def _sum_cross_entropy(logits, labels):
+    return torch.nn.functional.cross_entropy(logits.reshape(-1, logits.shape[-1]), labels.reshape(-1), ignore_index=-100, reduction="sum")
+
+
+@contextlib.contextmanager
+def label_hidden_states(model):
+    """
+    前向时跳过 lm_head: 模型的 outputs.logits 直接是 hidden states，配合 logits_to_keep=label_logit_positions
+    为 (B, K, H)。产出原来的 lm_head，交给 label_only_compute_loss_func / weighted_compute_loss_func 按chunk投影，
+    不生成整块 (B, K, V) 的 logits。model 为未包装的模型。
+    """
+    lm_head = model.get_output_embeddings()
+    # accelerate 的 hook 等可能已经替换了实例上的 forward，退出时原样恢复
+    instance_forward = lm_head.__dict__.get("forward")
+    project = lm_head.forward
+    lm_head.forward = lambda hidden_states: hidden_states
+    try:
+        yield project
+    finally:
+        if instance_forward is None:
+            del lm_head.forward
+        else:
+            lm_head.forward = instance_forward
+
+
+def _chunked_loss(loss_fn, lm_head, *chunk):
+    """一个chunk的loss；lm_head 不为None时 chunk[0] 是 hidden states，在这里投影成 logits，checkpoint 下反向时重算"""
+    if lm_head is not None:
+        chunk = (lm_head(chunk[0]),) + chunk[1:]
+    return loss_fn(*chunk)
+
+
+def label_only_compute_loss_func(outputs, labels, num_items_in_batch, segment_ids=None, chunk_size=512,
+                                 cross_entropy_fn=_sum_cross_entropy, lm_head=None):
+    """
+    只在label位置上计算的交叉熵，结果与 default_compute_loss_func 一致。
+    lm_head 为None时 outputs.logits 是 (B, K, V) 或完整的 logits，后者从中取出 label_logit_positions；
+    配合 CustomTrainer(label_only_logits=True) 时 outputs.logits 是这些位置的 hidden states (label_hidden_states)，
+    由 lm_head 按chunk投影。
+    按 chunk_size 个位置分块并做checkpoint，反向时重算，同时只存在一个chunk的 logits 和 log_softmax；
+    cross_entropy_fn 可换成 torch.compile 后的 _sum_cross_entropy。
+    """
+    positions = label_logit_positions(labels)
+    logits = outputs.logits
+    if logits.shape[1] != positions.numel():
+        logits = logits[:, positions]
+    targets = labels[:, positions + 1]
+    num_tokens = (targets != -100).sum()
+    if num_tokens == 0:
+        return logits.sum() * 0.0
+    loss = 0.0
+    for start in range(0, positions.numel(), chunk_size):
+        chunk = (logits[:, start:start + chunk_size], targets[:, start:start + chunk_size])
+        if torch.is_grad_enabled():
+            loss = loss + torch.utils.checkpoint.checkpoint(_chunked_loss, cross_entropy_fn, lm_head, *chunk, use_reentrant=False)
+        else:
+            loss = loss + _chunked_loss(cross_entropy_fn, lm_head, *chunk)
+    return loss / num_tokens
+
+
+@torch.no_grad()
+def per_example_loss(logits, labels, segment_ids=None, chunk_size=512, lm_head=None):
+    """
+    每条样本在label位置上的平均交叉熵 (不加权)，用训练loss已经算好的logits，不额外前向。
+    logits 可以是完整的 (B, T, V)，也可以是只含 label_logit_positions 的 (B, K, V)；
+    lm_head 不为None时为这些位置的 hidden states (B, K, H)，按chunk投影。
+    返回 (样本数,) 的float32: 不packing时每行一条样本；packing时按 segment_ids 拆分。没有有效label的样本为 nan。
+    """
+    positions = label_logit_positions(labels)
+    if logits.shape[1] != positions.numel():
+        logits = logits[:, positions]
+    targets = labels[:, positions + 1]
+    ce = torch.zeros(targets.shape, dtype=torch.float32, device=logits.device)
+    for start in range(0, positions.numel(), chunk_size):
+        logits_chunk = logits[:, start:start + chunk_size]
+        logits_chunk = (logits_chunk if lm_head is None else lm_head(logits_chunk)).float()
+        ce[:, start:start + chunk_size] = torch.nn.functional.cross_entropy(
+            logits_chunk.transpose(1, 2), targets[:, start:start + chunk_size], ignore_index=-100, reduction="none")
+    valid = targets != -100
+    if segment_ids is None:
+        groups = torch.arange(targets.shape[0], device=targets.device).unsqueeze(1).expand_as(targets)
+        num_examples = targets.shape[0]
+    else:
+        groups = segment_ids[:, positions + 1] - 1
+        num_examples = int(segment_ids.max())
+    sums = torch.zeros(num_examples, dtype=torch.float32, device=logits.device).index_add_(0, groups[valid], ce[valid])
+    counts = torch.zeros(num_examples, dtype=torch.float32, device=logits.device).index_add_(0, groups[valid], valid[valid].float())
+    return sums / counts
+
+def _weighted_cross_entropy(logits, labels, weights):
+    # logsumexp - 目标logit 即逐token交叉熵，乘权重后直接求和，不生成 (N, V) 的 log_softmax
+    logits = logits.float()
+    target_logits = logits.gather(-1, labels.clamp(min=0).unsqueeze(-1)).squeeze(-1)
+    return ((torch.logsumexp(logits, dim=-1) - target_logits) * weights).sum()
+
+
+def weighted_compute_loss_func(outputs, labels, num_items_in_batch, loss_weights=None, segment_ids=None,
+                               chunk_size=512, cross_entropy_fn=_weighted_cross_entropy, lm_head=None):
+    """
+    余弦位置加权loss的快速版本，结果与 compute_loss 一致: sum(ce * w) / count(w > 0)。
+    - loss_weights 由 collator(with_loss_weights=True) 预先计算，与labels对齐，packing 时已按样本计算，segment_ids 无需处理
+    - 只在 label_logit_positions 上计算，可配合 CustomTrainer(label_only_logits=True)，此时 outputs.logits 为
+      hidden states，由 lm_head 按chunk投影 (同 label_only_compute_loss_func)
+    - 按 chunk_size 个位置分块并做checkpoint；cross_entropy_fn 可换成 torch.compile 后的 _weighted_cross_entropy
+    """
+    positions = label_logit_positions(labels)
+    logits = outputs.logits
+    if logits.shape[1] != positions.numel():
+        logits = logits[:, positions]
+    targets = labels[:, positions + 1]
+    weights = loss_weights[:, positions + 1].to(torch.float32)
+    num_weighted = (weights > 0).sum()
+    if num_weighted == 0:
+        return logits.sum() * 0.0
+    loss = 0.0
+    for start in range(0, positions.numel(), chunk_size):
+        chunk = (logits[:, start:start + chunk_size], targets[:, start:start + chunk_size], weights[:, start:start + chunk_size])
+        if torch.is_grad_enabled():
+            loss = loss + torch.utils.checkpoint.checkpoint(_chunked_loss, cross_entropy_fn, lm_head, *chunk, use_reentrant=False)
+        else:
+            loss = loss + _chunked_loss(cross_entropy_fn, lm_head, *chunk)
+    return loss / num_weighted
+
 def create_compute_loss_func(eos_token_id):
     """创建带有eos_token_id的compute_loss函数"""
-    def compute_loss_with_eos(outputs, labels, num_items_in_batch):
-        return compute_loss(outputs, labels, num_items_in_batch, eos_token_id)
+    def compute_loss_with_eos(outputs, labels, num_items_in_batch, segment_ids=None):
+        return compute_loss(outputs, labels, num_items_in_batch, eos_token_id, segment_ids=segment_ids)
     return compute_loss_with_eos
 
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    按token预算预先组batch: 每个batch满足 行数 × padding后长度 <= total_max_length。
+    不丢弃任何样本，每个epoch的batch数固定 (loss_tracker 跳过样本时除外)，且为 num_replicas 的整数倍，
+    由 accelerate 的 BatchSamplerShard 轮转分配到各个rank。
+
+    Args:
+        lengths: 每条样本的总token长度 (input + output + eos)
+        total_max_length: 单个batch的token预算，None 表示不限制
+        shuffle: 是否每个epoch打乱样本顺序
+        seed: 随机种子，第 k 个epoch使用 seed + k
+        num_replicas: 进程数，batch总数会补齐到它的整数倍
+        num_epochs: 训练epoch数，用于预先确定固定的batch数
+        max_batch_size: 单个batch的最大行数，None 表示不限制
+        group_by_length: 按长度分桶（megabatch 内排序后再打乱batch顺序），减少padding
+        megabatch_size: 分桶时每个 megabatch 的样本数
+        packing: 样本会被拼接成一行，预算约束改为 样本长度之和 <= total_max_length
+        loss_tracker: ExampleLossTracker，按历史loss在每个epoch跳过已学会的样本，只用保留的样本组batch，
+            epoch的batch数随之减少 (仍为 num_replicas 的整数倍，分组时每个组为整轮)，__len__ 返回当前epoch的batch数；
+            set_epoch 时由 loss_tracker 汇总上一个epoch的loss，需要所有rank一起调用
+        groups: 每条样本的分组 (多adapter训练时为 adapter_id)，不为None时每个batch只含一个组的样本，
+            各组按轮轮流排列: 一轮是一个优化器step里所有rank的 num_replicas × gradient_accumulation_steps 个batch，
+            同一轮只含一个组，每个组的batch数固定并补齐到整轮
+        shape_bucket_size: 静态shape模式，padding后的长度按 bucket_length 取整后再计算预算
+        gradient_accumulation_steps: 梯度累积步数，只用于 groups 的轮大小
+    """
+    def __init__(self, lengths, total_max_length, shuffle=False, seed=42, num_replicas=1, num_epochs=1,
+                 max_batch_size=None, group_by_length=False, megabatch_size=None, packing=False, loss_tracker=None,
+                 groups=None, shape_bucket_size=None, gradient_accumulation_steps=1):
+        self.lengths = list(lengths)
+        self.total_max_length = total_max_length if total_max_length is not None else float("inf")
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = max(1, num_replicas)
+        self.num_epochs = max(1, int(num_epochs))
+        self.max_batch_size = max_batch_size
+        self.group_by_length = group_by_length
+        self.megabatch_size = megabatch_size or len(self.lengths)
+        self.packing = packing
+        self.loss_tracker = loss_tracker
+        self.groups = list(groups) if groups is not None else None
+        self.shape_bucket_size = shape_bucket_size
+        # BatchSamplerShard 把第 i 个batch分给 rank i % num_replicas，连续 round_size 个batch构成一个优化器step
+        self.round_size = self.num_replicas * max(1, gradient_accumulation_steps)
+        self.epoch = 0
+        self._num_batches = None
+        self._group_num_batches = None
+        # loss_tracker 时缓存当前epoch的batch: ((epoch, loss_tracker.epoch), batches)
+        self._epoch_cache = None
+        # 恢复训练时 (epoch, 该epoch开头已训练的batch数)
+        self._resume_skip = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if self.loss_tracker is not None:
+            self.loss_tracker.start_epoch(epoch)
+
+    def skip_batches(self, epoch, num_batches):
+        """恢复训练时 epoch 从第 num_batches 个batch开始 (所有rank合计)，Trainer 需设置 ignore_data_skip"""
+        self._resume_skip = (epoch, num_batches)
+
+    def over_budget_lengths(self):
+        """单条就超过token预算的样本长度，这些样本各自单独成batch，collator 不截断"""
+        return [length for length in self.lengths if bucket_length(length, self.shape_bucket_size) > self.total_max_length]
+
+    def _order(self, epoch):
+        order = list(range(len(self.lengths)))
+        if self.shuffle:
+            random.Random(self.seed + epoch).shuffle(order)
+        if not self.group_by_length:
+            return order
+        if not self.shuffle:
+            return sorted(order, key=lambda i: -self.lengths[i])
+        # megabatch sort-then-shuffle: 随机切分成 megabatch，每个 megabatch 内按长度降序
+        grouped = []
+        for start in range(0, len(order), self.megabatch_size):
+            grouped.extend(sorted(order[start:start + self.megabatch_size], key=lambda i: -self.lengths[i]))
+        return grouped
+
+    def _greedy_batches(self, order):
+        batches = []
+        batch, batch_max, batch_tokens = [], 0, 0
+        for idx in order:
+            length = self.lengths[idx]
+            new_max = max(batch_max, bucket_length(length, self.shape_bucket_size))
+            if self.packing:
+                over_budget = batch_tokens + length > self.total_max_length
+            else:
+                over_budget = (len(batch) + 1) * new_max > self.total_max_length
+            if batch and (over_budget or (self.max_batch_size is not None and len(batch) >= self.max_batch_size)):
+                batches.append(batch)
+                batch, new_max, batch_tokens = [], bucket_length(length, self.shape_bucket_size), 0
+            batch.append(idx)
+            batch_max = new_max
+            batch_tokens += length
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _group_batches(self, order, epoch):
+        """groups 不为None时每个组内分别组batch，返回 {组: batch列表}"""
+        group_orders = {}
+        for idx in order:
+            group_orders.setdefault(self.groups[idx], []).append(idx)
+        group_batches = {}
+        for group in sorted(group_orders):
+            batches = self._greedy_batches(group_orders[group])
+            if self.group_by_length and self.shuffle:
+                random.Random(self.seed + epoch).shuffle(batches)
+            group_batches[group] = batches
+        return group_batches
+
+    def _build_batches(self, order, epoch, fixed=True):
+        if self.groups is None:
+            return self._greedy_batches(order)
+        # 每个组补齐到固定的batch数 (整轮) 后按轮轮流排列 (round-robin)，同一个优化器step里所有rank训练同一个组，
+        # 各组的梯度不会在多卡平均时被其它rank的零梯度稀释；fixed 为False时每个组只补齐到整轮
+        targets = self._target_group_num_batches()
+        group_rounds = []
+        for group, batches in self._group_batches(order, epoch).items():
+            target = targets[group] if fixed else -(-len(batches) // self.round_size) * self.round_size
+            batches = self._fit_num_batches(batches, target)
+            group_rounds.append([batches[i:i + self.round_size] for i in range(0, len(batches), self.round_size)])
+        return [batch for rounds in itertools.zip_longest(*group_rounds) for batches in rounds if batches is not None
+                for batch in batches]
+
+    def _padded_tokens(self, batch):
+        if self.packing:
+            return bucket_length(sum(self.lengths[i] for i in batch), self.shape_bucket_size)
+        return len(batch) * bucket_length(max(self.lengths[i] for i in batch), self.shape_bucket_size)
+
+    def _fit_num_batches(self, batches, target):
+        # 全部样本组成的batch数因打乱顺序或按进程数取整而不足时，拆分padding token最多的batch，保证每个epoch步数一致
+        while len(batches) < target:
+            splittable = [i for i, b in enumerate(batches) if len(b) > 1]
+            if not splittable:
+                # 样本数少于batch数时只能重复样本补齐，而不是丢弃
+                batches.append(batches[(target - len(batches)) % len(batches)])
+                continue
+            i = max(splittable, key=lambda j: self._padded_tokens(batches[j]))
+            batch = batches[i]
+            half = len(batch) // 2
+            batches[i:i + 1] = [batch[:half], batch[half:]]
+        return batches
+
+    def _target_group_num_batches(self):
+        """每个组每个epoch固定的batch数: 各epoch中的最大值，补齐到 round_size 的整数倍"""
+        if self._group_num_batches is None:
+            targets = {}
+            for e in range(self.num_epochs if self.shuffle else 1):
+                for group, batches in self._group_batches(self._order(e), e).items():
+                    targets[group] = max(targets.get(group, 0), len(batches))
+            self._group_num_batches = {group: -(-count // self.round_size) * self.round_size for group, count in targets.items()}
+        return self._group_num_batches
+
+    def _target_num_batches(self):
+        if self._num_batches is None:
+            if self.groups is not None:
+                self._num_batches = sum(self._target_group_num_batches().values())
+                return self._num_batches
+            counts = [len(self._build_batches(self._order(e), e)) for e in range(self.num_epochs if self.shuffle else 1)]
+            target = max(counts) if counts else 0
+            self._num_batches = -(-target // self.num_replicas) * self.num_replicas
+        return self._num_batches
+
+    def _loss_aware_batches(self, order, epoch):
+        # 只用保留的样本组batch，epoch的batch数随跳过的样本减少，只补齐到进程数的整数倍 (分组时每个组补齐到整轮)；
+        # 全部样本都被跳过时保留最接近保留阈值的一条，epoch不为空
+        kept, skipped = self.loss_tracker.select(order, epoch)
+        trained = set(kept or skipped[:1])
+        batches = self._build_batches([idx for idx in order if idx in trained], epoch, fixed=False)
+        if batches:
+            batches = self._fit_num_batches(batches, -(-len(batches) // self.num_replicas) * self.num_replicas)
+        self.loss_tracker.log_epoch(epoch, order, [idx for batch in batches for idx in batch], self.lengths, len(batches))
+        return batches
+
+    def epoch_batches(self, epoch):
+        order = self._order(epoch)
+        if self.loss_tracker is None:
+            batches = self._build_batches(order, epoch)
+            if batches:
+                batches = self._fit_num_batches(batches, self._target_num_batches())
+        else:
+            batches = self._loss_aware_batches(order, epoch)
+        if not batches:
+            return batches
+        if self.group_by_length and self.shuffle:
+            # 打乱batch顺序保留随机性 (分组时已在组内打乱)，最大的batch放在最前面，尽早暴露OOM
+            if self.groups is None:
+                random.Random(self.seed + epoch).shuffle(batches)
+            largest = max(range(len(batches)), key=lambda j: self._padded_tokens(batches[j]))
+            if self.groups is None:
+                batches[0], batches[largest] = batches[largest], batches[0]
+            else:
+                # 分组时整轮交换，不打破每轮只含一个组
+                start = largest // self.round_size * self.round_size
+                batches[:self.round_size], batches[start:start + self.round_size] = \
+                    batches[start:start + self.round_size], batches[:self.round_size]
+        return batches
+
+    def padding_ratio(self, epoch=0):
+        """padding token 占 batch 总token的比例"""
+        batches = self.epoch_batches(epoch)
+        padded = sum(self._padded_tokens(b) for b in batches)
+        real = sum(self.lengths[i] for b in batches for i in b)
+        return 1 - real / padded if padded else 0.0
+
+    def _current_batches(self):
+        # loss_tracker 时batch数取决于已汇总的loss，__len__ 和 __iter__ 共用一次计算的结果
+        key = (self.epoch, self.loss_tracker.epoch)
+        if self._epoch_cache is None or self._epoch_cache[0] != key:
+            self._epoch_cache = (key, self.epoch_batches(self.epoch))
+        batches = self._epoch_cache[1]
+        if self._resume_skip is not None and self._resume_skip[0] == self.epoch:
+            batches = batches[self._resume_skip[1]:]
+        return batches
+
+    def __iter__(self):
+        if self.loss_tracker is not None:
+            yield from self._current_batches()
+        else:
+            yield from self.epoch_batches(self.epoch)
+
+    def __len__(self):
+        if self.loss_tracker is not None:
+            return len(self._current_batches())
+        return self._target_num_batches()
+
+
+class IndexedDataset(Dataset):
+    """给每条样本加上它在数据集中的下标 example_index，供 collate_with_index 放进batch"""
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return {**self.dataset[index], "example_index": index}
+
+    def __getitems__(self, indices):
+        return [self[index] for index in indices]
+
+
+def collate_with_index(examples, collate_fn):
+    """collator 的输出加上 example_index: 不packing时与行对应，packing时与 segment_ids (从1开始) 对应"""
+    batch = collate_fn(examples)
+    example_index = torch.tensor([example["example_index"] for example in examples], dtype=torch.long)
+    if "segment_ids" not in batch:
+        # collator 超出token预算时会截断行数
+        example_index = example_index[:batch["input_ids"].shape[0]]
+    batch["example_index"] = example_index
+    return batch
+
+
+class ExampleLossTracker(TrainerCallback):
+    """
+    按样本记录训练loss (compute_loss 的副产品)，在之后的epoch里降低已学会样本的采样概率。
+    - 每条样本保存loss的指数滑动平均 ema，以及连续低于 loss_threshold 的次数 streak
+    - streak >= patience 的样本以 max(floor_prob, ema / loss_threshold) 的概率保留，其余样本总是保留
+    - 各rank在当前epoch记录的loss在下一个epoch开始时 (sampler.set_epoch) 汇总，所有rank据此做出相同的选择；
+      从epoch中间恢复时先不合并checkpoint里的记录，保证恢复后的epoch与中断前选出的样本一致
+    - TokenBudgetBatchSampler 只用保留的样本组batch，epoch的步数随之减少。epoch_stats 保存每个epoch的batch数，
+      on_epoch_begin 按本epoch的步数估计剩余epoch，更新 max_steps 和LR schedule的总步数 (未设置 max_steps 时)；
+      恢复训练时由 resume_position 按各epoch的步数定位 global_step 所在的epoch
+    - 每个epoch打印跳过的样本数和token比例，skipped_token_ratio 为累计节省的token比例
+    """
+    def __init__(self, num_examples, loss_threshold=0.1, patience=2, floor_prob=0.1, ema_decay=0.5, seed=42, is_main=True):
+        self.loss_threshold = loss_threshold
+        self.patience = patience
+        self.floor_prob = floor_prob
+        self.ema_decay = ema_decay
+        self.seed = seed
+        self.is_main = is_main
+        self.ema = np.full(num_examples, np.nan, dtype=np.float32)
+        self.streak = np.zeros(num_examples, dtype=np.int32)
+        # 本rank在当前epoch的记录，留在设备上，epoch结束前不做同步
+        self.pending = []
+        # 恢复训练时从checkpoint读出的、尚未合并的全部rank的记录
+        self.restored = []
+        # epoch -> (样本数, 跳过样本数, token数, 跳过token数, batch数)
+        self.epoch_stats = {}
+        # pending 中的记录所属的epoch
+        self.epoch = 0
+
+    def record(self, example_index, losses):
+        self.pending.append((example_index.detach(), losses.detach()))
+
+    def _local_records(self):
+        if not self.pending:
+            return []
+        example_index = torch.cat([index for index, _ in self.pending]).tolist()
+        losses = torch.cat([loss for _, loss in self.pending]).tolist()
+        return [(index, loss) for index, loss in zip(example_index, losses) if not math.isnan(loss)]
+
+    def gather_records(self):
+        """所有rank尚未合并的记录，需要所有rank一起调用"""
+        return gather_object(self.restored + self._local_records())
+
+    def merge(self, records):
+        for index, loss in records:
+            previous = self.ema[index]
+            self.ema[index] = loss if np.isnan(previous) else self.ema_decay * previous + (1 - self.ema_decay) * loss
+            self.streak[index] = self.streak[index] + 1 if loss < self.loss_threshold else 0
+
+    def start_epoch(self, epoch):
+        """进入新的epoch时汇总上一个epoch所有rank的记录，需要所有rank一起调用；同一个epoch重复调用不做任何事"""
+        if epoch == self.epoch:
+            return
+        records = self.gather_records()
+        self.pending, self.restored = [], []
+        self.merge(records)
+        self.epoch = epoch
+
+    def epoch_steps(self, epoch, num_replicas, gradient_accumulation_steps):
+        """epoch 的优化器步数，由 epoch_stats 中所有rank合计的batch数计算"""
+        return -(-(self.epoch_stats[epoch][4] // num_replicas) // gradient_accumulation_steps)
+
+    def resume_position(self, global_step, num_replicas, gradient_accumulation_steps):
+        """global_step 所在的 (epoch, 该epoch内已完成的优化器步数)"""
+        start = 0
+        for epoch in sorted(self.epoch_stats):
+            steps = self.epoch_steps(epoch, num_replicas, gradient_accumulation_steps)
+            if global_step < start + steps:
+                return epoch, global_step - start
+            start += steps
+        return max(self.epoch_stats, default=-1) + 1, global_step - start
+
+    def on_epoch_begin(self, args, state, control, train_dataloader=None, lr_scheduler=None, **kwargs):
+        # sampler 已在 set_epoch 后确定本epoch的batch，train_dataloader 的长度是本rank本epoch剩余的batch数
+        if args.max_steps > 0 or train_dataloader is None or self.epoch not in self.epoch_stats:
+            return
+        remaining = -(-len(train_dataloader) // args.gradient_accumulation_steps)
+        later_epochs = max(0, math.ceil(args.num_train_epochs) - self.epoch - 1)
+        state.max_steps = state.global_step + remaining + later_epochs * self.epoch_steps(
+            self.epoch, args.world_size, args.gradient_accumulation_steps)
+        if lr_scheduler is not None and not set_schedule_total_steps(lr_scheduler, state.max_steps) and self.is_main:
+            print(f"[loss-aware] 无法更新 {type(lr_scheduler).__name__} 的总步数，LR schedule 仍按不跳过样本的步数计算")
+
+    def keep_probabilities(self):
+        keep = np.ones(len(self.ema), dtype=np.float32)
+        learned = self.streak >= self.patience
+        keep[learned] = np.clip(self.ema[learned] / self.loss_threshold, self.floor_prob, 1.0)
+        return keep
+
+    def select(self, order, epoch):
+        """
+        按保留概率划分一个epoch的样本顺序，由 (seed, epoch) 和已合并的loss确定，各rank结果一致。
+        返回 (保留的样本, 跳过的样本)，保留的样本按原顺序；跳过的样本按离保留阈值的距离排序，越接近保留的越靠前。
+        """
+        draws = np.random.default_rng([self.seed, epoch]).random(len(self.ema))
+        keep_probabilities = self.keep_probabilities()
+        kept = [index for index in order if draws[index] < keep_probabilities[index]]
+        skipped = sorted((index for index in order if draws[index] >= keep_probabilities[index]),
+                         key=lambda index: draws[index] - keep_probabilities[index])
+        return kept, skipped
+
+    def log_epoch(self, epoch, order, trained, lengths, num_batches):
+        """记录一个epoch实际训练的样本 (补齐batch数时重复的样本只计一次) 和batch数"""
+        if epoch in self.epoch_stats:
+            return
+        trained = set(trained)
+        total_tokens = sum(lengths[index] for index in order)
+        trained_tokens = sum(lengths[index] for index in trained)
+        self.epoch_stats[epoch] = (len(order), len(order) - len(trained), total_tokens, total_tokens - trained_tokens,
+                                   num_batches)
+        if self.is_main and len(trained) < len(order):
+            print(f"[loss-aware] epoch {epoch}: 跳过 {len(order) - len(trained)}/{len(order)} 条样本, "
+                  f"{num_batches} 个batch, 节省 {(total_tokens - trained_tokens) / total_tokens:.1%} token, "
+                  f"累计节省 {self.skipped_token_ratio():.1%}")
+
+    def skipped_token_ratio(self):
+        total = sum(stats[2] for stats in self.epoch_stats.values())
+        return sum(stats[3] for stats in self.epoch_stats.values()) / total if total else 0.0
+
+    def state_dict(self, records):
+        return {"ema": self.ema.copy(), "streak": self.streak.copy(), "pending": records, "epoch": self.epoch,
+                "epoch_stats": dict(self.epoch_stats)}
+
+    def load_state_dict(self, state):
+        self.ema, self.streak = state["ema"], state["streak"]
+        self.epoch, self.epoch_stats = state["epoch"], state["epoch_stats"]
+        # 汇总后的记录只放在主进程，下个epoch开始时再次汇总，不会被重复合并
+        self.restored = state["pending"] if self.is_main else []
+        self.pending = []
+
+
+def set_schedule_total_steps(lr_scheduler, num_training_steps):
+    """
+    修改 get_scheduler 创建的 LambdaLR 的总步数 (lr_lambda 为带 num_training_steps 参数的 partial)，之后的step按新的总步数计算。
+    不是 LambdaLR 时返回False；constant 等与总步数无关的schedule不需要修改。
+    """
+    # DeepSpeed 下 accelerate 会把scheduler包装一层
+    scheduler = getattr(lr_scheduler, "scheduler", lr_scheduler)
+    if not isinstance(scheduler, torch.optim.lr_scheduler.LambdaLR):
+        return False
+    for lr_lambda in scheduler.lr_lambdas:
+        if isinstance(lr_lambda, partial) and "num_training_steps" in lr_lambda.keywords:
+            lr_lambda.keywords["num_training_steps"] = num_training_steps
+    return True
+
+
+# 多adapter训练时每个adapter可以单独覆盖的参数，其余参数所有adapter共用
+MULTI_ADAPTER_KEYS = ("dataset_dir", "dataset_eval_dir", "lora_rank", "lora_alpha", "lora_dropout", "lora_trainable",
+                      "lora_init_method")
+
+
+def load_multi_adapter_config(path, args):
+    """
+    读取多adapter配置: JSON列表，每项为 {"name": ..., 以及 MULTI_ADAPTER_KEYS 中要覆盖的参数}。
+    返回 [(name, adapter_args)]，adapter_args 是命令行参数的副本，未覆盖的参数沿用命令行的值。
+    """
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path} 应为非空的JSON列表")
+    adapters = []
+    for entry in entries:
+        name = entry.get("name")
+        if not isinstance(name, str) or not name.replace("_", "").replace("-", "").isalnum():
+            raise ValueError(f"adapter 名称只能包含字母、数字、下划线和连字符: {name!r}")
+        unknown = set(entry) - {"name", *MULTI_ADAPTER_KEYS}
+        if unknown:
+            raise ValueError(f"adapter {name} 包含不支持的参数: {', '.join(sorted(unknown))}")
+        adapter_args = copy.copy(args)
+        for key in MULTI_ADAPTER_KEYS:
+            if key in entry:
+                setattr(adapter_args, key, entry[key])
+        adapters.append((name, adapter_args))
+    names = [name for name, _ in adapters]
+    if len(set(names)) != len(names):
+        raise ValueError(f"adapter 名称重复: {names}")
+    return adapters
+
+
+def build_lora_config(args):
+    return LoraConfig(
+            r=args.lora_rank,
+            lora_alpha=args.lora_alpha,
+            lora_dropout=args.lora_dropout,
+            init_lora_weights=bool(args.lora_init_method) if args.lora_init_method == 'True' or args.lora_init_method == 'False' else args.lora_init_method,
+            target_modules=args.lora_trainable.split(","),
+            task_type="CAUSAL_LM",  # 明确指定任务类型
+            bias="none",  # 不训练bias
+        )
+
+
+class MultiAdapterDataset(Dataset):
+    """
+    把各adapter的数据集首尾相接，dataset[i] 额外返回样本所属adapter的下标 adapter_id；
+    dataset["length"] / dataset["adapter_id"] 返回整列，供 TokenBudgetBatchSampler 按adapter分组。
+    """
+    def __init__(self, datasets):
+        self.datasets = list(datasets)
+        self.offsets = np.cumsum([0] + [len(dataset) for dataset in self.datasets])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key == "adapter_id":
+                return [adapter_id for adapter_id, dataset in enumerate(self.datasets) for _ in range(len(dataset))]
+            return [value for dataset in self.datasets for value in dataset[key]]
+        adapter_id = int(np.searchsorted(self.offsets, key, side="right")) - 1
+        return {**self.datasets[adapter_id][int(key - self.offsets[adapter_id])], "adapter_id": adapter_id}
+
+    def __repr__(self):
+        return f"MultiAdapterDataset(num_rows={[len(dataset) for dataset in self.datasets]})"
+
+
+def collate_with_adapter_ids(examples, collate_fn):
+    """
+    collator 的输出加上逐行的 adapter_ids。保持为 Python list，不随batch拷贝到GPU，路由时也不需要同步。
+    packing 时一行由多个样本拼接而成，要求它们属于同一个adapter (按adapter分组组batch)。
+    """
+    # 同一adapter的行排在一起，AdapterRouter 按连续切片计算；原地排序，外层的 collate_with_index 读到的是同一顺序
+    examples.sort(key=lambda example: example["adapter_id"])
+    batch = collate_fn(examples)
+    adapter_ids = [example["adapter_id"] for example in examples]
+    num_rows = batch["input_ids"].shape[0]
+    if "segment_ids" in batch:
+        if len(set(adapter_ids)) > 1:
+            raise ValueError("packing 的一行中包含多个adapter的样本，需要使用 --adapter_routing round_robin")
+        adapter_ids = adapter_ids[:1] * num_rows
+    # collator 超出token预算时会截断行数，静态shape模式下补齐的行沿用最后一个adapter，不打断连续切片
+    batch["adapter_ids"] = adapter_ids[:num_rows] + adapter_ids[-1:] * (num_rows - len(adapter_ids))
+    return batch
+
+
+class AdapterRouter:
+    """
+    多adapter训练时为每个batch选择adapter，所有adapter共享同一个冻结的基座:
+    - batch 只属于一个adapter时，直接切换各 LoraLayer 的当前adapter，前向与单adapter训练完全相同
+    - 否则 LoraLayer 只计算基座，再由 forward hook 按adapter把连续的行切片，分别加上各自的 LoRA 分支后拼接。
+      collate_with_adapter_ids 已把同一adapter的行排在一起，切片是view，没有 peft adapter_names 逐行索引的拷贝和散射，
+      adapter的计算顺序也是固定的 (peft 按 set 的顺序累加，结果随 PYTHONHASHSEED 变化)
+    路由保持到下一个batch，gradient checkpointing 在反向中重算前向时使用同一路由。
+    不使用 set_adapter: 它会把其余adapter的参数设为不可训练。只支持普通 LoRA (不支持 DoRA 等变体)。
+    """
+    def __init__(self, model, adapter_names):
+        from peft.tuners.lora import LoraLayer
+        self.adapter_names = list(adapter_names)
+        self.layers = [module for module in model.modules() if isinstance(module, LoraLayer)]
+        if any(layer.lora_variant for layer in self.layers):
+            raise ValueError("多adapter训练只支持普通 LoRA")
+        self.segments = None
+        for layer in self.layers:
+            layer.register_forward_hook(self._add_lora_segments)
+
+    def _add_lora_segments(self, module, args, output):
+        if self.segments is None:
+            return None
+        x = args[0]
+        outputs = []
+        for name, start, end in self.segments:
+            result = output[start:end]
+            if name in module.lora_A:
+                lora_A = module.lora_A[name]
+                sub_x = x[start:end].to(lora_A.weight.dtype)
+                # 与 peft 单adapter前向相同: 基座输出加上 LoRA 分支后转回基座的dtype
+                result = (result + module.lora_B[name](lora_A(module.lora_dropout[name](sub_x))) * module.scaling[name]).to(result.dtype)
+            outputs.append(result)
+        return torch.cat(outputs)
+
+    def route(self, adapter_ids):
+        segments = []
+        for adapter_id, rows in itertools.groupby(range(len(adapter_ids)), key=lambda row: adapter_ids[row]):
+            rows = list(rows)
+            segments.append((self.adapter_names[adapter_id], rows[0], rows[-1] + 1))
+        if len(segments) == 1:
+            self.segments = None
+            active_adapter = segments[0][0]
+        else:
+            # LoraLayer 没有当前adapter时只计算基座，LoRA 分支由 _add_lora_segments 按行切片加上
+            self.segments = segments
+            active_adapter = []
+        for layer in self.layers:
+            layer._active_adapter = active_adapter
+
+
+def _lora_input_width(config, module_name):
+    """LoRA 所在线性层的输入维度"""
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+    if module_name == "o_proj":
+        return config.num_attention_heads * head_dim
+    if module_name == "down_proj":
+        return config.intermediate_size
+    return config.hidden_size
+
+
+def layer_activation_bytes(config, lora_rank, lora_targets, lora_dropout=0.0, dtype_bytes=2, lora_dtype_bytes=4):
+    """
+    一个 decoder layer 在反向传播前为每个token保存的激活字节数 (Llama/Qwen2/Qwen3 结构, SDPA attention)。
+    RMSNorm 内部升到 fp32 计算，保存 fp32 输入；
+    LoRA 分支按 LoRA 权重的 dtype 计算 (peft 默认把 adapter 升到 fp32，DeepSpeed bf16 下会被转回 bf16)，
+    输入先转换成该 dtype，开启 dropout 时每个目标层额外保存 dropout 后的输入和 mask。
+    """
+    b, lb = dtype_bytes, lora_dtype_bytes
+    h, inter = config.hidden_size, config.intermediate_size
+    num_heads, num_kv_heads = config.num_attention_heads, config.num_key_value_heads
+    head_dim = getattr(config, "head_dim", None) or h // num_heads
+    q_width, kv_width = num_heads * head_dim, num_kv_heads * head_dim
+    # 两个 RMSNorm: fp32 输入 + 乘权重后的输出 (被后面的线性层保存)，权重不训练时不保存归一化结果
+    total = 2 * (4 + b) * h
+    if config.model_type == "qwen3":
+        # q_norm / k_norm 按 head_dim 归一化，输出经过 RoPE 后不再保存
+        total += 4 * (q_width + kv_width)
+    # 有 padding mask 时 SDPA 不走 GQA，保存 q、展开到 num_heads 的 k/v、输出和 logsumexp，o_proj 保存转置后的输出
+    total += b * 5 * q_width + 4 * num_heads
+    # MLP: gate 输出, act(gate), up 输出, act(gate) * up
+    total += 4 * b * inter
+    for name in lora_targets:
+        total += lb * lora_rank
+        if lora_dropout > 0:
+            total += (1 + lb) * _lora_input_width(config, name)
+        elif lb != b:
+            # 转换 dtype 后的输入被 lora_A 保存
+            total += lb * _lora_input_width(config, name)
+    return total
+
+
+def estimate_training_memory(config, num_tokens, num_params, num_trainable_params, lora_rank, lora_targets,
+                             lora_dropout=0.0, dtype_bytes=2, lora_dtype_bytes=4, gradient_checkpointing=True,
+                             label_only_loss=False, logit_fraction=1.0, loss_chunk_size=512, max_seq_len=None,
+                             optimizer_offload=False, num_replicas=1):
+    """
+    估算一个训练step的显存峰值，按组成部分返回字节数:
+      weights: 模型权重 (参数量 × dtype_bytes)
+      lora: LoRA 梯度，以及未 offload 时的 fp32 主权重和 Adam m/v (ZeRO 按 num_replicas 切分)
+      activations: 反向传播中激活的峰值，取两个阶段的较大值:
+        - 计算loss时: 所有层保存的激活 (gradient checkpointing 下只有每层输入) + logits、log_softmax 和它们的梯度
+        - 逐层反向时: gradient checkpointing 下为每层输入 + 重算的一层 + hidden_states 和 MLP 中间结果的梯度
+    num_tokens 是一个 micro batch 的 token 数 (行数 × padding 后长度)；
+    loss_chunk_size 是 label_only_loss 下一个 chunk 的 token 数 (行数 × chunk 位置数)。
+    """
+    b = dtype_bytes
+    h, inter, vocab = config.hidden_size, config.intermediate_size, config.vocab_size
+    num_layers = config.num_hidden_layers
+    layer_bytes = layer_activation_bytes(config, lora_rank, lora_targets, lora_dropout, dtype_bytes, lora_dtype_bytes)
+    saved = num_layers * b * h if gradient_checkpointing else num_layers * layer_bytes
+    # 有 padding 时 SDPA 使用 (行数, 1, L, L) 的 attention mask，所有层共用，每个token占 L 个元素
+    saved += b * min(num_tokens, max_seq_len or num_tokens)
+    loss_phase = num_tokens * (saved + (4 + 2 * b) * h)
+    if label_only_loss:
+        # 只保留 logit_fraction 比例位置的 hidden states 和它的梯度，lm_head 和交叉熵按 chunk 重算，
+        # 同时只存在一个 chunk 的 logits 和 log_softmax (_sum_cross_entropy 按 logits 的 dtype 计算)
+        logit_tokens = math.ceil(num_tokens * logit_fraction)
+        loss_phase += logit_tokens * 2 * b * h + min(logit_tokens, loss_chunk_size) * 2 * b * vocab
+    else:
+        loss_phase += num_tokens * 3 * b * vocab
+    layer_phase = num_tokens * (saved + (layer_bytes if gradient_checkpointing else 0) + b * (h + inter))
+    optimizer_bytes = 0 if optimizer_offload else (4 + 8) * num_trainable_params / num_replicas
+    components = {
+        "weights": b * num_params,
+        "lora": lora_dtype_bytes * num_trainable_params + optimizer_bytes,
+        "activations": max(loss_phase, layer_phase),
+    }
+    components["total"] = sum(components.values())
+    return components
+
+
+def find_token_budget(estimate_fn, memory_limit, granularity=1024, max_tokens=1 << 22):
+    """
+    二分查找 estimate_fn(num_tokens)["total"] <= memory_limit 的最大 token 数 (granularity 的整数倍)。
+    找不到满足条件的预算时返回 0。
+    """
+    low, high = 0, max_tokens // granularity
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_fn(mid * granularity)["total"] <= memory_limit:
+            low = mid
+        else:
+            high = mid - 1
+    return low * granularity
+
+
+def probe_step_memory(model, num_tokens, max_seq_len, logit_fraction=1.0, label_only_loss=False, loss_chunk_size=512):
+    """
+    用随机数据在GPU上跑一次 forward/backward，返回 torch.cuda.max_memory_allocated。
+    第一行做左padding，保证与真实batch一样走带 mask 的 SDPA；label 放在每行末尾 logit_fraction 的位置。
+    """
+    seq_len = max(1, min(num_tokens, max_seq_len or num_tokens))
+    rows = max(1, num_tokens // seq_len)
+    device = torch.device("cuda", torch.cuda.current_device())
+    model.to(device)
+    input_ids = torch.randint(0, model.config.vocab_size, (rows, seq_len), device=device)
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[0, : seq_len // 4] = 0
+    labels = input_ids.clone()
+    labels[:, : seq_len - max(1, int(seq_len * logit_fraction))] = -100
+    model.zero_grad(set_to_none=True)
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    if label_only_loss:
+        with label_hidden_states(model) as lm_head:
+            outputs = model(input_ids=input_ids, attention_mask=attention_mask, logits_to_keep=label_logit_positions(labels))
+        loss = label_only_compute_loss_func(outputs, labels, None, chunk_size=loss_chunk_size, lm_head=lm_head)
+    else:
+        outputs = model(input_ids=input_ids, attention_mask=attention_mask)
+        loss = default_compute_loss_func(outputs, labels, None)
+    del outputs
+    loss.backward()
+    peak = torch.cuda.max_memory_allocated(device)
+    del loss
+    model.zero_grad(set_to_none=True)
+    torch.cuda.empty_cache()
+    return peak
+
+
+def select_token_budget(model, args, accelerator, train_dataset, memory_limit, probe=False, granularity=1024):
+    """
+    按显存上限自动选择 total_max_length (单个batch的token预算)。
+    先用 estimate_training_memory 二分出最大预算；probe=True 时再用随机batch实测，
+    超出上限则按比例缩小后重测，多卡时取所有rank的最小值。
+    """
+    config = model.config
+    num_trainable, num_params = model.get_nb_trainable_parameters()
+    ds_plugin = accelerator.state.deepspeed_plugin
+    ds_config = ds_plugin.deepspeed_config if ds_plugin is not None else {}
+    zero_config = ds_config.get("zero_optimization", {})
+    offload_device = zero_config.get("offload_optimizer", {}).get("device", "none")
+    # DeepSpeed bf16 会把整个模型 (包括 LoRA) 转成 bf16，否则 peft 把 adapter 保持为 fp32
+    lora_dtype_bytes = 2 if ds_config.get("bf16", {}).get("enabled") else 4
+    max_seq_len = None
+    logit_fraction = 1.0
+    if not args.streaming:
+        if not args.packing:
+            max_seq_len = max(train_dataset["length"])
+        if args.label_only_loss:
+            # 需要计算logits的位置比例取抽样的95分位，左padding时答案对齐在末尾
+            sample = [train_dataset[i] for i in range(min(len(train_dataset), 2000))]
+            fractions = sorted((len(example["labels"]) + 1) / example["length"] for example in sample)
+            logit_fraction = fractions[int(0.95 * (len(fractions) - 1))] if fractions else 1.0
+    estimate_fn = partial(
+        estimate_training_memory,
+        config,
+        num_params=num_params,
+        num_trainable_params=num_trainable,
+        lora_rank=args.lora_rank,
+        lora_targets=args.lora_trainable.split(","),
+        lora_dropout=args.lora_dropout,
+        dtype_bytes=model.dtype.itemsize,
+        lora_dtype_bytes=lora_dtype_bytes,
+        gradient_checkpointing=True,
+        label_only_loss=args.label_only_loss,
+        logit_fraction=logit_fraction,
+        # loss_chunk_size 按位置计，每个位置最多 batch_size 行
+        loss_chunk_size=args.loss_chunk_size * args.batch_size,
+        max_seq_len=max_seq_len,
+        optimizer_offload=offload_device in ("cpu", "nvme"),
+        num_replicas=accelerator.num_processes if zero_config.get("stage", 0) >= 1 else 1,
+    )
+    budget = find_token_budget(lambda num_tokens: estimate_fn(num_tokens=num_tokens), memory_limit, granularity)
+    if budget == 0:
+        raise ValueError(f"显存上限 {memory_limit / 2**30:.1f}GB 不足以容纳 {granularity} 个token的batch")
+    estimate = estimate_fn(num_tokens=budget)
+    if accelerator.is_main_process:
+        parts = ", ".join(f"{name} {value / 2**30:.2f}GB" for name, value in estimate.items())
+        print(f"自动token预算: 估算 {budget // 1024}K tokens ({parts}), 显存上限 {memory_limit / 2**30:.2f}GB")
+    if probe:
+        optimizer_bytes = estimate["lora"] - lora_dtype_bytes * num_trainable
+        for _ in range(3):
+            peak = probe_step_memory(model, budget, max_seq_len, logit_fraction, args.label_only_loss, args.loss_chunk_size)
+            peak += optimizer_bytes
+            print(f"[rank {accelerator.process_index}] 实测 {budget // 1024}K tokens 峰值 {peak / 2**30:.2f}GB")
+            if peak <= memory_limit:
+                break
+            budget = int(budget * memory_limit / peak) // granularity * granularity
+            if budget == 0:
+                raise ValueError(f"实测显存超出上限 {memory_limit / 2**30:.1f}GB")
+        budget = min(gather_object([budget]))
+    return budget
+
+
+_dynamo_counters = None
+
+
+def compiled_graph_count():
+    """torch.compile 到目前为止编译出的图数，每次 (重新) 编译都会增加；计数器对象只在第一次调用时查找"""
+    global _dynamo_counters
+    if _dynamo_counters is None:
+        from torch._dynamo.utils import counters
+        _dynamo_counters = counters
+    return _dynamo_counters["stats"]["unique_graphs"]
+
+
+def compile_decoder_layers(model, num_graphs):
+    """
+    按层编译 (regional compilation): 每个 decoder layer 原地 compile(dynamic=False)，模块类型和参数名不变，
+    checkpoint 和 peft 保存都不受影响。所有层的代码相同，每种输入shape只编译一次，编译耗时与层数无关。
+    embedding、attention mask、lm_head (logits_to_keep 随数据变化) 留在 eager 中执行。
+    num_graphs: 预计的shape组合数，dynamo 对每段代码的重新编译次数有上限，超出后回退到 eager，这里在默认上限上再加上它。
+    """
+    from transformers.modeling_layers import GradientCheckpointingLayer
+    layers = [module for module in model.modules() if isinstance(module, GradientCheckpointingLayer)]
+    if not layers:
+        raise ValueError(f"{type(model).__name__} 中没有找到 decoder layer，不支持 --compile_model")
+    torch._dynamo.config.cache_size_limit += num_graphs
+    torch._dynamo.config.accumulated_cache_size_limit = max(torch._dynamo.config.accumulated_cache_size_limit,
+                                                           torch._dynamo.config.cache_size_limit)
+    for layer in layers:
+        layer.compile(dynamic=False)
+    return len(layers)
+
+
+class StepTimingCallback(TrainerCallback):
+    """
+    记录每个优化步的耗时拆分和吞吐，写入 jsonl 文件，并在logging步把区间均值交给 Trainer.log 上报到 report_to。
+    - data_wait: 从 dataloader 取batch的耗时 (CPU墙钟)
+    - forward / backward / optimizer: GPU上用 cuda event 计时，只在logging步同步一次，不阻塞每一步
+    - step_time: 相邻两步结束之间的墙钟时间；tokens_per_sec 为本rank的非padding token数 / step_time
+    - padding_fraction: padding token 占比；peak_memory_gb: 本步显存峰值 (CPU上为进程RSS峰值)
+    - checkpoint_time: 保存checkpoint的耗时，单独写一条记录
+    - shape: 本步batch的 input_ids shape；graphs_compiled: 本步 torch.compile 新编译的图数，
+      只在 count_graphs=True (开启了编译) 时统计，否则为None，每步不查询 dynamo 的计数器
+    forward / backward / data_wait 的计时点由 CustomTrainer 调用 start_step / time_forward / time_train_step 打上。
+    shape_summary: 静态shape模式下按shape汇总步数、编译次数和耗时 (含编译的步与之后的步分开统计)，训练结束时打印并写入文件。
+    """
+    def __init__(self, output_file, shape_summary=False, count_graphs=False):
+        self.output_file = output_file
+        self.shape_summary = shape_summary
+        self.count_graphs = count_graphs
+        self.shape_stats = {}
+        self.use_cuda = torch.cuda.is_available()
+        self.current = None
+        self.pending = []
+        self.summary = None
+        self.last_step_end = None
+        self.last_phase_end = None
+
+    def _mark(self):
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _elapsed(self, start, end):
+        if self.use_cuda:
+            return start.elapsed_time(end) / 1000
+        return end - start
+
+    def start_step(self, data_wait, batch_samples):
+        tokens = 0
+        total_tokens = 0
+        for batch in batch_samples:
+            input_ids = batch["input_ids"]
+            total_tokens += input_ids.numel()
+            # 保持为tensor累加，避免每步 .item() 同步
+            if "attention_mask" in batch:
+                tokens = tokens + batch["attention_mask"].sum()
+            elif "segment_ids" in batch:
+                tokens = tokens + (batch["segment_ids"] > 0).sum()
+            else:
+                tokens = tokens + input_ids.numel()
+        self.current = {"data_wait": data_wait, "tokens": tokens, "total_tokens": total_tokens, "forward": [], "train_step": [],
+                        "shape": ",".join("x".join(map(str, batch["input_ids"].shape)) for batch in batch_samples),
+                        "graphs_before": compiled_graph_count() if self.count_graphs else None}
+
+    def time_forward(self, fn):
+        start = self._mark()
+        result = fn()
+        if self.current is not None:
+            self.current["forward"].append((start, self._mark()))
+        return result
+
+    def time_train_step(self, fn):
+        start = self._mark()
+        result = fn()
+        if self.current is not None:
+            self.current["train_step"].append((start, self._mark()))
+        return result
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        if self.current is not None:
+            self.current["optimizer_end"] = self._mark()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        now = time.perf_counter()
+        if self.current is not None and self.current["train_step"]:
+            self.current["step"] = state.global_step
+            self.current["step_time"] = now - self.last_step_end if self.last_step_end is not None else None
+            graphs_before = self.current.pop("graphs_before")
+            self.current["graphs_compiled"] = compiled_graph_count() - graphs_before if self.count_graphs else None
+            if self.use_cuda:
+                self.current["peak_memory_gb"] = torch.cuda.max_memory_allocated() / 1024**3
+                torch.cuda.reset_peak_memory_stats()
+            else:
+                self.current["peak_memory_gb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2
+            self.pending.append(self.current)
+        self.current = None
+        self.last_step_end = now
+        # DefaultFlowCallback 先于本回调执行，should_log 已经确定
+        if control.should_log or control.should_training_stop:
+            self._flush(state)
+        self.last_phase_end = time.perf_counter()
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self.last_phase_end = time.perf_counter()
+
+    def on_save(self, args, state, control, **kwargs):
+        if self.last_phase_end is not None:
+            self._write([{"step": state.global_step, "checkpoint_time": time.perf_counter() - self.last_phase_end}], state)
+        # 保存和评估的耗时不计入下一步的 step_time
+        self.last_step_end = time.perf_counter()
+
+    def _flush(self, state):
+        if not self.pending:
+            return
+        if self.use_cuda:
+            self.pending[-1]["optimizer_end"].synchronize()
+        records = []
+        for step in self.pending:
+            forward = sum(self._elapsed(start, end) for start, end in step["forward"])
+            train_step = sum(self._elapsed(start, end) for start, end in step["train_step"])
+            tokens = int(step["tokens"])
+            record = {
+                "step": step["step"],
+                "data_wait": step["data_wait"],
+                "forward": forward,
+                "backward": train_step - forward,
+                "optimizer": self._elapsed(step["train_step"][-1][1], step["optimizer_end"]),
+                "step_time": step["step_time"],
+                "tokens": tokens,
+                "padding_fraction": 1 - tokens / max(step["total_tokens"], 1),
+                "tokens_per_sec": tokens / step["step_time"] if step["step_time"] else None,
+                "peak_memory_gb": step["peak_memory_gb"],
+                "shape": step["shape"],
+                "graphs_compiled": step["graphs_compiled"],
+            }
+            records.append(record)
+            if self.shape_summary:
+                self._update_shape_stats(record)
+        self.pending = []
+        self._write(records, state)
+        summary = {}
+        for key in ("data_wait", "forward", "backward", "optimizer", "step_time", "padding_fraction", "tokens_per_sec"):
+            values = [record[key] for record in records if record[key] is not None]
+            if values:
+                summary[f"timing/{key}"] = sum(values) / len(values)
+        summary["timing/peak_memory_gb"] = max(record["peak_memory_gb"] for record in records)
+        if self.count_graphs:
+            summary["timing/graphs_compiled"] = compiled_graph_count()
+        self.summary = summary
+
+    def _update_shape_stats(self, record):
+        stats = self.shape_stats.setdefault(record["shape"], {
+            "steps": 0, "compile_steps": 0, "graphs_compiled": 0, "compile_step_time": 0.0, "step_time": 0.0, "timed_steps": 0})
+        stats["steps"] += 1
+        # 编译发生在 forward / backward 中，按两者之和统计；step_time 在第一步为None，且包含数据等待
+        compute_time = record["forward"] + record["backward"]
+        if record["graphs_compiled"]:
+            stats["compile_steps"] += 1
+            stats["graphs_compiled"] += record["graphs_compiled"]
+            stats["compile_step_time"] += compute_time
+        else:
+            stats["timed_steps"] += 1
+            stats["step_time"] += compute_time
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self._flush(state)
+        if not self.shape_summary or not self.shape_stats:
+            return
+        buckets = {}
+        for shape, stats in sorted(self.shape_stats.items(), key=lambda item: -item[1]["steps"]):
+            buckets[shape] = {
+                "steps": stats["steps"],
+                "compile_steps": stats["compile_steps"],
+                "graphs_compiled": stats["graphs_compiled"],
+                "compile_step_time": stats["compile_step_time"] / stats["compile_steps"] if stats["compile_steps"] else None,
+                "step_time": stats["step_time"] / stats["timed_steps"] if stats["timed_steps"] else None,
+            }
+        graphs_compiled = compiled_graph_count() if self.count_graphs else None
+        self._write([{"step": state.global_step, "graphs_compiled": graphs_compiled, "shape_buckets": buckets}], state)
+        if not state.is_world_process_zero:
+            return
+        compiled = f", 共编译 {graphs_compiled} 个图" if self.count_graphs else ""
+        print(f"按shape统计 ({len(buckets)} 种shape{compiled}, forward+backward 耗时):")
+        for shape, bucket in buckets.items():
+            step_time = f"{bucket['step_time']:.3f}s" if bucket["step_time"] is not None else "-"
+            if bucket["compile_steps"]:
+                print(f"  {shape}: {bucket['steps']} 步, 编译 {bucket['graphs_compiled']} 个图 "
+                      f"(含编译的步 {bucket['compile_step_time']:.3f}s), 其余每步 {step_time}")
+            else:
+                print(f"  {shape}: {bucket['steps']} 步, 每步 {step_time}")
+
+    def _write(self, records, state):
+        if not state.is_world_process_zero:
+            return
+        os.makedirs(os.path.dirname(self.output_file) or ".", exist_ok=True)
+        with open(self.output_file, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+    def pop_summary(self):
+        summary, self.summary = self.summary, None
+        return summary
+
+
+LATEST_CHECKPOINT_MARKER = "latest_checkpoint"
+
+
+def publish_latest_checkpoint(run_dir, checkpoint_dir):
+    """原子地更新 run_dir/latest_checkpoint，内容为最近一个完整写完的checkpoint的绝对路径"""
+    marker = os.path.join(run_dir, LATEST_CHECKPOINT_MARKER)
+    tmp_marker = f"{marker}.tmp-{os.getpid()}"
+    with open(tmp_marker, "w", encoding="utf-8") as f:
+        f.write(os.path.abspath(checkpoint_dir) + "\n")
+    os.replace(tmp_marker, marker)
+
+
+def resolve_resume_checkpoint(output_dir, resume_from_checkpoint):
+    """latest: 读取 output_dir/latest_checkpoint 完成标记，没有标记时退回到步数最大的 checkpoint-*"""
+    if resume_from_checkpoint != "latest":
+        return resume_from_checkpoint
+    marker = os.path.join(output_dir, LATEST_CHECKPOINT_MARKER)
+    if os.path.isfile(marker):
+        with open(marker, encoding="utf-8") as f:
+            return f.read().strip()
+    from transformers.trainer_utils import get_last_checkpoint
+    return get_last_checkpoint(output_dir) if os.path.isdir(output_dir) else None
+
+
+def is_async_checkpoint(checkpoint_dir):
+    return os.path.isfile(os.path.join(checkpoint_dir, "optimizer_rank0.pt"))
+
+
+def adapter_checkpoint_dir(checkpoint_dir, adapter_name):
+    """与 peft 的 save_pretrained 一致: default adapter 在根目录，其余adapter在同名子目录"""
+    return checkpoint_dir if adapter_name == "default" else os.path.join(checkpoint_dir, adapter_name)
+
+
+def _skip_deepspeed_load_checkpoint(*args, **kwargs):
+    """异步checkpoint没有DeepSpeed引擎目录，状态由 CustomTrainer._load_optimizer_and_scheduler 恢复"""
+
+
+def snapshot_to_cpu(obj):
+    """递归地把 state_dict 中的tensor拷贝到CPU内存，得到与训练中被原地更新的状态解耦的快照"""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+class AsyncCheckpointWriter:
+    """
+    后台线程写checkpoint: 训练线程只负责把状态快照到内存并入队，写盘、完成标记和轮转都在后台进行。
+    - 每个rank写自己的文件，最后留下 .done-rank{r} 标记
+    - 主进程等所有rank的标记都出现后写 .complete，再原子地更新 latest_checkpoint，
+      然后按 save_total_limit 删除更早的checkpoint (保留 best_model_checkpoint)
+    - 队列最多积压 max_pending 个checkpoint，写盘跟不上时 submit 会阻塞，避免快照占满内存
+    所有rank需要能看到同一个 output_dir (单机或共享存储)。
+    """
+    def __init__(self, run_dir, rank=0, world_size=1, is_main=True, save_total_limit=None, max_pending=1, rank_timeout=1800):
+        self.run_dir = run_dir
+        self.rank = rank
+        self.world_size = world_size
+        self.is_main = is_main
+        self.save_total_limit = save_total_limit
+        self.rank_timeout = rank_timeout
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="async-checkpoint-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, checkpoint_dir, files, keep=None):
+        """files: 文件名 -> 内容 (dict[str, Tensor] 写为 safetensors，str 写为文本，其余用 torch.save)"""
+        if self.error is not None:
+            raise RuntimeError("后台写checkpoint失败") from self.error
+        self.queue.put((checkpoint_dir, files, keep))
+
+    def wait(self):
+        self.queue.join()
+        if self.error is not None:
+            raise RuntimeError("后台写checkpoint失败") from self.error
+
+    def _run(self):
+        while True:
+            checkpoint_dir, files, keep = self.queue.get()
+            try:
+                start = time.perf_counter()
+                self._write(checkpoint_dir, files)
+                if self.is_main:
+                    if self._wait_for_ranks(checkpoint_dir):
+                        open(os.path.join(checkpoint_dir, ".complete"), "w").close()
+                        publish_latest_checkpoint(self.run_dir, checkpoint_dir)
+                        self._rotate(checkpoint_dir, keep)
+                    print(f"后台写checkpoint完成: {checkpoint_dir} ({time.perf_counter() - start:.1f}s)")
+            except Exception as e:
+                self.error = e
+                print(f"后台写checkpoint失败: {checkpoint_dir}: {e!r}")
+            finally:
+                self.queue.task_done()
+
+    def _write(self, checkpoint_dir, files):
+        from safetensors.torch import save_file
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        for name, content in files.items():
+            path = os.path.join(checkpoint_dir, name)
+            tmp_path = f"{path}.tmp-rank{self.rank}"
+            if isinstance(content, str):
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(content)
+            elif name.endswith(".safetensors"):
+                save_file(content, tmp_path, metadata={"format": "pt"})
+            else:
+                torch.save(content, tmp_path)
+            os.replace(tmp_path, path)
+        open(os.path.join(checkpoint_dir, f".done-rank{self.rank}"), "w").close()
+
+    def _wait_for_ranks(self, checkpoint_dir):
+        deadline = time.monotonic() + self.rank_timeout
+        markers = [os.path.join(checkpoint_dir, f".done-rank{rank}") for rank in range(self.world_size)]
+        while not all(os.path.exists(marker) for marker in markers):
+            if time.monotonic() > deadline:
+                print(f"等待其他rank写完 {checkpoint_dir} 超时，不更新 {LATEST_CHECKPOINT_MARKER}")
+                return False
+            time.sleep(0.5)
+        return True
+
+    def _rotate(self, latest_dir, keep):
+        if not self.save_total_limit:
+            return
+        def step_of(path):
+            return int(path.rsplit("-", 1)[-1])
+        checkpoints = sorted(
+            (path for path in glob.glob(os.path.join(self.run_dir, f"{PREFIX_CHECKPOINT_DIR}-*"))
+             if os.path.isdir(path) and path.rsplit("-", 1)[-1].isdigit() and step_of(path) <= step_of(latest_dir)),
+            key=step_of,
+        )
+        keep_paths = {os.path.abspath(latest_dir)} | ({os.path.abspath(keep)} if keep else set())
+        removable = [path for path in checkpoints if os.path.abspath(path) not in keep_paths]
+        num_to_remove = max(0, len(checkpoints) - self.save_total_limit)
+        for path in removable[:num_to_remove]:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class StartupTimer(TrainerCallback):
+    """
+    记录启动各阶段耗时 (从进程启动开始)，第一个训练步结束时在主进程打印报告，即 time-to-first-step。
+    main() 中每个阶段结束时调用 mark(阶段名)。
+    """
+    def __init__(self, start_time=_START_TIME):
+        self.start_time = start_time
+        self.last = start_time
+        self.phases = []
+        self.reported = False
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.mark("训练初始化")
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self.reported:
+            return
+        self.reported = True
+        self.mark("第一个训练步")
+        if state.is_world_process_zero:
+            print(f"启动耗时 (time-to-first-step {self.last - self.start_time:.1f}s):")
+            for name, elapsed in self.phases:
+                print(f"  {name}: {elapsed:.2f}s")
+
+
+class CustomTrainer(Trainer):
+    """
+    在 HF Trainer 的基础上支持自定义 batch_sampler。
+    token_budget_batching: 训练集和验证集都按token预算组batch，替代 collator 里的截断。
+    group_by_length: 按长度分桶组batch（训练集 megabatch 内排序，验证集整体按长度排序），减少padding。
+    packing: 按token预算把多个样本拼接成一行，需配合 packing_data_collator 使用。
+    label_only_logits: 只对有label的位置计算logits: 模型输出这些位置的 hidden states，由 label_only_compute_loss_func /
+        weighted_compute_loss_func 按chunk经过 lm_head，需配合这两个loss函数使用。
+    训练集为 JsonlStreamingDataset 时使用流式 DataLoader，在 streaming_num_workers 个 worker 中读取并 tokenize。
+    step_timer: StepTimingCallback，记录每步的 data_wait / forward / backward 耗时。
+    checkpoint_writer: AsyncCheckpointWriter，只保存LoRA权重和训练状态，由后台线程写盘；为None时使用 Trainer 的同步保存。
+    resume_from_checkpoint 支持两种checkpoint格式；流式训练额外保存数据游标，恢复时直接定位而不重放数据。
+    loss_tracker: ExampleLossTracker，训练集按token预算组batch，记录每条样本的loss并跳过已学会的样本。
+    adapter_router: AdapterRouter，多adapter训练时按batch中的 adapter_ids 路由；
+        adapter_routing 为 round_robin 时每个batch只含一个adapter的样本，同一个优化器step里所有rank训练同一个adapter，
+        各adapter按step轮流；为 mixed 时batch内按行混合。只支持DDP，不支持DeepSpeed。
+        checkpoint 按 save_pretrained 的目录结构保存所有adapter，恢复和加载最优checkpoint时全部加载。
+    shape_bucket_size: 静态shape模式，组batch时按 bucket_length 取整后的长度计算预算，需配合同样设置的 collator 使用。
+    sampler_data_collator: 按 batch_sampler 组batch时使用的 collator (不做旧的截断)，为None时使用 data_collator。
+    """
+    def __init__(self, *args, total_max_length=None, token_budget_batching=False, group_by_length=False,
+                 megabatch_size=None, shuffle_seed=42, packing=False, streaming_num_workers=0, label_only_logits=False,
+                 step_timer=None, checkpoint_writer=None, loss_tracker=None, adapter_router=None, adapter_routing="mixed",
+                 shape_bucket_size=None, sampler_data_collator=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sampler_data_collator = sampler_data_collator
+        self.shape_bucket_size = shape_bucket_size
+        self.adapter_router = adapter_router
+        self.adapter_routing = adapter_routing
+        self.checkpoint_writer = checkpoint_writer
+        self.loss_tracker = loss_tracker
+        if loss_tracker is not None:
+            self.add_callback(loss_tracker)
+        self.streaming_dataloader = None
+        self.pending_data_cursor = None
+        # loss-aware 恢复训练时 (epoch, 该epoch内已完成的优化器步数, global_step)
+        self.loss_resume_position = None
+        self.step_timer = step_timer
+        if step_timer is not None:
+            self.add_callback(step_timer)
+        self.label_only_logits = label_only_logits
+        self.streaming_num_workers = streaming_num_workers
+        self.total_max_length = total_max_length
+        self.token_budget_batching = token_budget_batching
+        self.group_by_length = group_by_length
+        self.packing = packing
+        self.megabatch_size = megabatch_size
+        self.shuffle_seed = shuffle_seed
+
+    @property
+    def use_batch_sampler(self):
+        return self.token_budget_batching or self.group_by_length or self.packing or self.round_robin
+
+    @property
+    def round_robin(self):
+        return self.adapter_router is not None and self.adapter_routing == "round_robin"
+
+    def _create_batch_sampler(self, dataset, batch_size, shuffle, num_epochs=1, loss_tracker=None):
+        batch_sampler = TokenBudgetBatchSampler(
+            dataset["length"],
+            self.total_max_length,
+            shuffle=shuffle,
+            seed=self.shuffle_seed,
+            num_replicas=self.args.world_size,
+            num_epochs=num_epochs,
+            # 仅分桶时保留原来的batch行数上限
+            max_batch_size=None if self.token_budget_batching or self.packing else batch_size,
+            group_by_length=self.group_by_length,
+            megabatch_size=self.megabatch_size,
+            packing=self.packing,
+            loss_tracker=loss_tracker,
+            groups=dataset["adapter_id"] if self.round_robin else None,
+            gradient_accumulation_steps=self.args.gradient_accumulation_steps,
+            shape_bucket_size=self.shape_bucket_size,
+        )
+        over_budget = batch_sampler.over_budget_lengths()
+        if over_budget and self.is_world_process_zero():
+            print(f"⚠️  {len(over_budget)} 条样本单条超过 total_max_length={self.total_max_length} (最长 {max(over_budget)})，"
+                  f"将各自单独成batch且不截断label，这些step的显存占用会超出预算")
+        return batch_sampler
+
+    def _log_padding_ratio(self, batch_sampler, description):
+        if not self.group_by_length or not self.is_world_process_zero():
+            return
+        baseline = TokenBudgetBatchSampler(
+            batch_sampler.lengths,
+            batch_sampler.total_max_length,
+            shuffle=batch_sampler.shuffle,
+            seed=batch_sampler.seed,
+            max_batch_size=batch_sampler.max_batch_size,
+            packing=batch_sampler.packing,
+            shape_bucket_size=batch_sampler.shape_bucket_size,
+        )
+        print(f"[{description}] 按长度分桶 padding 比例: {batch_sampler.padding_ratio():.2%} "
+              f"(不分桶: {baseline.padding_ratio():.2%})")
+
+    def _build_batch_sampler_dataloader(self, dataset, batch_sampler, collate_fn=None):
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=collate_fn or self.sampler_data_collator or self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            prefetch_factor=self.args.dataloader_prefetch_factor,
+            # batch_sampler 在主进程中，set_epoch 对常驻 worker 同样生效
+            persistent_workers=self.args.dataloader_persistent_workers,
+        )
+        # batch_size为None时 accelerate 按batch轮转分片，batch数已补齐到进程数的整数倍，不会重复或丢弃
+        dataloader = self.accelerator.prepare(dataloader)
+        if getattr(dataloader.batch_sampler, "batch_sampler", None) is batch_sampler:
+            # 多进程时外层的 BatchSamplerShard 不会把 set_epoch 转发给自定义的 batch_sampler，否则每个epoch顺序相同
+            dataloader.batch_sampler.set_epoch = batch_sampler.set_epoch
+        return dataloader
+
+    def _save_checkpoint(self, model, trial):
+        run_dir = self._get_output_dir(trial=trial)
+        checkpoint_dir = os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}")
+        if self.checkpoint_writer is None:
+            super()._save_checkpoint(model, trial)
+            data_cursor = self._data_cursor_file()
+            if data_cursor is not None:
+                with open(os.path.join(checkpoint_dir, data_cursor[0]), "w", encoding="utf-8") as f:
+                    f.write(data_cursor[1])
+            loss_stats = self._loss_tracker_file()
+            if loss_stats is not None:
+                torch.save(loss_stats[1], os.path.join(checkpoint_dir, loss_stats[0]))
+            # 所有rank都写完后再发布完成标记
+            self.accelerator.wait_for_everyone()
+            if self.args.should_save:
+                publish_latest_checkpoint(run_dir, checkpoint_dir)
+            return
+        self._save_checkpoint_async(run_dir, checkpoint_dir)
+
+    def _save_checkpoint_async(self, run_dir, checkpoint_dir):
+        from peft import get_peft_model_state_dict
+        self.store_flos()
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        if self.state.best_global_step:
+            # checkpoint目录在入队前同步创建，文件可能仍在后台写入，训练结束加载前会等待写完
+            best_checkpoint_dir = os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{self.state.best_global_step}")
+            if os.path.isdir(best_checkpoint_dir):
+                self.state.best_model_checkpoint = best_checkpoint_dir
+        # RNG 状态很小，直接同步写
+        self._save_rng_state(checkpoint_dir)
+        files = {f"optimizer_rank{self.args.process_index}.pt": snapshot_to_cpu(self.optimizer.state_dict())}
+        data_cursor = self._data_cursor_file()
+        if data_cursor is not None:
+            files[data_cursor[0]] = data_cursor[1]
+        loss_stats = self._loss_tracker_file()
+        if loss_stats is not None:
+            files[loss_stats[0]] = loss_stats[1]
+        if self.args.should_save:
+            unwrapped_model = self.accelerator.unwrap_model(self.model)
+            for name, peft_config in unwrapped_model.peft_config.items():
+                peft_config.save_pretrained(adapter_checkpoint_dir(checkpoint_dir, name))
+                state_dict = snapshot_to_cpu(get_peft_model_state_dict(unwrapped_model, adapter_name=name))
+                files[os.path.relpath(os.path.join(adapter_checkpoint_dir(checkpoint_dir, name), "adapter_model.safetensors"),
+                                      checkpoint_dir)] = {key: value.contiguous() for key, value in state_dict.items()}
+            files["scheduler.pt"] = snapshot_to_cpu(self.lr_scheduler.state_dict())
+            for cb in [cb for cb in self.callback_handler.callbacks + [self.control] if isinstance(cb, ExportableState)]:
+                cb_name = cb.__class__.__name__
+                if isinstance(self.state.stateful_callbacks[cb_name], list):
+                    self.state.stateful_callbacks[cb_name].append(cb.state())
+                else:
+                    self.state.stateful_callbacks[cb_name] = cb.state()
+            files["trainer_state.json"] = json.dumps(dataclasses.asdict(self.state), indent=2, sort_keys=True) + "\n"
+        self.checkpoint_writer.submit(checkpoint_dir, files, keep=self.state.best_model_checkpoint)
+
+    def _data_cursor_file(self):
+        """流式训练时每个rank保存自己的数据游标 (文件名, 内容)"""
+        if self.streaming_dataloader is None:
+            return None
+        return f"data_cursor_rank{self.args.process_index}.json", json.dumps(self.streaming_dataloader.state_dict())
+
+    def _loss_tracker_file(self):
+        """汇总所有rank当前epoch的样本loss，由主进程保存 (文件名, 内容)；需要所有rank一起调用"""
+        if self.loss_tracker is None:
+            return None
+        records = self.loss_tracker.gather_records()
+        if not self.args.should_save:
+            return None
+        return "example_losses.pt", self.loss_tracker.state_dict(records)
+
+    def _restore_loss_tracker(self, checkpoint_dir):
+        """
+        恢复样本loss记录，并按各epoch的batch数定位 global_step 所在的epoch和epoch内的位置；
+        各epoch步数不同，Trainer 按固定步数的跳过逻辑不适用，改由 sampler 跳过已训练的batch。
+        """
+        path = os.path.join(checkpoint_dir, "example_losses.pt")
+        if self.loss_tracker is None or not os.path.isfile(path):
+            return
+        self.loss_tracker.load_state_dict(torch.load(path, weights_only=False))
+        with open(os.path.join(checkpoint_dir, "trainer_state.json"), encoding="utf-8") as f:
+            global_step = json.load(f)["global_step"]
+        epoch, steps = self.loss_tracker.resume_position(global_step, self.args.world_size, self.args.gradient_accumulation_steps)
+        self.loss_resume_position = (epoch, steps, global_step)
+        self.args.ignore_data_skip = True
+
+    def set_initial_training_values(self, args, dataloader, total_train_batch_size):
+        values = super().set_initial_training_values(args, dataloader, total_train_batch_size)
+        if self.loss_resume_position is None:
+            return values
+        # Trainer 按 global_step // num_update_steps_per_epoch 确定从哪个epoch继续，loss-aware 时各epoch步数不同，
+        # 这里改为使商正好等于恢复的epoch的值 (max_steps 已按原值算好，之后由 ExampleLossTracker 更新)
+        epoch, _, global_step = self.loss_resume_position
+        self.loss_resume_position = None
+        num_update_steps_per_epoch = global_step // epoch if epoch > 0 else global_step + 1
+        if num_update_steps_per_epoch == 0 or global_step // num_update_steps_per_epoch != epoch:
+            raise ValueError(f"无法从 global_step={global_step} 恢复到第 {epoch} 个epoch: 之前每个epoch的平均步数少于epoch数")
+        return (values[0], num_update_steps_per_epoch) + tuple(values[2:])
+
+    def _restore_data_cursor(self, checkpoint_dir):
+        """
+        流式数据集从checkpoint里的游标继续，并关闭 Trainer 逐batch重放的跳过逻辑。
+        map-style 数据集的 sampler 由 (seed, epoch) 确定，Trainer 只跳过 batch 下标，不会读取数据，保持默认行为。
+        """
+        if not isinstance(self.train_dataset, JsonlStreamingDataset):
+            return
+        cursor_file = os.path.join(checkpoint_dir, f"data_cursor_rank{self.args.process_index}.json")
+        if not os.path.isfile(cursor_file):
+            print(f"{checkpoint_dir} 中没有数据游标，将逐batch跳过已训练的数据")
+            return
+        with open(cursor_file, encoding="utf-8") as f:
+            state = json.load(f)
+        num_shards = self.args.world_size * max(1, self.streaming_num_workers)
+        if state["num_shards"] != num_shards:
+            print(f"数据分片数与checkpoint不一致 ({state['num_shards']} != {num_shards})，将逐batch跳过已训练的数据")
+            return
+        self.pending_data_cursor = state
+        self.args.ignore_data_skip = True
+
+    def _load_optimizer_and_scheduler(self, checkpoint):
+        if checkpoint is None or not is_async_checkpoint(checkpoint):
+            return super()._load_optimizer_and_scheduler(checkpoint)
+        optimizer_state = torch.load(
+            os.path.join(checkpoint, f"optimizer_rank{self.args.process_index}.pt"), map_location="cpu", weights_only=False
+        )
+        if self.is_deepspeed_enabled:
+            # DeepSpeed 不经过 Trainer._load_from_checkpoint，这里加载adapter；ZeRO 优化器按 dp rank 从列表中取本rank的分片
+            self._load_adapters(checkpoint)
+            rank_states = [None] * self.args.world_size
+            rank_states[self.args.process_index] = optimizer_state
+            self.optimizer.optimizer.load_state_dict(rank_states, load_from_fp32_weights=True)
+        else:
+            self.optimizer.load_state_dict(optimizer_state)
+        self.lr_scheduler.load_state_dict(torch.load(os.path.join(checkpoint, "scheduler.pt"), weights_only=True))
+
+    def _load_adapters(self, checkpoint_dir, model=None):
+        """加载checkpoint中所有adapter的LoRA权重，目录结构与 save_pretrained 一致"""
+        from peft import set_peft_model_state_dict
+        from safetensors.torch import load_file
+        unwrapped_model = self.accelerator.unwrap_model(model if model is not None else self.model)
+        for name in unwrapped_model.peft_config:
+            adapter_path = os.path.join(adapter_checkpoint_dir(checkpoint_dir, name), "adapter_model.safetensors")
+            set_peft_model_state_dict(unwrapped_model, load_file(adapter_path), adapter_name=name)
+
+    def _load_from_checkpoint(self, resume_from_checkpoint, model=None):
+        if self.adapter_router is None:
+            return super()._load_from_checkpoint(resume_from_checkpoint, model)
+        # Trainer 只会把第一个adapter加载为可训练，多adapter时自行加载全部权重
+        self._load_adapters(resume_from_checkpoint, model)
+
+    def _load_best_model(self):
+        if self.checkpoint_writer is None and self.adapter_router is None:
+            return super()._load_best_model()
+        # 异步checkpoint只有LoRA权重，等待写完后直接加载adapter；Trainer 只会加载当前adapter，多adapter时同样自行加载
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait()
+        self.accelerator.wait_for_everyone()
+        self._load_adapters(self.state.best_model_checkpoint)
+        if self.args.should_save:
+            print(f"已加载最优checkpoint: {self.state.best_model_checkpoint} (score: {self.state.best_metric})")
+
+    def train(self, resume_from_checkpoint=None, *args, **kwargs):
+        import transformers.trainer as hf_trainer
+        deepspeed_load_checkpoint = hf_trainer.deepspeed_load_checkpoint
+        if resume_from_checkpoint is not None:
+            self._restore_data_cursor(resume_from_checkpoint)
+            self._restore_loss_tracker(resume_from_checkpoint)
+            if self.is_deepspeed_enabled and is_async_checkpoint(resume_from_checkpoint):
+                hf_trainer.deepspeed_load_checkpoint = _skip_deepspeed_load_checkpoint
+        try:
+            return super().train(resume_from_checkpoint, *args, **kwargs)
+        finally:
+            hf_trainer.deepspeed_load_checkpoint = deepspeed_load_checkpoint
+            if self.checkpoint_writer is not None:
+                self.checkpoint_writer.wait()
+
+    def evaluate(self, *args, **kwargs):
+        if isinstance(self.eval_dataset, LazyDataset):
+            self.eval_dataset = self.eval_dataset.load()
+        return super().evaluate(*args, **kwargs)
+
+    def get_batch_samples(self, epoch_iterator, num_batches, device):
+        start = time.perf_counter()
+        batch_samples, num_items_in_batch = super().get_batch_samples(epoch_iterator, num_batches, device)
+        if self.step_timer is not None and batch_samples:
+            self.step_timer.start_step(time.perf_counter() - start, batch_samples)
+        return batch_samples, num_items_in_batch
+
+    def training_step(self, model, inputs, num_items_in_batch=None):
+        if self.step_timer is None:
+            return super().training_step(model, inputs, num_items_in_batch)
+        return self.step_timer.time_train_step(lambda: super(CustomTrainer, self).training_step(model, inputs, num_items_in_batch))
+
+    def log(self, logs, *args, **kwargs):
+        if self.step_timer is not None and "loss" in logs:
+            logs.update(self.step_timer.pop_summary() or {})
+        if self.loss_tracker is not None and "loss" in logs:
+            logs["skipped_token_ratio"] = self.loss_tracker.skipped_token_ratio()
+        super().log(logs, *args, **kwargs)
+
+    def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        if self.step_timer is not None and model.training:
+            return self.step_timer.time_forward(lambda: self._compute_loss(model, inputs, return_outputs, num_items_in_batch))
+        return self._compute_loss(model, inputs, return_outputs, num_items_in_batch)
+
+    def _compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        adapter_ids = inputs.pop("adapter_ids", None)
+        if adapter_ids is not None:
+            self.adapter_router.route(adapter_ids)
+        example_index = inputs.pop("example_index", None)
+        if example_index is None or self.loss_tracker is None or not model.training:
+            return self._model_loss(model, inputs, return_outputs, num_items_in_batch)
+        # Trainer 会从 inputs 中取出 labels，先保留引用
+        labels, segment_ids = inputs["labels"], inputs.get("segment_ids")
+        loss, outputs = self._model_loss(model, inputs, True, num_items_in_batch)
+        # label_only_logits 时 outputs.logits 是label位置的 hidden states，同样按chunk经过 lm_head
+        lm_head = self.accelerator.unwrap_model(model).get_output_embeddings() if self.label_only_logits else None
+        # 静态shape模式下补齐的行在真实样本之后，不对应任何样本
+        self.loss_tracker.record(example_index, per_example_loss(outputs.logits, labels, segment_ids, lm_head=lm_head)[:len(example_index)])
+        return (loss, outputs) if return_outputs else loss
+
+    def _model_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        loss_kwargs = {key: inputs.pop(key) for key in ("segment_ids", "loss_weights") if key in inputs}
+        if self.label_only_logits and "labels" in inputs:
+            # 模型只输出有label位置的 hidden states，loss 函数按chunk经过 lm_head，不生成 (B, T, V) 或 (B, K, V) 的 logits
+            inputs = {**inputs, "logits_to_keep": label_logit_positions(inputs["labels"])}
+            with label_hidden_states(self.accelerator.unwrap_model(model)) as lm_head:
+                return self._trainer_loss(model, inputs, return_outputs, num_items_in_batch, {**loss_kwargs, "lm_head": lm_head})
+        return self._trainer_loss(model, inputs, return_outputs, num_items_in_batch, loss_kwargs)
+
+    def _trainer_loss(self, model, inputs, return_outputs, num_items_in_batch, loss_kwargs):
+        if not loss_kwargs or self.compute_loss_func is None:
+            return super().compute_loss(model, inputs, return_outputs=return_outputs, num_items_in_batch=num_items_in_batch)
+        # segment_ids / loss_weights / lm_head 不能传给模型，临时绑定到 compute_loss_func 上，其余逻辑沿用 Trainer.compute_loss
+        compute_loss_func = self.compute_loss_func
+        self.compute_loss_func = partial(compute_loss_func, **loss_kwargs)
+        try:
+            return super().compute_loss(model, inputs, return_outputs=return_outputs, num_items_in_batch=num_items_in_batch)
+        finally:
+            self.compute_loss_func = compute_loss_func
+
+    def get_train_dataloader(self):
+        if isinstance(self.train_dataset, JsonlStreamingDataset):
+            # 流式数据集自身已按 rank/worker 切分，不再经过 accelerate 的分片包装
+            self.streaming_dataloader = StreamingDataLoader(
+                self.train_dataset,
+                batch_size=self.args.per_device_train_batch_size,
+                collate_fn=self.data_collator,
+                num_workers=self.streaming_num_workers,
+                pin_memory=self.args.dataloader_pin_memory,
+                # 流式数据集的epoch保存在worker的副本中，不开启 persistent_workers
+                prefetch_factor=self.args.dataloader_prefetch_factor if self.streaming_num_workers > 0 else None,
+            )
+            if self.pending_data_cursor is not None:
+                self.streaming_dataloader.load_state_dict(self.pending_data_cursor)
+                self.pending_data_cursor = None
+            return self.streaming_dataloader
+        if not self.use_batch_sampler and self.loss_tracker is None:
+            return super().get_train_dataloader()
+        batch_sampler = self._create_batch_sampler(
+            self.train_dataset,
+            self.args.per_device_train_batch_size,
+            shuffle=True,
+            num_epochs=self.args.num_train_epochs,
+            loss_tracker=self.loss_tracker,
+        )
+        self._log_padding_ratio(batch_sampler, "train")
+        if self.loss_resume_position is not None:
+            epoch, steps, _ = self.loss_resume_position
+            batch_sampler.skip_batches(epoch, steps * self.args.gradient_accumulation_steps * self.args.world_size)
+        if self.loss_tracker is None:
+            return self._build_batch_sampler_dataloader(self.train_dataset, batch_sampler)
+        return self._build_batch_sampler_dataloader(
+            IndexedDataset(self.train_dataset), batch_sampler,
+            collate_fn=partial(collate_with_index, collate_fn=self.sampler_data_collator or self.data_collator))
+
+    def get_eval_dataloader(self, eval_dataset=None):
+        if not self.use_batch_sampler:
+            return super().get_eval_dataloader(eval_dataset)
+        eval_dataset = eval_dataset if eval_dataset is not None else self.eval_dataset
+        batch_sampler = self._create_batch_sampler(eval_dataset, self.args.per_device_eval_batch_size, shuffle=False)
+        self._log_padding_ratio(batch_sampler, "eval")
+        return self._build_batch_sampler_dataloader(eval_dataset, batch_sampler)
+
 def main():
+    startup_timer = StartupTimer()
+    startup_timer.mark("导入依赖")
     # 初始化 Accelerator
     accelerator = Accelerator()
-    
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--model_name", type=str, required=True)
-    parser.add_argument("--dataset_dir", type=str, required=True)
-    parser.add_argument("--dataset_eval_dir", type=str, required=True)
-    parser.add_argument("--total_max_length", type=int, default=1)
-    parser.add_argument("--batch_size", type=int, default=1)
-    parser.add_argument("--epochs", type=int, default=3)
-    parser.add_argument("--lora_rank",type=int, default=8)
-    parser.add_argument("--lora_alpha",type=int, default=32)
-    parser.add_argument("--lora_dropout",type=float, default=0.05)
-    parser.add_argument("--lora_trainable",type=str, default="q_proj,k_proj,v_proj,o_proj,gate_proj,up_proj,down_proj")
-    parser.add_argument("--lora_init_method",type=str, default=None)
-    parser.add_argument("--output_dir",type=str, default="output")
-    parser.add_argument("--shuffle_data", action="store_true", help="启用数据随机化")
-    parser.add_argument("--shuffle_seed", type=int, default=42, help="数据随机化种子")
-    parser.add_argument("--learning_rate", type=float, default=5e-5, help="学习率")
-    parser.add_argument("--save_steps", type=int, default=2000, help="保存步数")
-    parser.add_argument("--logging_steps", type=int, default=1, help="日志步数")
-    parser.add_argument("--eval_steps", type=int, default=2000, help="评估步数")
-    parser.add_argument("--save_total_limit", type=int, default=5, help="保存总限制")
-
-    args = parser.parse_args()
-    args.total_max_length = args.total_max_length*1024
-    print(args)
+    args = _CLI_ARGS if _CLI_ARGS is not None else parse_args()
+    adapters = None
+    if args.multi_adapter_config:
+        if accelerator.state.deepspeed_plugin is not None:
+            # 每步只有部分adapter参与前向，ddp_find_unused_parameters 只对DDP生效。ZeRO 下未使用参数的梯度归约未经验证，
+            # 而且 ZeRO 会给没有梯度的参数补零梯度，Adam 动量仍会更新不在当前step的adapter，因此要求用DDP启动
+            raise ValueError("--multi_adapter_config 不支持 DeepSpeed，请使用DDP的 accelerate 配置 (如 ddp_config.yaml)")
+        adapters = load_multi_adapter_config(args.multi_adapter_config, args)
+    # fast_start 下诊断信息只在主进程打印摘要
+    verbose = not args.fast_start
+    if verbose or accelerator.is_main_process:
+        print(args)
+    startup_timer.mark("初始化accelerator和参数")
     # 使用 Accelerator 兼容的模型加载设置
     model = AutoModelForCausalLM.from_pretrained(
         args.model_name, 
@@ -202,73 +2397,121 @@ def main():
     )
     model.train()
     model.config.use_cache = False
+    startup_timer.mark("加载模型")
     tokenizer = AutoTokenizer.from_pretrained(args.model_name)
     
     # 确保tokenizer有pad_token
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
-    jsonl_files = glob.glob(os.path.join(args.dataset_dir, "*.jsonl"))
-    print(jsonl_files)
-    ds = load_dataset("json", data_files=jsonl_files)['train']
-    
-    # 在数据集层面添加随机化
-    if args.shuffle_data:
-        print(f"启用数据随机化，种子: {args.shuffle_seed}")
-        # 方法1: 使用 shuffle 方法打乱数据集
-        ds = ds.shuffle(seed=args.shuffle_seed)  # 使用指定种子确保可重现性
-    
-    tokenized_ds = ds.map(partial(mapper_tokenize,tokenizer=tokenizer),batched=True,batch_size=args.batch_size,remove_columns=ds.column_names)
-    tokenized_ds = tokenized_ds.filter(lambda x: len(x['input_ids']) <= 2048)
-    
-
-    jsonl_files_eval = glob.glob(os.path.join(args.dataset_eval_dir, "*.jsonl"))
-    print(jsonl_files_eval)
-    ds_eval = load_dataset("json", data_files=jsonl_files_eval)['train']
-    tokenized_ds_eval = ds_eval.map(partial(mapper_tokenize,tokenizer=tokenizer),batched=True,batch_size=args.batch_size,remove_columns=ds_eval.column_names)
-    tokenized_ds_eval = tokenized_ds_eval.filter(lambda x: len(x['input_ids']) <= 2048)
-    print(tokenized_ds_eval)
-    print(tokenized_ds_eval[0])
-    print(tokenized_ds)
-    print(tokenized_ds[0])
-    print(tokenized_ds[1])
-    print(model)
-    print(tokenizer)
-    lora_config = LoraConfig(
-            r=args.lora_rank,
-            lora_alpha=args.lora_alpha,
-            lora_dropout=args.lora_dropout,
-            init_lora_weights=bool(args.lora_init_method) if args.lora_init_method == 'True' or args.lora_init_method == 'False' else args.lora_init_method,
-            target_modules=args.lora_trainable.split(","),
-            task_type="CAUSAL_LM",  # 明确指定任务类型
-            bias="none",  # 不训练bias
-        )
-    print(lora_config)
-    peft_model = get_peft_model(model, lora_config)
+    startup_timer.mark("加载tokenizer")
+    if adapters is None:
+        tokenized_ds, tokenized_ds_eval = prepare_datasets(tokenizer, args, accelerator, lazy_eval=args.fast_start)
+    else:
+        # 每个adapter的数据集单独tokenize (各自命中缓存)，再拼接成一个带 adapter_id 的数据集
+        adapter_datasets = [prepare_datasets(tokenizer, adapter_args, accelerator, lazy_eval=args.fast_start)
+                            for _, adapter_args in adapters]
+        tokenized_ds = MultiAdapterDataset([train_ds for train_ds, _ in adapter_datasets])
+        if args.fast_start:
+            tokenized_ds_eval = LazyDataset(lambda: MultiAdapterDataset([eval_ds.load() for _, eval_ds in adapter_datasets]))
+        else:
+            tokenized_ds_eval = MultiAdapterDataset([eval_ds for _, eval_ds in adapter_datasets])
+    if args.streaming and args.max_steps <= 0:
+        # 流式数据集没有长度，按行数预估每个epoch的步数来驱动 LR schedule
+        num_lines = count_jsonl_lines(tokenized_ds.jsonl_files)
+        steps_per_epoch = math.ceil(num_lines / (args.batch_size * accelerator.num_processes))
+        args.max_steps = steps_per_epoch * args.epochs
+        print(f"流式模式: 训练集共 {num_lines} 行, 每个epoch约 {steps_per_epoch} 步, max_steps={args.max_steps}")
+    startup_timer.mark("准备数据集")
+    if verbose:
+        print(tokenized_ds_eval)
+        print(tokenized_ds_eval[0])
+        print(tokenized_ds)
+        if not args.streaming:
+            print(tokenized_ds[0])
+            print(tokenized_ds[1])
+        print(model)
+        print(tokenizer)
+    adapter_router = None
+    if adapters is None:
+        lora_config = build_lora_config(args)
+        if verbose:
+            print(lora_config)
+        peft_model = get_peft_model(model, lora_config)
+    else:
+        adapter_names = [name for name, _ in adapters]
+        lora_configs = [build_lora_config(adapter_args) for _, adapter_args in adapters]
+        if verbose:
+            for name, lora_config in zip(adapter_names, lora_configs):
+                print(name, lora_config)
+        peft_model = get_peft_model(model, lora_configs[0], adapter_name=adapter_names[0])
+        for name, lora_config in zip(adapter_names[1:], lora_configs[1:]):
+            peft_model.add_adapter(name, lora_config)
+        # add_adapter 只让当前adapter可训练，路由时也不切换 requires_grad，所有adapter的LoRA参数都需要保持可训练
+        for name, param in peft_model.named_parameters():
+            if "lora_" in name:
+                param.requires_grad = True
+        adapter_router = AdapterRouter(peft_model, adapter_names)
     
     # 确保模型处于训练模式
     peft_model.train()
     
-    # 打印可训练参数信息
-    peft_model.print_trainable_parameters()
-    
-    # 检查并修复梯度设置
-    trainable_params = 0
-    total_params = 0
-    for name, param in peft_model.named_parameters():
-        total_params += param.numel()
-        if param.requires_grad:
-            trainable_params += param.numel()
-            # 确保参数有梯度
-            param.requires_grad = True
-            print(f"Trainable param: {name}, shape: {param.shape}, requires_grad: {param.requires_grad}")
-    
-    print(f"Trainable parameters: {trainable_params:,} || Total parameters: {total_params:,} || Trainable%: {100 * trainable_params / total_params:.2f}")
+    if verbose:
+        # 打印可训练参数信息
+        peft_model.print_trainable_parameters()
+        
+        # 检查并修复梯度设置
+        trainable_params = 0
+        total_params = 0
+        for name, param in peft_model.named_parameters():
+            total_params += param.numel()
+            if param.requires_grad:
+                trainable_params += param.numel()
+                # 确保参数有梯度
+                param.requires_grad = True
+                print(f"Trainable param: {name}, shape: {param.shape}, requires_grad: {param.requires_grad}")
+        
+        print(f"Trainable parameters: {trainable_params:,} || Total parameters: {total_params:,} || Trainable%: {100 * trainable_params / total_params:.2f}")
+    elif accelerator.is_main_process:
+        trainable_params, total_params = peft_model.get_nb_trainable_parameters()
+        train_size = "流式" if args.streaming else f"{len(tokenized_ds)} 条"
+        print(f"模型: {type(model).__name__} ({model.dtype}), 参数 {total_params:,}, 可训练 {trainable_params:,} ({100 * trainable_params / total_params:.2f}%)")
+        for name, adapter_args in adapters or [("default", args)]:
+            print(f"LoRA[{name}]: r={adapter_args.lora_rank}, alpha={adapter_args.lora_alpha}, target={adapter_args.lora_trainable}")
+        print(f"tokenizer: {type(tokenizer).__name__}, 词表 {len(tokenizer)}, eos={tokenizer.eos_token_id}, pad={tokenizer.pad_token_id}")
+        print(f"训练集: {train_size}, 验证集: 第一次评估时加载")
     peft_model.enable_input_require_grads()
+    startup_timer.mark("创建LoRA模型")
+    if args.auto_token_budget:
+        if args.memory_limit_gb is not None:
+            memory_limit = args.memory_limit_gb * 2**30
+        elif torch.cuda.is_available():
+            memory_limit = 0.9 * torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory
+        else:
+            raise ValueError("没有GPU时 --auto_token_budget 需要指定 --memory_limit_gb")
+        if args.auto_token_budget_probe and not torch.cuda.is_available():
+            raise ValueError("--auto_token_budget_probe 需要GPU")
+        if args.auto_token_budget_probe:
+            # 与 Trainer 一致开启 gradient checkpointing 后实测
+            peft_model.gradient_checkpointing_enable()
+        budget_args = args
+        if adapters is not None:
+            # 每行只经过一个adapter，按最大的 rank 和所有adapter目标模块的并集估算
+            budget_args = copy.copy(args)
+            budget_args.lora_rank = max(adapter_args.lora_rank for _, adapter_args in adapters)
+            budget_args.lora_trainable = ",".join(sorted({
+                target for _, adapter_args in adapters for target in adapter_args.lora_trainable.split(",")}))
+        args.total_max_length = select_token_budget(peft_model, budget_args, accelerator, tokenized_ds, memory_limit,
+                                                    probe=args.auto_token_budget_probe)
+        if accelerator.is_main_process:
+            print(f"total_max_length = {args.total_max_length // 1024}K tokens")
+        startup_timer.mark("选择token预算")
 
 
+    pin_memory = torch.cuda.is_available() and not args.no_pin_memory
     training_args = TrainingArguments(
         output_dir=args.output_dir,
         num_train_epochs=args.epochs,
+        max_steps=args.max_steps,
         per_device_train_batch_size=args.batch_size,
         per_device_eval_batch_size=args.batch_size,
         save_steps=args.save_steps,
@@ -287,13 +2530,20 @@ def main():
         metric_for_best_model="eval_loss",
         bf16=True,
         gradient_checkpointing=True,  # 启用gradient_checkpointing节省显存
+        # 多adapter时每步只有部分adapter有梯度，DDP需要查找未使用的参数，此时只能用非重入的 checkpoint 实现；
+        # 编译后的层也需要非重入的 checkpoint
+        gradient_checkpointing_kwargs={"use_reentrant": False} if adapters or args.compile_model else None,
+        ddp_find_unused_parameters=True if adapters else None,
         dataloader_drop_last=False,
         remove_unused_columns=False,
-        # 数据随机化设置
-        dataloader_pin_memory=False,  # 减少内存使用
-        dataloader_persistent_workers=False,  # 禁用持久化工作进程
-        # 内存优化设置
-        dataloader_num_workers=0,  # 减少数据加载器工作进程
+        # 数据随机化设置: 默认 RandomSampler 也使用 shuffle_seed
+        data_seed=args.shuffle_seed,
+        # 预取设置: worker 进程提前collate prefetch_factor 个batch 放入锁页内存，H2D拷贝异步进行
+        dataloader_pin_memory=pin_memory,
+        dataloader_persistent_workers=args.dataloader_num_workers > 0,
+        dataloader_num_workers=args.dataloader_num_workers,
+        dataloader_prefetch_factor=args.dataloader_prefetch_factor if args.dataloader_num_workers > 0 else None,
+        accelerator_config={"non_blocking": pin_memory},
         max_grad_norm=1.0,  # 梯度裁剪
         warmup_steps=100,  # 预热步数
         learning_rate=args.learning_rate,  # 学习率
@@ -307,27 +2557,99 @@ def main():
         run_name=os.getenv("WANDB_RUN_NAME", "default-run"),
         disable_tqdm=False,
     )
-    print(training_args)
-    trainer = Trainer(
+    if verbose:
+        print(training_args)
+    if args.weighted_loss:
+        # 余弦位置加权loss，权重由collator预先计算
+        compile_loss = args.compile_loss or args.compile_model
+        cross_entropy_fn = torch.compile(_weighted_cross_entropy, dynamic=True) if compile_loss else _weighted_cross_entropy
+        compute_loss_func = partial(weighted_compute_loss_func, chunk_size=args.loss_chunk_size, cross_entropy_fn=cross_entropy_fn)
+    elif args.label_only_loss:
+        # label位置数随数据变化，分块交叉熵按动态shape编译
+        cross_entropy_fn = torch.compile(_sum_cross_entropy, dynamic=True) if args.compile_model else _sum_cross_entropy
+        compute_loss_func = partial(label_only_compute_loss_func, chunk_size=args.loss_chunk_size, cross_entropy_fn=cross_entropy_fn)
+    elif args.compile_model:
+        # 完整logits与batch的shape相同，每个桶编译一次
+        compute_loss_func = torch.compile(default_compute_loss_func, dynamic=False)
+    else:
+        compute_loss_func = default_compute_loss_func
+    if args.compile_model:
+        # 每个桶长度对应唯一的batch shape，预算内的桶数就是训练集和验证集shape数的上限
+        num_shapes = -(-args.total_max_length // args.shape_bucket_size)
+        # 训练和评估 (grad mode、dropout不同) 各编译一份，round_robin 时每个adapter的分支不同，也各编译一份
+        num_graphs = 2 * num_shapes * (len(adapters) if adapters else 1)
+        num_layers = compile_decoder_layers(peft_model, num_graphs)
+        if accelerator.is_main_process:
+            print(f"torch.compile: {num_layers} 个decoder layer, 最多 {num_shapes} 种batch shape (桶大小 {args.shape_bucket_size})")
+    collate_fn = partial(packing_data_collator if args.packing else data_collator,eos_token_id=tokenizer.eos_token_id,pad_token_id=tokenizer.pad_token_id,total_max_length=args.total_max_length,with_loss_weights=args.weighted_loss,
+                         shape_bucket_size=args.shape_bucket_size,
+                         max_batch_size=None if args.token_budget_batching or args.packing else args.batch_size)
+    # 经过 TokenBudgetBatchSampler 的 dataloader 不再截断，超预算的样本整条保留
+    sampler_collate_fn = collate_fn if args.packing else partial(collate_fn, truncate=False)
+    if adapters is not None:
+        collate_fn = partial(collate_with_adapter_ids, collate_fn=collate_fn)
+        sampler_collate_fn = partial(collate_with_adapter_ids, collate_fn=sampler_collate_fn)
+    trainer = CustomTrainer(
         model=peft_model,
         args=training_args,
         train_dataset=tokenized_ds,
         eval_dataset=tokenized_ds_eval,
-        data_collator=partial(data_collator,eos_token_id=tokenizer.eos_token_id,pad_token_id=tokenizer.pad_token_id,total_max_length=args.total_max_length),
-        # compute_loss_func=create_compute_loss_func(tokenizer.eos_token_id),
-        compute_loss_func=default_compute_loss_func,
+        data_collator=collate_fn,
+        sampler_data_collator=sampler_collate_fn,
+        compute_loss_func=compute_loss_func,
+        total_max_length=args.total_max_length,
+        token_budget_batching=args.token_budget_batching,
+        group_by_length=args.group_by_length,
+        megabatch_size=args.megabatch_size or 50 * args.batch_size,
+        shuffle_seed=args.shuffle_seed,
+        packing=args.packing,
+        streaming_num_workers=args.streaming_num_workers,
+        label_only_logits=args.label_only_loss,
+        step_timer=None if args.disable_step_timing else StepTimingCallback(
+            os.path.join(args.output_dir, "step_timing.jsonl"), shape_summary=bool(args.shape_bucket_size),
+            count_graphs=args.compile_model or args.compile_loss),
+        callbacks=[startup_timer],
+        checkpoint_writer=AsyncCheckpointWriter(
+            args.output_dir,
+            rank=training_args.process_index,
+            world_size=training_args.world_size,
+            is_main=training_args.should_save,
+            save_total_limit=args.save_total_limit,
+        ) if args.async_checkpoint else None,
+        loss_tracker=ExampleLossTracker(
+            len(tokenized_ds),
+            loss_threshold=args.skip_loss_threshold,
+            patience=args.skip_patience,
+            floor_prob=args.skip_floor_prob,
+            seed=args.shuffle_seed,
+            is_main=training_args.process_index == 0,
+        ) if args.loss_aware_sampling else None,
+        adapter_router=adapter_router,
+        adapter_routing=args.adapter_routing,
+        shape_bucket_size=args.shape_bucket_size,
     )
-    print(trainer)
     # 确保模型在训练前正确设置
     peft_model.train()
     
-    # 验证模型参数设置
-    print("验证模型参数设置...")
-    for name, param in peft_model.named_parameters():
-        if param.requires_grad:
-            print(f"✓ {name}: requires_grad={param.requires_grad}, shape={param.shape}")
+    if verbose:
+        print(trainer)
+        # 验证模型参数设置
+        print("验证模型参数设置...")
+        for name, param in peft_model.named_parameters():
+            if param.requires_grad:
+                print(f"✓ {name}: requires_grad={param.requires_grad}, shape={param.shape}")
+    startup_timer.mark("创建Trainer")
     
-    trainer.train()
+    resume_checkpoint = None
+    if args.resume_from_checkpoint is not None:
+        resume_checkpoint = resolve_resume_checkpoint(args.output_dir, args.resume_from_checkpoint)
+        if training_args.should_save:
+            print(f"从checkpoint恢复训练: {resume_checkpoint}" if resume_checkpoint else "没有找到可恢复的checkpoint，从头开始训练")
+    trainer.train(resume_from_checkpoint=resume_checkpoint)
+    # 多adapter时 save_pretrained 把每个adapter保存到 output_dir 下的同名子目录
     peft_model.save_pretrained(args.output_dir)
+    if adapters is not None and training_args.should_save:
+        for name, _ in adapters:
+            print(f"adapter {name} 已保存到 {adapter_checkpoint_dir(args.output_dir, name)}")
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,91 @@
+"""
+train.py 的命令行参数。只依赖标准库: train.py 作为入口运行时先解析和校验参数，再导入 torch / transformers
+(Trainer 会连带导入 accelerate、datasets、peft，本地约7s)，--help 和参数错误不必在每个rank上等待这些导入。
+"""
+import argparse
+import os
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", type=str, required=True)
+    parser.add_argument("--dataset_dir", type=str, required=True)
+    parser.add_argument("--dataset_eval_dir", type=str, required=True)
+    parser.add_argument("--total_max_length", type=int, default=1)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--lora_rank",type=int, default=8)
+    parser.add_argument("--lora_alpha",type=int, default=32)
+    parser.add_argument("--lora_dropout",type=float, default=0.05)
+    parser.add_argument("--lora_trainable",type=str, default="q_proj,k_proj,v_proj,o_proj,gate_proj,up_proj,down_proj")
+    parser.add_argument("--lora_init_method",type=str, default=None)
+    parser.add_argument("--output_dir",type=str, default="output")
+    parser.add_argument("--shuffle_data", action="store_true", help="启用数据随机化")
+    parser.add_argument("--shuffle_seed", type=int, default=42, help="数据随机化种子")
+    parser.add_argument("--learning_rate", type=float, default=5e-5, help="学习率")
+    parser.add_argument("--save_steps", type=int, default=2000, help="保存步数")
+    parser.add_argument("--logging_steps", type=int, default=1, help="日志步数")
+    parser.add_argument("--eval_steps", type=int, default=2000, help="评估步数")
+    parser.add_argument("--save_total_limit", type=int, default=5, help="保存总限制")
+    parser.add_argument("--token_budget_batching", action="store_true", help="按token预算预先组batch，不再截断丢弃样本")
+    parser.add_argument("--group_by_length", action="store_true", help="按样本长度分桶组batch，减少左padding")
+    parser.add_argument("--megabatch_size", type=int, default=None, help="分桶时每个megabatch的样本数，默认 50×batch_size")
+    parser.add_argument("--packing", action="store_true", help="按token预算把多个样本拼接成一行，样本之间互不可见")
+    parser.add_argument("--max_input_length", type=int, default=2048, help="过滤掉 input 超过该token数的样本")
+    parser.add_argument("--tokenized_cache_dir", type=str, default=None, help="tokenize 结果的磁盘缓存目录，按指纹复用")
+    parser.add_argument("--tokenize_batch_size", type=int, default=1000, help="tokenize 时 ds.map 的batch大小，与训练batch无关")
+    parser.add_argument("--tokenize_num_proc", type=int, default=None, help="tokenize 的进程数，默认使用本机全部CPU")
+    parser.add_argument("--streaming", action="store_true", help="流式读取训练集jsonl，在dataloader worker中实时tokenize")
+    parser.add_argument("--shuffle_buffer_size", type=int, default=10000, help="流式模式下按块打乱的块大小 (行数)")
+    parser.add_argument("--streaming_num_workers", type=int, default=4, help="流式模式下 dataloader 的 worker 数")
+    parser.add_argument("--max_steps", type=int, default=-1, help="最大训练步数，流式模式下未指定时按行数预估")
+    parser.add_argument("--label_only_loss", action="store_true", help="只在label位置计算lm_head和交叉熵，lm_head 按 --loss_chunk_size 分块投影，降低logits显存")
+    parser.add_argument("--loss_chunk_size", type=int, default=512, help="label_only_loss / weighted_loss 下 lm_head 投影和交叉熵分块计算的位置数")
+    parser.add_argument("--weighted_loss", action="store_true", help="使用余弦位置加权loss，权重在collator中预先计算")
+    parser.add_argument("--compile_loss", action="store_true", help="用 torch.compile 编译加权交叉熵")
+    parser.add_argument("--dataloader_num_workers", type=int, default=2, help="collate 的 dataloader worker 进程数，0 表示在训练线程中同步collate")
+    parser.add_argument("--dataloader_prefetch_factor", type=int, default=4, help="每个 worker 预取的batch数")
+    parser.add_argument("--no_pin_memory", action="store_true", help="不使用锁页内存 (默认在GPU上开启并异步拷贝到显存)")
+    parser.add_argument("--resume_from_checkpoint", nargs="?", const="latest", default=None,
+                        metavar="PATH|latest",
+                        help="从checkpoint恢复训练: checkpoint 目录路径，或 latest (不带值时同 latest) 使用 output_dir 中最新的完整checkpoint")
+    parser.add_argument("--async_checkpoint", action="store_true", help="只保存LoRA权重和训练状态，快照到内存后由后台线程写盘和轮转")
+    parser.add_argument("--fast_start", action="store_true", help="快速启动: 验证集延迟到第一次评估加载，只在主进程打印诊断摘要")
+    parser.add_argument("--disable_step_timing", action="store_true", help="关闭每步耗时/吞吐统计 (默认写入 output_dir/step_timing.jsonl)")
+    parser.add_argument("--auto_token_budget", action="store_true", help="按显存估算自动选择 total_max_length，忽略命令行给定的值")
+    parser.add_argument("--memory_limit_gb", type=float, default=None, help="自动token预算的显存上限 (GB)，默认为单卡显存的90%%")
+    parser.add_argument("--auto_token_budget_probe", action="store_true", help="自动token预算时再用随机batch实测一次 (仅GPU)")
+    parser.add_argument("--loss_aware_sampling", action="store_true", help="按样本记录训练loss，之后的epoch中按概率跳过已学会的样本，epoch的步数随之减少")
+    parser.add_argument("--skip_loss_threshold", type=float, default=0.1, help="样本平均交叉熵低于该值视为已学会")
+    parser.add_argument("--skip_patience", type=int, default=2, help="连续多少次低于阈值后开始降低采样概率")
+    parser.add_argument("--skip_floor_prob", type=float, default=0.1, help="已学会样本的最低保留概率")
+    parser.add_argument("--multi_adapter_config", type=str, default=None,
+                        help="多adapter训练配置(JSON列表)，基座只加载一次，每个adapter可单独指定数据集和LoRA参数")
+    parser.add_argument("--adapter_routing", type=str, default="mixed", choices=["mixed", "round_robin"],
+                        help="多adapter时batch的组成: mixed 按行混合多个adapter，round_robin 每个优化器step所有rank训练同一个adapter、按step轮流")
+    parser.add_argument("--shape_bucket_size", type=int, default=0,
+                        help="静态shape: padding后的长度向上取整到它的整数倍 (如64/128)，行数按token预算补齐，0 表示不分桶")
+    parser.add_argument("--compile_model", action="store_true", help="用 torch.compile 按层编译模型并编译loss，需要 --shape_bucket_size")
+    return parser
+
+
+def parse_args(argv=None):
+    """解析并校验只依赖参数本身的组合；多adapter配置文件等在 train.main() 中加载"""
+    args = build_arg_parser().parse_args(argv)
+    args.total_max_length = args.total_max_length*1024
+    if args.loss_aware_sampling and args.streaming:
+        raise ValueError("--loss_aware_sampling 需要 map-style 数据集，不支持 --streaming")
+    if args.tokenize_num_proc is None:
+        # 只有每个节点的主进程做 tokenize，可以用满本机CPU
+        args.tokenize_num_proc = os.cpu_count() or 1
+    if args.multi_adapter_config:
+        if args.streaming:
+            raise ValueError("--multi_adapter_config 需要 map-style 数据集，不支持 --streaming")
+        if args.packing and args.adapter_routing != "round_robin":
+            raise ValueError("--packing 的一行只能属于一个adapter，需要 --adapter_routing round_robin")
+    if args.compile_model:
+        if not args.shape_bucket_size:
+            raise ValueError("--compile_model 需要 --shape_bucket_size，否则每种padding长度都会重新编译")
+        if args.multi_adapter_config and args.adapter_routing == "mixed":
+            raise ValueError("--compile_model 下 mixed 路由的每种行切分都会重新编译，需要 --adapter_routing round_robin")
+    return args
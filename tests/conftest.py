@@ -0,0 +1,7 @@
+import os
+import sys
+
+# 与 src/benchmark.py 一致: train 等模块在 src/ 下，compress_schema / schema_format 在仓库根目录
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, ROOT)
@@ -0,0 +1,51 @@
+"""
+round_robin 多adapter路由: TokenBudgetBatchSampler 按组 (adapter) 组batch，经 accelerate 的 BatchSamplerShard
+分到多个rank后，同一个优化器step (所有rank × 梯度累积) 的batch属于同一个adapter，各adapter的梯度不会被
+其它rank的零梯度稀释；每个样本每个epoch恰好训练一次，各rank的step数相同。
+"""
+import random
+
+import pytest
+from accelerate.data_loader import BatchSamplerShard
+
+from train import TokenBudgetBatchSampler
+
+
+def make_groups(sizes, seed=0):
+    rng = random.Random(seed)
+    lengths, groups = [], []
+    for group, size in enumerate(sizes):
+        lengths += [rng.randint(16, 256) for _ in range(size)]
+        groups += [group] * size
+    return lengths, groups
+
+
+def optimizer_steps(sampler, num_processes, gradient_accumulation_steps):
+    # 每个rank的batch序列，按 (step, 累积的micro step) 取出所有rank的batch
+    shards = [list(BatchSamplerShard(sampler, num_processes=num_processes, process_index=rank)) for rank in range(num_processes)]
+    assert len({len(shard) for shard in shards}) == 1
+    num_micro_steps = len(shards[0])
+    assert num_micro_steps % gradient_accumulation_steps == 0
+    return [[shard[micro] for shard in shards for micro in range(step, step + gradient_accumulation_steps)]
+            for step in range(0, num_micro_steps, gradient_accumulation_steps)]
+
+
+@pytest.mark.parametrize("num_processes", [1, 2, 4])
+@pytest.mark.parametrize("gradient_accumulation_steps", [1, 3])
+@pytest.mark.parametrize("group_by_length", [False, True])
+@pytest.mark.parametrize("sizes", [(300, 300), (500, 60, 200)], ids=["two_equal", "three_uneven"])
+def test_each_step_trains_one_adapter(num_processes, gradient_accumulation_steps, group_by_length, sizes):
+    lengths, groups = make_groups(sizes)
+    sampler = TokenBudgetBatchSampler(lengths, 1024, shuffle=True, num_replicas=num_processes, num_epochs=3,
+                                      group_by_length=group_by_length, groups=groups,
+                                      gradient_accumulation_steps=gradient_accumulation_steps)
+    for epoch in range(3):
+        sampler.set_epoch(epoch)
+        steps = optimizer_steps(sampler, num_processes, gradient_accumulation_steps)
+        assert len(steps) * num_processes * gradient_accumulation_steps == len(sampler)
+        for batches in steps:
+            assert len({groups[index] for batch in batches for index in batch}) == 1
+        # 每个adapter都参与训练，样本不丢失 (补齐整轮时拆分batch，只有样本不够拆分时才重复)
+        trained = [index for batches in steps for batch in batches for index in batch]
+        assert set(trained) == set(range(len(lengths)))
+        assert {groups[batches[0][0]] for batches in steps} == set(range(len(sizes)))
@@ -0,0 +1,131 @@
+"""
+TokenBudgetBatchSampler 配合 ExampleLossTracker 跳过样本时: 只用保留的样本组batch，epoch的batch数随之减少
+(仍为进程数的整数倍，分组时每个组为整轮)，不重复样本；skipped_token_ratio 统计没有训练的token。
+每个epoch的batch数保存在 epoch_stats 中，用于恢复训练时定位 global_step 和更新LR schedule的总步数。
+"""
+import random
+from types import SimpleNamespace
+
+import pytest
+import torch
+from transformers import get_scheduler
+
+from train import ExampleLossTracker, TokenBudgetBatchSampler, set_schedule_total_steps
+
+
+def make_lengths(num_examples=200, seed=0, low=16, high=256):
+    rng = random.Random(seed)
+    return [rng.randint(low, high) for _ in range(num_examples)]
+
+
+def learned_tracker(num_examples, learned_fraction, seed=0):
+    # 前 learned_fraction 的样本已连续多次低于阈值，按 floor_prob 保留
+    tracker = ExampleLossTracker(num_examples, loss_threshold=0.1, patience=2, floor_prob=0.1, seed=seed, is_main=False)
+    num_learned = int(num_examples * learned_fraction)
+    tracker.ema[:num_learned] = 0.0
+    tracker.streak[:num_learned] = 5
+    return tracker
+
+
+@pytest.mark.parametrize("num_replicas", [1, 4])
+@pytest.mark.parametrize("packing", [False, True])
+@pytest.mark.parametrize("group_by_length", [False, True])
+@pytest.mark.parametrize("learned_fraction", [0.0, 0.3, 1.0])
+def test_skipping_shrinks_epoch(num_replicas, packing, group_by_length, learned_fraction):
+    lengths = make_lengths()
+    tracker = learned_tracker(len(lengths), learned_fraction)
+    kwargs = dict(shuffle=True, num_epochs=3, num_replicas=num_replicas, group_by_length=group_by_length, packing=packing)
+    sampler = TokenBudgetBatchSampler(lengths, 1024, loss_tracker=tracker, **kwargs)
+    reference = TokenBudgetBatchSampler(lengths, 1024, **kwargs)
+    for epoch in range(3):
+        sampler.set_epoch(epoch)
+        batches = list(sampler)
+        assert len(batches) == len(sampler) == tracker.epoch_stats[epoch][4]
+        assert len(batches) % num_replicas == 0
+        indices = [index for batch in batches for index in batch]
+        assert len(indices) == len(set(indices))
+        _, skipped, total_tokens, skipped_tokens, _ = tracker.epoch_stats[epoch]
+        assert skipped == len(lengths) - len(indices)
+        assert skipped_tokens == total_tokens - sum(lengths[index] for index in indices)
+        if learned_fraction == 0:
+            assert skipped == 0
+            assert len(batches) <= len(reference)
+        else:
+            assert skipped > 0
+            assert len(batches) < len(reference)
+
+
+def test_realistic_corpus_trains_fewer_tokens():
+    # 2万条样本、12K token预算、4个进程，一半样本已学会
+    lengths = make_lengths(20000, low=64, high=2048)
+    tracker = learned_tracker(len(lengths), 0.5)
+    kwargs = dict(shuffle=True, num_epochs=2, num_replicas=4, group_by_length=True, megabatch_size=800)
+    sampler = TokenBudgetBatchSampler(lengths, 12 * 1024, loss_tracker=tracker, **kwargs)
+    reference = TokenBudgetBatchSampler(lengths, 12 * 1024, **kwargs)
+    sampler.set_epoch(1)
+    trained_tokens = sum(lengths[index] for batch in sampler for index in batch)
+    assert trained_tokens < 0.6 * sum(lengths)
+    # 约一半样本的90%被跳过，节省的token比例与之相符
+    assert 0.4 < tracker.skipped_token_ratio() < 0.5
+    assert len(sampler) % 4 == 0
+    assert len(sampler) < 0.6 * len(reference)
+
+
+def test_round_robin_groups_fill_whole_rounds():
+    lengths = make_lengths(400)
+    groups = [index % 3 for index in range(len(lengths))]
+    tracker = learned_tracker(len(lengths), 0.5)
+    sampler = TokenBudgetBatchSampler(lengths, 1024, shuffle=True, num_replicas=2, groups=groups, loss_tracker=tracker,
+                                      gradient_accumulation_steps=2)
+    batches = list(sampler)
+    assert len(batches) % sampler.round_size == 0
+    for start in range(0, len(batches), sampler.round_size):
+        assert len({groups[index] for batch in batches[start:start + sampler.round_size] for index in batch}) == 1
+
+
+def test_all_examples_skipped_keeps_one():
+    lengths = make_lengths(5)
+    tracker = learned_tracker(len(lengths), 1.0)
+    tracker.floor_prob = 0.0
+    sampler = TokenBudgetBatchSampler(lengths, 1024, num_replicas=2, loss_tracker=tracker)
+    batches = list(sampler)
+    assert len(batches) == 2
+    _, skipped = tracker.select(list(range(len(lengths))), 0)
+    assert {index for batch in batches for index in batch} == {skipped[0]}
+
+
+def test_resume_position_and_skip_batches():
+    lengths = make_lengths()
+    tracker = learned_tracker(len(lengths), 0.0)
+    sampler = TokenBudgetBatchSampler(lengths, 1024, shuffle=True, num_replicas=2, loss_tracker=tracker)
+    full = list(sampler)
+    tracker.epoch_stats = {0: (0, 0, 0, 0, 12), 1: (0, 0, 0, 0, 8), 2: (0, 0, 0, 0, 4)}
+    # 2个进程、梯度累积3步: 每个epoch 2、2、1 个优化器step
+    assert tracker.resume_position(0, 2, 3) == (0, 0)
+    assert tracker.resume_position(3, 2, 3) == (1, 1)
+    assert tracker.resume_position(4, 2, 3) == (2, 0)
+    assert tracker.resume_position(5, 2, 3) == (3, 0)
+    sampler.skip_batches(0, 4)
+    assert list(sampler) == full[4:]
+    assert len(sampler) == len(full) - 4
+
+
+def test_epoch_begin_updates_schedule_total():
+    tracker = learned_tracker(10, 0.0)
+    tracker.epoch, tracker.epoch_stats = 1, {0: (0, 0, 0, 0, 40), 1: (0, 0, 0, 0, 16)}
+    optimizer = torch.optim.SGD([torch.nn.Parameter(torch.zeros(1))], lr=1.0)
+    scheduler = get_scheduler("cosine", optimizer, num_warmup_steps=2, num_training_steps=60)
+    args = SimpleNamespace(max_steps=-1, num_train_epochs=3, world_size=2, gradient_accumulation_steps=2)
+    state = SimpleNamespace(global_step=10, max_steps=60)
+    # 从epoch 1 开头恢复 (之前10步)，本epoch 4步，之后还有1个epoch按4步估计
+    tracker.on_epoch_begin(args, state, None, train_dataloader=range(8), lr_scheduler=scheduler)
+    assert state.max_steps == 18
+    expected = get_scheduler("cosine", torch.optim.SGD([torch.nn.Parameter(torch.zeros(1))], lr=1.0),
+                             num_warmup_steps=2, num_training_steps=18)
+    assert [lr_lambda(12) for lr_lambda in scheduler.lr_lambdas] == [lr_lambda(12) for lr_lambda in expected.lr_lambdas]
+    # 设置了 max_steps 时保持原来的总步数
+    state.max_steps = 60
+    tracker.on_epoch_begin(SimpleNamespace(**{**vars(args), "max_steps": 60}), state, None, train_dataloader=range(8),
+                           lr_scheduler=scheduler)
+    assert state.max_steps == 60
+    assert set_schedule_total_steps(object(), 10) is False
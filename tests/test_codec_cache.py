@@ -0,0 +1,35 @@
+"""get_codec / SchemaCodec 缓存: 按内容复用，原地修改后不复用旧的编解码器，缓存大小有上限"""
+import copy
+
+import compress_schema
+from compress_schema import build_schema_maps, get_codec, schema_definition
+
+
+def test_codec_reused_by_content():
+    maps = build_schema_maps(schema_definition)
+    assert get_codec(maps) is get_codec(copy.deepcopy(maps))
+    assert get_codec(schema_json=schema_definition) is get_codec(schema_json=copy.deepcopy(schema_definition))
+
+
+def test_in_place_mutation_gets_new_codec():
+    maps = build_schema_maps(schema_definition)
+    codec = get_codec(maps)
+    entity_type = next(iter(maps["entity_map"]))
+    original_code = maps["entity_map"][entity_type]
+    maps["entity_map"][entity_type] = "ZZ"
+    mutated = get_codec(maps)
+    assert mutated is not codec
+    assert mutated.entity_map[entity_type] == "ZZ"
+    # 按旧内容缓存的编解码器不受调用方原地修改的影响
+    assert codec.entity_map[entity_type] == original_code
+    assert get_codec(build_schema_maps(schema_definition)) is codec
+
+
+def test_codec_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(compress_schema, "CODEC_CACHE_SIZE", 4)
+    maps = build_schema_maps(schema_definition)
+    for i in range(10):
+        variant = copy.deepcopy(maps)
+        variant["entity_map"] = {**variant["entity_map"], f"Extra{i}": f"X{i}"}
+        get_codec(variant)
+    assert len(compress_schema._codec_cache) <= 4
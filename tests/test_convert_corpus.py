@@ -0,0 +1,31 @@
+"""convert_corpus: 转换失败的行写占位记录，空行保留，输出与输入逐行对齐"""
+import json
+import random
+
+import convert_corpus
+from compress_schema import build_schema_maps, schema_definition
+from sttl_reference import make_kg
+
+
+def test_failed_lines_keep_alignment():
+    maps = build_schema_maps(schema_definition)
+    convert_corpus._init_worker("json2sttl", "compress_schema", maps, True)
+    rng = random.Random(0)
+    records = [{"id": i, "output": make_kg(rng, schema_definition, 3)} for i in range(4)]
+    lines = [json.dumps(record).encode() + b"\n" for record in records]
+    # 字段缺失、字段内容非法、整行不是 JSON、空行
+    lines[1] = json.dumps({"id": 1}).encode() + b"\n"
+    lines[2] = json.dumps({"id": 2, "output": "{not json"}).encode() + b"\n"
+    lines.insert(3, b"not json\n")
+    lines.insert(4, b"\n")
+    data, stats, errors = convert_corpus.convert_chunk(lines, "output")
+    out = data.decode("utf-8").split("\n")[:-1]
+    assert len(out) == len(lines)
+    assert stats["lines"] == 5 and stats["converted"] == 2 and stats["errors"] == 3
+    assert [idx for idx, _ in errors] == [1, 2, 3]
+    assert out[4] == ""
+    parsed = [json.loads(line) for line in out if line]
+    assert [record.get("id") for record in parsed] == [0, 1, 2, None, 3]
+    assert [record.get("output") is None for record in parsed] == [False, True, True, True, False]
+    assert ["convert_error" in record for record in parsed] == [False, True, True, True, False]
+    assert parsed[0]["output"] == convert_corpus._convert(records[0]["output"])[0]
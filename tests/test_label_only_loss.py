@@ -0,0 +1,92 @@
+"""
+label_only_loss: CustomTrainer(label_only_logits=True) 时模型跳过 lm_head，只输出label位置的 hidden states，
+loss 函数按chunk经过 lm_head。与完整logits上的 default_compute_loss_func 比较 loss 和 LoRA 梯度，
+lm_head 本身是 LoRA 目标时同样一致；前向结束后 lm_head 恢复原样。
+"""
+from functools import partial
+
+import pytest
+import torch
+from peft import LoraConfig, get_peft_model
+from transformers import AutoModelForCausalLM, Qwen3Config, TrainingArguments
+
+from train import (
+    CustomTrainer,
+    data_collator,
+    default_compute_loss_func,
+    label_hidden_states,
+    label_logit_positions,
+    label_only_compute_loss_func,
+    per_example_loss,
+)
+
+EOS_TOKEN_ID = 1
+PAD_TOKEN_ID = 0
+VOCAB_SIZE = 128
+HIDDEN_SIZE = 32
+
+
+def make_batch(num_examples=3, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    examples = []
+    for _ in range(num_examples):
+        input_length, label_length = torch.randint(3, 20, (2,), generator=generator).tolist()
+        tokens = torch.randint(2, VOCAB_SIZE, (input_length + label_length,), generator=generator).tolist()
+        examples.append({"input_ids": tokens[:input_length], "labels": tokens[input_length:]})
+    return data_collator(examples, EOS_TOKEN_ID, PAD_TOKEN_ID, total_max_length=4096, truncate=False)
+
+
+def make_model(targets):
+    torch.manual_seed(0)
+    config = Qwen3Config(vocab_size=VOCAB_SIZE, hidden_size=HIDDEN_SIZE, intermediate_size=64, num_hidden_layers=1,
+                         num_attention_heads=2, num_key_value_heads=1, head_dim=16, tie_word_embeddings=False,
+                         eos_token_id=EOS_TOKEN_ID, pad_token_id=PAD_TOKEN_ID)
+    config.use_cache = False
+    model = AutoModelForCausalLM.from_config(config, dtype=torch.float32)
+    model = get_peft_model(model, LoraConfig(r=4, lora_alpha=8, target_modules=targets, init_lora_weights=False))
+    return model.train()
+
+
+def lora_grads(model):
+    return {name: param.grad.clone() for name, param in model.named_parameters() if param.requires_grad}
+
+
+@pytest.mark.parametrize("targets", [["q_proj", "down_proj"], ["q_proj", "lm_head"]], ids=["base_lm_head", "lora_lm_head"])
+def test_trainer_label_only_matches_full_logits(tmp_path, targets):
+    model = make_model(targets)
+    batch = make_batch()
+    model.zero_grad()
+    outputs = model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"])
+    ref_loss = default_compute_loss_func(outputs, batch["labels"], None)
+    ref_loss.backward()
+    ref_grads = lora_grads(model)
+    ref_per_example = per_example_loss(outputs.logits, batch["labels"])
+
+    trainer = CustomTrainer(model=model, args=TrainingArguments(output_dir=str(tmp_path), report_to=[], use_cpu=True),
+                            compute_loss_func=partial(label_only_compute_loss_func, chunk_size=3), label_only_logits=True)
+    model.zero_grad()
+    loss, outputs = trainer.compute_loss(model, dict(batch), return_outputs=True)
+    loss.backward()
+    # 模型只输出 label 位置的 hidden states，没有 (B, K, V) 的 logits
+    assert outputs.logits.shape == (batch["labels"].shape[0], label_logit_positions(batch["labels"]).numel(), HIDDEN_SIZE)
+    torch.testing.assert_close(loss, ref_loss, rtol=1e-5, atol=1e-6)
+    for name, grad in lora_grads(model).items():
+        torch.testing.assert_close(grad, ref_grads[name], rtol=1e-4, atol=1e-6, msg=name)
+    lm_head = model.get_output_embeddings()
+    torch.testing.assert_close(per_example_loss(outputs.logits, batch["labels"], lm_head=lm_head), ref_per_example)
+    # 退出后 lm_head 恢复原来的 forward
+    assert "forward" not in vars(lm_head)
+    assert model(input_ids=batch["input_ids"]).logits.shape[-1] == VOCAB_SIZE
+
+
+def test_label_hidden_states_restores_instance_forward():
+    lm_head = torch.nn.Linear(HIDDEN_SIZE, VOCAB_SIZE, bias=False)
+    hooked = lambda hidden_states: torch.nn.Linear.forward(lm_head, hidden_states) * 2  # noqa: E731
+    lm_head.forward = hooked
+    model = torch.nn.Module()
+    model.get_output_embeddings = lambda: lm_head
+    hidden = torch.randn(2, HIDDEN_SIZE)
+    with label_hidden_states(model) as project:
+        assert lm_head(hidden) is hidden
+        torch.testing.assert_close(project(hidden), hooked(hidden))
+    assert lm_head.forward is hooked
@@ -0,0 +1,123 @@
+"""
+estimate_training_memory / layer_activation_bytes 与已知大小对比:
+- 小配置上手算的每层激活字节数和各组成部分
+- 真实 LoRA 模型的参数量、LoRA 梯度和 Adam 状态大小
+- 一个 decoder layer 反向前实际保存的激活 (saved_tensors_hooks 统计，按 storage 去重，不含参数)
+"""
+from types import SimpleNamespace
+
+import pytest
+import torch
+from peft import LoraConfig, get_peft_model
+from transformers import AutoModelForCausalLM, Qwen2Config, Qwen3Config
+
+from train import estimate_training_memory, layer_activation_bytes
+
+TARGETS = ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"]
+# 实测激活与估算的允许偏差: 估算按峰值建模，个别临时张量 (如 dtype 转换后的输入) 在小模型上占比偏大
+ACTIVATION_TOLERANCE = 0.2
+
+# h=8, inter=16, 2个头 (head_dim=4), 1个kv头
+TINY = SimpleNamespace(model_type="qwen2", hidden_size=8, intermediate_size=16, num_attention_heads=2,
+                       num_key_value_heads=1, head_dim=4, num_hidden_layers=2, vocab_size=32)
+
+
+def test_layer_activation_bytes_tiny_config():
+    # RMSNorm 2*(4+2)*8=96，attention 2*5*8+4*2=88，MLP 4*2*16=128
+    assert layer_activation_bytes(TINY, 2, [], dtype_bytes=2, lora_dtype_bytes=4) == 312
+    # 每个目标层 rank*4 的中间结果 + 转成fp32的输入 (q_proj 输入宽8，down_proj 输入宽16)
+    assert layer_activation_bytes(TINY, 2, ["q_proj", "down_proj"], dtype_bytes=2, lora_dtype_bytes=4) == 312 + 8 + 32 + 8 + 64
+    # dropout 时改为保存 mask (1字节) 和 dropout 后的fp32输入
+    assert layer_activation_bytes(TINY, 2, ["q_proj", "down_proj"], lora_dropout=0.1, dtype_bytes=2,
+                                  lora_dtype_bytes=4) == 312 + 8 + 40 + 8 + 80
+    # LoRA 与基座同 dtype 且不开 dropout 时不额外保存输入
+    assert layer_activation_bytes(TINY, 2, ["q_proj"], dtype_bytes=2, lora_dtype_bytes=2) == 312 + 4
+
+
+def test_estimate_components_tiny_config():
+    estimate = estimate_training_memory(TINY, num_tokens=10, num_params=1000, num_trainable_params=100, lora_rank=2,
+                                        lora_targets=["q_proj", "down_proj"], max_seq_len=5)
+    assert estimate["weights"] == 2 * 1000
+    # LoRA 梯度 fp32 + fp32 主权重和 Adam m/v
+    assert estimate["lora"] == 4 * 100 + 12 * 100
+    # 逐层反向阶段: 每个token 每层输入 2*2*8 + mask 5*2 + 重算一层 424 + hidden/MLP 梯度 2*(8+16)
+    assert estimate["activations"] == 10 * (32 + 10 + 424 + 48)
+    assert estimate["total"] == estimate["weights"] + estimate["lora"] + estimate["activations"]
+    # ZeRO 按进程数切分优化器状态，offload 时不占显存
+    assert estimate_training_memory(TINY, 10, 1000, 100, 2, ["q_proj"], num_replicas=4)["lora"] == 400 + 300
+    assert estimate_training_memory(TINY, 10, 1000, 100, 2, ["q_proj"], optimizer_offload=True)["lora"] == 400
+    # 不开 gradient checkpointing 时 loss 阶段保存所有层的激活
+    no_ckpt = estimate_training_memory(TINY, 10, 1000, 100, 2, ["q_proj", "down_proj"], max_seq_len=5,
+                                       gradient_checkpointing=False)
+    assert no_ckpt["activations"] == max(10 * (2 * 424 + 10 + 8 * 8) + 10 * 3 * 2 * 32, 10 * (2 * 424 + 10 + 48))
+    # label_only_loss: 一半位置的 hidden states 和梯度，加一个 chunk (4 个token) 的 logits 和 log_softmax
+    label_only = estimate_training_memory(TINY, 10, 1000, 100, 2, ["q_proj", "down_proj"], max_seq_len=5,
+                                          gradient_checkpointing=False, label_only_loss=True, logit_fraction=0.5,
+                                          loss_chunk_size=4)
+    assert label_only["activations"] == 10 * (2 * 424 + 10 + 8 * 8) + 5 * 2 * 2 * 8 + 4 * 2 * 2 * 32
+
+
+def tiny_lora_model(config_class, dtype, lora_dropout):
+    torch.manual_seed(0)
+    config = config_class(vocab_size=128, hidden_size=64, intermediate_size=176, num_hidden_layers=1,
+                          num_attention_heads=4, num_key_value_heads=2, head_dim=16, max_position_embeddings=512,
+                          tie_word_embeddings=False)
+    config._attn_implementation = "sdpa"
+    model = AutoModelForCausalLM.from_config(config, dtype=dtype)
+    lora_config = LoraConfig(r=8, lora_alpha=16, lora_dropout=lora_dropout, target_modules=TARGETS, task_type="CAUSAL_LM")
+    return get_peft_model(model, lora_config).train()
+
+
+def test_lora_and_optimizer_sizes():
+    model = tiny_lora_model(Qwen2Config, torch.bfloat16, 0.0)
+    num_trainable, num_params = model.get_nb_trainable_parameters()
+    config = model.config
+    head_dim = config.head_dim
+    widths = {"q_proj": (64, 4 * head_dim), "k_proj": (64, 2 * head_dim), "v_proj": (64, 2 * head_dim),
+              "o_proj": (4 * head_dim, 64), "gate_proj": (64, 176), "up_proj": (64, 176), "down_proj": (176, 64)}
+    assert num_trainable == sum(8 * (fan_in + fan_out) for fan_in, fan_out in widths.values())
+    assert num_params == sum(p.numel() for p in model.parameters())
+
+    estimate = estimate_training_memory(config, 128, num_params, num_trainable, 8, TARGETS, dtype_bytes=2, lora_dtype_bytes=4)
+    ids = torch.randint(0, 128, (2, 16))
+    model(input_ids=ids, labels=ids).loss.backward()
+    grad_bytes = sum(p.grad.numel() * p.grad.element_size() for p in model.parameters() if p.requires_grad)
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad])
+    optimizer.step()
+    state_bytes = sum(t.numel() * t.element_size() for state in optimizer.state.values()
+                      for t in state.values() if torch.is_tensor(t) and t.dim() > 0)
+    # 估算: LoRA 梯度 + fp32 主权重 (DeepSpeed bf16 下单独保存) + Adam m/v
+    assert estimate["lora"] == grad_bytes + 4 * num_trainable + state_bytes
+
+
+def saved_activation_bytes_per_token(model, rows=2, seq_len=64):
+    # 统计第一个 decoder layer 为反向保存的张量，按 storage 去重，不计参数
+    params = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in params:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    layer = model.base_model.model.model.layers[0]
+    hooks = torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor)
+    layer.register_forward_pre_hook(lambda *args: hooks.__enter__())
+    layer.register_forward_hook(lambda *args: hooks.__exit__(None, None, None))
+    ids = torch.randint(0, 128, (rows, seq_len))
+    attention_mask = torch.ones_like(ids)
+    # 第一行左padding，与真实batch一样走带 mask 的 SDPA
+    attention_mask[0, :3] = 0
+    model(input_ids=ids, attention_mask=attention_mask)
+    return sum(saved.values()) / (rows * seq_len)
+
+
+@pytest.mark.parametrize("config_class", [Qwen2Config, Qwen3Config], ids=["qwen2", "qwen3"])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16], ids=["fp32", "bf16"])
+@pytest.mark.parametrize("lora_dropout", [0.0, 0.05])
+def test_layer_activation_bytes_matches_saved_tensors(config_class, dtype, lora_dropout):
+    model = tiny_lora_model(config_class, dtype, lora_dropout)
+    measured = saved_activation_bytes_per_token(model)
+    estimated = layer_activation_bytes(model.config, 8, TARGETS, lora_dropout, dtype_bytes=dtype.itemsize, lora_dtype_bytes=4)
+    assert abs(estimated - measured) <= ACTIVATION_TOLERANCE * measured, (estimated, measured)
@@ -0,0 +1,83 @@
+"""
+packing 与不packing的loss一致性: 随机初始化的小型 Qwen2/Qwen3 在CPU上对同一批样本分别用
+data_collator (左padding) 和 packing_data_collator (拼成一行) 前向，default / cosine 两种loss应在容差内一致。
+packing_data_collator 不输出 attention_mask，样本之间的隔离依赖 transformers 从重置的 position_ids 识别
+packed序列；若注意力跨样本泄漏 (例如注意力实现忽略 position_ids)，loss不再一致，这里必须能检测出来。
+"""
+import pytest
+import torch
+
+from train import create_compute_loss_func, data_collator, default_compute_loss_func, packing_data_collator
+
+transformers = pytest.importorskip("transformers")
+from transformers import AttentionInterface, AutoModelForCausalLM, Qwen2Config, Qwen3Config  # noqa: E402
+from transformers.integrations.sdpa_attention import sdpa_attention_forward  # noqa: E402
+
+EOS_TOKEN_ID = 1
+PAD_TOKEN_ID = 0
+VOCAB_SIZE = 128
+TOTAL_MAX_LENGTH = 4096
+ATOL = 1e-4
+
+
+def leaky_attention_forward(module, query, key, value, attention_mask, **kwargs):
+    # 只做因果mask，忽略由 position_ids 推出的样本边界: packing 行中后面的样本能看到前面的样本
+    return sdpa_attention_forward(module, query, key, value, None, **kwargs)
+
+
+AttentionInterface.register("leaky_packed", leaky_attention_forward)
+
+
+def make_examples(num_examples=4, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    examples = []
+    for _ in range(num_examples):
+        input_length, label_length = torch.randint(3, 20, (2,), generator=generator).tolist()
+        tokens = torch.randint(2, VOCAB_SIZE, (input_length + label_length,), generator=generator).tolist()
+        examples.append({"input_ids": tokens[:input_length], "labels": tokens[input_length:]})
+    return examples
+
+
+def make_model(config_class, attn_implementation):
+    torch.manual_seed(0)
+    config = config_class(vocab_size=VOCAB_SIZE, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                          num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=512,
+                          eos_token_id=EOS_TOKEN_ID, pad_token_id=PAD_TOKEN_ID)
+    config._attn_implementation = attn_implementation
+    # 与 main() 一致关闭KV cache: transformers 只在没有 past_key_values 时才从 position_ids 识别packed序列
+    config.use_cache = False
+    return AutoModelForCausalLM.from_config(config, dtype=torch.float32).eval()
+
+
+@torch.no_grad()
+def padded_and_packed_losses(model, examples, packed_model=None):
+    cosine_loss = create_compute_loss_func(EOS_TOKEN_ID)
+    losses = {}
+    padded = data_collator(examples, EOS_TOKEN_ID, PAD_TOKEN_ID, total_max_length=TOTAL_MAX_LENGTH, truncate=False)
+    outputs = model(input_ids=padded["input_ids"], attention_mask=padded["attention_mask"])
+    losses["padded"] = (default_compute_loss_func(outputs, padded["labels"], None),
+                        cosine_loss(outputs, padded["labels"], None))
+    packed = packing_data_collator(examples, EOS_TOKEN_ID, PAD_TOKEN_ID, total_max_length=TOTAL_MAX_LENGTH)
+    outputs = (packed_model or model)(input_ids=packed["input_ids"], position_ids=packed["position_ids"])
+    losses["packed"] = (default_compute_loss_func(outputs, packed["labels"], None),
+                        cosine_loss(outputs, packed["labels"], None, segment_ids=packed["segment_ids"]))
+    return losses
+
+
+@pytest.mark.parametrize("config_class", [Qwen2Config, Qwen3Config], ids=["qwen2", "qwen3"])
+@pytest.mark.parametrize("attn_implementation", ["eager", "sdpa"])
+def test_packed_loss_matches_padded(config_class, attn_implementation):
+    model = make_model(config_class, attn_implementation)
+    losses = padded_and_packed_losses(model, make_examples())
+    for name, padded_loss, packed_loss in zip(["default", "cosine"], losses["padded"], losses["packed"]):
+        torch.testing.assert_close(packed_loss, padded_loss, atol=ATOL, rtol=0, msg=lambda m: f"{name} loss: {m}")
+
+
+@pytest.mark.parametrize("config_class", [Qwen2Config, Qwen3Config], ids=["qwen2", "qwen3"])
+def test_cross_document_attention_is_detected(config_class):
+    # 对照: 同一组权重，packing 行用跨样本泄漏的注意力时 loss 明显不一致，上面的一致性检查才有意义
+    model = make_model(config_class, "sdpa")
+    leaky_model = make_model(config_class, "leaky_packed")
+    losses = padded_and_packed_losses(model, make_examples(), packed_model=leaky_model)
+    for padded_loss, packed_loss in zip(losses["padded"], losses["packed"]):
+        assert (packed_loss - padded_loss).abs() > 100 * ATOL
@@ -0,0 +1,39 @@
+"""StepTimingCallback: 未开启编译时每步不查询 torch.compile 的图计数"""
+import json
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+import train
+from train import StepTimingCallback
+
+
+def run_steps(timer, num_steps=3):
+    state = SimpleNamespace(global_step=0, is_world_process_zero=True)
+    for step in range(1, num_steps + 1):
+        timer.start_step(0.0, [{"input_ids": torch.ones(2, 8, dtype=torch.long)}])
+        timer.time_train_step(lambda: timer.time_forward(lambda: None))
+        timer.on_optimizer_step(None, state, None)
+        state.global_step = step
+        timer.on_step_end(None, state, SimpleNamespace(should_log=False, should_training_stop=step == num_steps))
+    return timer.pop_summary()
+
+
+def test_graph_count_not_queried_without_compile(tmp_path, monkeypatch):
+    def fail():
+        raise AssertionError("compiled_graph_count should not be called")
+    monkeypatch.setattr(train, "compiled_graph_count", fail)
+    summary = run_steps(StepTimingCallback(str(tmp_path / "timing.jsonl")))
+    assert "timing/graphs_compiled" not in summary
+
+
+@pytest.mark.parametrize("count_graphs", [False, True])
+def test_graphs_compiled_per_step(tmp_path, monkeypatch, count_graphs):
+    counts = iter(range(100))
+    monkeypatch.setattr(train, "compiled_graph_count", lambda: next(counts))
+    timer = StepTimingCallback(str(tmp_path / "timing.jsonl"), count_graphs=count_graphs)
+    summary = run_steps(timer)
+    assert ("timing/graphs_compiled" in summary) == count_graphs
+    records = [json.loads(line) for line in (tmp_path / "timing.jsonl").read_text().splitlines()]
+    assert [record["graphs_compiled"] is not None for record in records] == [count_graphs] * 3
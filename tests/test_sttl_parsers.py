@@ -0,0 +1,153 @@
+"""
+STTL 解析的差分校验，与原来的正则实现 (src/sttl_reference.py 中的 reference_*) 比较，不依赖 torch:
+- 属性块: compress_schema.scan_attr_block / schema_format.scan_attr_block 与 re.findall 逐对一致
+- 整段文本 (实体行、| 属性块、m=…||、#R 三元组): 合法输出和随机变异后的输出上 SchemaCodec.decode、
+  sttl_to_kg 与原实现一致，非法输入抛出相同类型的异常
+- STTLStreamParser 任意切分文本块后与 sttl_to_kg 一致
+"""
+import random
+import re
+
+import pytest
+
+import schema_format
+from compress_schema import SchemaCodec, build_attr_regex_pattern, build_schema_maps, scan_attr_block, schema_definition
+from sttl_reference import (
+    make_kg,
+    make_schema_format_sttls,
+    reference_convert_sttl_2_json,
+    reference_sttl_to_kg,
+    split_stream,
+)
+
+NUM_KGS = 64
+
+# 差分校验用的属性块片段: 真实代码、分隔符、\w 边界附近的字符 (含 Unicode 字母数字)
+SCANNER_PIECES = ["=", "=", ";", ";", " ", "_", "x", "7", "é", "中", "-", "|", ":", "||", "m", "m=", ".", "Appearance.Clothing"]
+
+
+def mutate_sttl(rng, text, codes):
+    # 在合法 STTL 上随机插入/替换片段，覆盖段首不是代码、值里再含 =、空段、缺少 : 的实体行等情况
+    pieces = SCANNER_PIECES + codes
+    lines = text.split("\n")
+    for _ in range(rng.randint(1, 6)):
+        i = rng.randrange(len(lines))
+        line = lines[i]
+        op = rng.random()
+        if op < 0.6:
+            pos = rng.randint(0, len(line))
+            line = line[:pos] + "".join(rng.choice(pieces) for _ in range(rng.randint(1, 4))) + line[pos:]
+        elif op < 0.8 and line:
+            pos = rng.randrange(len(line))
+            line = line[:pos] + line[pos + rng.randint(1, 5):]
+        elif op < 0.9:
+            line = rng.choice(["", "  ", "#R", "#R extra", "\t" + line + " "])
+        else:
+            line = "".join(rng.choice(pieces) for _ in range(rng.randint(1, 12)))
+        lines[i] = line
+    return "\n".join(lines)
+
+
+def parse_or_error(fn, *args, **kwargs):
+    # 原解析器对部分非法输入会抛异常，差分时比较异常类型
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        return type(e)
+
+
+@pytest.fixture(scope="module")
+def kgs():
+    rng = random.Random(0)
+    return [make_kg(rng, schema_definition, rng.randint(2, 12)) for _ in range(NUM_KGS)]
+
+
+@pytest.fixture(scope="module")
+def sf_sttls(kgs):
+    return make_schema_format_sttls(random.Random(1), kgs, schema_format.maps)
+
+
+def test_attr_block_scanners_match_regex():
+    rng = random.Random(0)
+    maps = build_schema_maps(schema_definition)
+    codes = list(maps["attr_map"].values())
+    pattern = re.compile(build_attr_regex_pattern(maps["attr_map"]))
+    # 含非字母代码、以 _ 开头、Unicode 字母的代码，以及互为前缀的代码
+    odd_attr_map = {"A1": "a1", "B": "_b", "C": "ä", "D": "x_2", "E": "x"}
+    odd_codes = list(odd_attr_map.values())
+    odd_pattern = re.compile(build_attr_regex_pattern(odd_attr_map))
+    for _ in range(20 * NUM_KGS):
+        block = "".join(rng.choice(SCANNER_PIECES + codes + odd_codes) for _ in range(rng.randint(0, 12)))
+        assert scan_attr_block(block, set(codes)) == pattern.findall(block + ";"), block
+        assert scan_attr_block(block, set(odd_codes)) == odd_pattern.findall(block + ";"), block
+        assert schema_format.scan_attr_block(block) == re.findall(r"([^=;]+)=([^;]*)", block), block
+
+
+def test_codec_decode_matches_reference(kgs):
+    rng = random.Random(0)
+    maps = build_schema_maps(schema_definition)
+    codec = SchemaCodec.from_maps(maps)
+    assert codec.scan_attrs, "schema 的属性代码应全部走 scan_attr_block"
+    codes = list(maps["attr_map"].values())
+    for sttl in codec.encode_many(kgs):
+        for text in [sttl] + [mutate_sttl(rng, sttl, codes) for _ in range(4)]:
+            assert codec.decode(text) == reference_convert_sttl_2_json(text, maps=maps), text
+
+
+def test_non_word_codes_fall_back_to_regex():
+    maps = build_schema_maps(schema_definition)
+    odd_maps = dict(maps, attr_map=dict(maps["attr_map"], Unknown="a-b"), attr_regex_pattern=None)
+    assert not SchemaCodec(odd_maps).scan_attrs
+
+
+@pytest.mark.parametrize("include_mentions", [True, False])
+def test_sttl_to_kg_matches_reference(sf_sttls, include_mentions):
+    rng = random.Random(0)
+    sf_maps = schema_format.maps
+    codes = list(sf_maps["attr_map"].values())
+    for sttl in sf_sttls:
+        for text in [sttl] + [mutate_sttl(rng, sttl, codes) for _ in range(4)]:
+            new = parse_or_error(schema_format.sttl_to_kg, text, sf_maps, include_mentions=include_mentions)
+            ref = parse_or_error(reference_sttl_to_kg, text, sf_maps, include_mentions=include_mentions)
+            assert new == ref, text
+
+
+def stream_parse(text, chunks, **kwargs):
+    parser = schema_format.STTLStreamParser(schema_format.maps, **kwargs)
+    events = []
+    for chunk in chunks:
+        events += parser.feed(chunk)
+    events += parser.close()
+    return parser, events
+
+
+@pytest.mark.parametrize("include_mentions", [True, False])
+def test_stream_parser_matches_sttl_to_kg(sf_sttls, include_mentions):
+    rng = random.Random(0)
+    sf_maps = schema_format.maps
+    codes = list(sf_maps["attr_map"].values())
+    for text in sf_sttls:
+        for variant in (text, text.replace("\n", "\r\n"), mutate_sttl(rng, text, codes)):
+            expected = parse_or_error(schema_format.sttl_to_kg, variant, sf_maps, include_mentions=include_mentions)
+            got = parse_or_error(stream_parse, variant, split_stream(rng, variant, 1, 8), include_mentions=include_mentions)
+            if isinstance(expected, type):
+                assert got is expected, variant
+                # 跳过非法行时其余行照常解析
+                parser, _ = stream_parse(variant, [variant], include_mentions=include_mentions, skip_invalid_lines=True)
+                assert parser.invalid_lines > 0
+                continue
+            parser, events = got
+            assert parser.kg == expected, variant
+            assert [e[1] for e in events if e[0] == "triple"] == expected["Triples"]
+            # 同名实体重复出现时 kg 里只保留一个，按首次出现的顺序比较
+            entity_names = [e[1] for e in events if e[0] == "entity"]
+            assert list(dict.fromkeys(entity_names)) == list(expected["Entity types"])
+
+
+def test_stream_parser_sees_in_place_maps_changes():
+    # 反向映射不跨调用缓存，原地修改 maps 后新的 parser 使用新的代码
+    maps = {name: dict(table) for name, table in schema_format.maps.items() if isinstance(table, dict)}
+    entity_type, code = next(iter(maps["entity_map"].items()))
+    assert schema_format.sttl_to_kg(f"x:{code}", maps)["Entity types"]["x"] == entity_type
+    maps["entity_map"][entity_type] = "ZZ"
+    assert schema_format.sttl_to_kg("x:ZZ", maps)["Entity types"]["x"] == entity_type
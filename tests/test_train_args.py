@@ -0,0 +1,36 @@
+"""train_args: 参数解析不导入 torch / transformers，只依赖参数的组合在解析时就报错"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+from train_args import parse_args
+
+REQUIRED = ["--model_name", "m", "--dataset_dir", "d", "--dataset_eval_dir", "e"]
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+
+def test_parse_args_does_not_import_heavy_modules():
+    code = ("import sys, train_args; train_args.parse_args(sys.argv[1:]); "
+            "print(sorted(m for m in ('torch', 'transformers', 'accelerate', 'numpy') if m in sys.modules))")
+    result = subprocess.run([sys.executable, "-c", code, *REQUIRED], cwd=SRC_DIR, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[]"
+
+
+def test_defaults():
+    args = parse_args(REQUIRED + ["--total_max_length", "12"])
+    assert args.total_max_length == 12 * 1024
+    assert args.tokenize_num_proc == (os.cpu_count() or 1)
+
+
+@pytest.mark.parametrize("extra", [
+    ["--loss_aware_sampling", "--streaming"],
+    ["--multi_adapter_config", "a.json", "--streaming"],
+    ["--multi_adapter_config", "a.json", "--packing"],
+    ["--compile_model"],
+    ["--compile_model", "--shape_bucket_size", "64", "--multi_adapter_config", "a.json"],
+])
+def test_invalid_combinations(extra):
+    with pytest.raises(ValueError):
+        parse_args(REQUIRED + extra)
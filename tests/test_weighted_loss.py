@@ -0,0 +1,86 @@
+"""
+weighted_compute_loss_func (collator 预计算的余弦位置权重) 与原 compute_loss 的一致性:
+eager 与 torch.compile 的 _weighted_cross_entropy，padding 与 packing 两种batch，loss 和梯度都要一致。
+"""
+from functools import partial
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from train import (
+    _weighted_cross_entropy,
+    compute_loss,
+    data_collator,
+    label_logit_positions,
+    packing_data_collator,
+    weighted_compute_loss_func,
+)
+
+EOS_TOKEN_ID = 1
+PAD_TOKEN_ID = 0
+VOCAB_SIZE = 96
+HIDDEN_SIZE = 32
+TOTAL_MAX_LENGTH = 4096
+
+CROSS_ENTROPY_FNS = {
+    "eager": _weighted_cross_entropy,
+    "compiled": torch.compile(_weighted_cross_entropy, dynamic=True),
+}
+COLLATORS = {"padded": data_collator, "packed": packing_data_collator}
+
+
+def make_examples(num_examples=6, seed=0):
+    # 长度各不相同，含只有一个label的样本
+    generator = torch.Generator().manual_seed(seed)
+    examples = []
+    for i in range(num_examples):
+        input_length = int(torch.randint(2, 24, (1,), generator=generator))
+        label_length = 1 if i == 0 else int(torch.randint(2, 40, (1,), generator=generator))
+        tokens = torch.randint(2, VOCAB_SIZE, (input_length + label_length,), generator=generator).tolist()
+        examples.append({"input_ids": tokens[:input_length], "labels": tokens[input_length:]})
+    return examples
+
+
+def loss_and_grad(loss_fn, batch, label_only):
+    # 随机 hidden states + lm_head 模拟模型输出；label_only 时只算label位置的logits，
+    # 为 "hidden" 时与 CustomTrainer(label_only_logits=True) 一样传入这些位置的 hidden states，由loss函数按chunk经过 lm_head
+    torch.manual_seed(0)
+    lm_head = torch.nn.Linear(HIDDEN_SIZE, VOCAB_SIZE, bias=False)
+    hidden = torch.randn(*batch["labels"].shape, HIDDEN_SIZE, requires_grad=True)
+    labels = batch["labels"]
+    if label_only == "hidden":
+        loss = loss_fn(SimpleNamespace(logits=hidden[:, label_logit_positions(labels)]), labels, None, lm_head=lm_head)
+    else:
+        logits = lm_head(hidden[:, label_logit_positions(labels)] if label_only else hidden)
+        loss = loss_fn(SimpleNamespace(logits=logits), labels, None)
+    loss.backward()
+    return loss.detach(), hidden.grad, lm_head.weight.grad
+
+
+@pytest.mark.parametrize("collator_name", list(COLLATORS))
+@pytest.mark.parametrize("fn_name", list(CROSS_ENTROPY_FNS))
+@pytest.mark.parametrize("label_only", ["hidden", True, False], ids=["chunked_lm_head", "label_only_logits", "full_logits"])
+@pytest.mark.parametrize("chunk_size", [7, 512])
+def test_weighted_loss_matches_compute_loss(collator_name, fn_name, label_only, chunk_size):
+    batch = COLLATORS[collator_name](make_examples(), EOS_TOKEN_ID, PAD_TOKEN_ID, TOTAL_MAX_LENGTH, with_loss_weights=True)
+    reference = partial(compute_loss, eos_token_id=EOS_TOKEN_ID, segment_ids=batch.get("segment_ids"))
+    candidate = partial(weighted_compute_loss_func, loss_weights=batch["loss_weights"], chunk_size=chunk_size,
+                        cross_entropy_fn=CROSS_ENTROPY_FNS[fn_name])
+    ref_loss, ref_hidden_grad, ref_weight_grad = loss_and_grad(reference, batch, label_only=False)
+    loss, hidden_grad, weight_grad = loss_and_grad(candidate, batch, label_only=label_only)
+    torch.testing.assert_close(loss, ref_loss, rtol=1e-5, atol=1e-6)
+    torch.testing.assert_close(hidden_grad, ref_hidden_grad, rtol=1e-4, atol=1e-6)
+    torch.testing.assert_close(weight_grad, ref_weight_grad, rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize("collator_name", list(COLLATORS))
+def test_packed_weights_match_padded_weights(collator_name):
+    # packing 时每个样本单独计算权重，与各样本单独成行时的权重相同
+    examples = make_examples()
+    batch = COLLATORS[collator_name](examples, EOS_TOKEN_ID, PAD_TOKEN_ID, TOTAL_MAX_LENGTH, with_loss_weights=True)
+    weights = batch["loss_weights"][batch["loss_weights"] > 0]
+    singles = [data_collator([example], EOS_TOKEN_ID, PAD_TOKEN_ID, TOTAL_MAX_LENGTH, with_loss_weights=True)["loss_weights"]
+               for example in examples]
+    expected = torch.cat([single[single > 0] for single in singles])
+    torch.testing.assert_close(weights.sort().values, expected.sort().values)
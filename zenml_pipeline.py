@@ -155,8 +155,12 @@ def train_model(dataset_dirs: tuple, training_script: str, training_env: str = N
         print("❌ 训练失败，返回码:", return_code)
         raise RuntimeError("训练失败")
     
-    # 从输出中提取最后一行作为输出目录
-    if output_lines and output_lines[-1].strip():
+    # 优先使用训练脚本根据 latest_checkpoint 完成标记输出的路径
+    marked_outputs = [line.split("=", 1)[1].strip() for line in output_lines if line.startswith("LATEST_CHECKPOINT=")]
+    if marked_outputs and os.path.exists(marked_outputs[-1]):
+        output_dir = marked_outputs[-1]
+    # 否则从输出中提取最后一行作为输出目录
+    elif output_lines and output_lines[-1].strip():
         # 尝试从最后一行获取输出目录
         potential_output = output_lines[-1].strip()
         if os.path.exists(potential_output):